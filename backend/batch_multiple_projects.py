@@ -8,6 +8,7 @@ import os
 sys.path.append(os.path.dirname(__file__))
 
 from batch_processor_v3 import *
+from batch_processor_v4_rate_optimized import GRAPH_CLIENT, fetch_pdf
 from concurrent.futures import ProcessPoolExecutor, as_completed
 import time
 
@@ -44,7 +45,7 @@ def process_single_project_path(project_path, access_token, user_email, collecti
 
         # フォルダの存在確認とID取得
         folder_url = f"https://graph.microsoft.com/v1.0/users/{user_email}/drive/root:/{project_path}"
-        response = requests.get(folder_url, headers=headers, timeout=30)
+        response = GRAPH_CLIENT.get(folder_url, headers=headers, timeout=30)
 
         if response.status_code != 200:
             return False, project_path, f"フォルダが見つかりません (Status: {response.status_code})"
@@ -54,7 +55,7 @@ def process_single_project_path(project_path, access_token, user_email, collecti
 
         # 構造設計図書フォルダを探索
         children_url = f"https://graph.microsoft.com/v1.0/users/{user_email}/drive/items/{parent_folder_id}/children"
-        children_response = requests.get(children_url, headers=headers, timeout=30)
+        children_response = GRAPH_CLIENT.get(children_url, headers=headers, timeout=30)
         children_response.raise_for_status()
         children = children_response.json().get('value', [])
 
@@ -73,7 +74,7 @@ def process_single_project_path(project_path, access_token, user_email, collecti
             for child in children:
                 if 'folder' in child and ('成果物' in child.get('name', '') or '納品' in child.get('name', '')):
                     sub_url = f"https://graph.microsoft.com/v1.0/users/{user_email}/drive/items/{child['id']}/children"
-                    sub_response = requests.get(sub_url, headers=headers, timeout=30)
+                    sub_response = GRAPH_CLIENT.get(sub_url, headers=headers, timeout=30)
                     if sub_response.status_code == 200:
                         sub_children = sub_response.json().get('value', [])
                         for sub_child in sub_children:
@@ -85,7 +86,7 @@ def process_single_project_path(project_path, access_token, user_email, collecti
                                 # 納品時などのさらにサブフォルダを探索
                                 if '納品' in sub_name:
                                     subsub_url = f"https://graph.microsoft.com/v1.0/users/{user_email}/drive/items/{sub_child['id']}/children"
-                                    subsub_response = requests.get(subsub_url, headers=headers, timeout=30)
+                                    subsub_response = GRAPH_CLIENT.get(subsub_url, headers=headers, timeout=30)
                                     if subsub_response.status_code == 200:
                                         subsub_children = subsub_response.json().get('value', [])
                                         for subsub_child in subsub_children:
@@ -156,7 +157,7 @@ def process_single_project_path(project_path, access_token, user_email, collecti
 
         # フォルダ内のファイル一覧を取得
         files_url = f"https://graph.microsoft.com/v1.0/users/{user_email}/drive/items/{folder_id}/children"
-        files_response = requests.get(files_url, headers=headers, timeout=30)
+        files_response = GRAPH_CLIENT.get(files_url, headers=headers, timeout=30)
         files_response.raise_for_status()
         items = files_response.json().get('value', [])
 
@@ -173,13 +174,11 @@ def process_single_project_path(project_path, access_token, user_email, collecti
         file_name_hints = []
 
         for pdf_file in calc_files[:10]:  # 最大10ファイル
-            download_url = pdf_file.get('@microsoft.graph.downloadUrl')
-            if download_url:
-                pdf_response = requests.get(download_url, timeout=120)
-                if pdf_response.status_code == 200:
-                    # (label, data)のタプル形式で追加
-                    file_data_list.append((pdf_file['name'], pdf_response.content))
-                    file_name_hints.append(pdf_file['name'])
+            pdf_file_data = fetch_pdf(pdf_file, headers, user_email)
+            if pdf_file_data is not None:
+                # (label, data)のタプル形式で追加
+                file_data_list.append((pdf_file['name'], pdf_file_data))
+                file_name_hints.append(pdf_file['name'])
 
         if not file_data_list:
             return False, project_path, "PDFダウンロード失敗"
@@ -188,7 +187,11 @@ def process_single_project_path(project_path, access_token, user_email, collecti
 
         # Gemini APIで解析
         print(f"   🤖 AI解析開始...")
-        analysis_result = analyze_with_gemini(file_data_list, file_name_hints)
+        try:
+            analysis_result = analyze_with_gemini(file_data_list, file_name_hints)
+        finally:
+            for _, data in file_data_list:
+                data.close()
 
         # メモリ解放
         del file_data_list
@@ -1,5 +1,4 @@
 import msal
-import requests
 import json
 import os
 import vertexai
@@ -7,6 +6,7 @@ from vertexai.generative_models import GenerativeModel, Part, GenerationConfig
 from google.cloud import secretmanager
 from google.cloud import firestore
 from datetime import datetime, timezone, timedelta
+from batch_processor_v4_rate_optimized import GRAPH_CLIENT, fetch_pdf, read_pdf_data
 
 # 日本時間のタイムゾーン
 JST = timezone(timedelta(hours=9))
@@ -290,7 +290,7 @@ def fetch_drive_changes(access_token, user_email, delta_link=None):
 
     try:
         while url:
-            response = requests.get(url, headers=headers)
+            response = GRAPH_CLIENT.get(url, headers=headers)
             response.raise_for_status()
             data = response.json()
 
@@ -383,13 +383,13 @@ def process_changed_folders(access_token, user_email, changed_items):
         try:
             # フォルダ内の全ファイルを取得
             folder_url = f"https://graph.microsoft.com/v1.0/users/{user_email}/drive/items/{folder_id}/children"
-            response = requests.get(folder_url, headers=headers)
+            response = GRAPH_CLIENT.get(folder_url, headers=headers)
             response.raise_for_status()
             folder_items = response.json().get('value', [])
 
             # フォルダ情報も取得
             folder_detail_url = f"https://graph.microsoft.com/v1.0/users/{user_email}/drive/items/{folder_id}"
-            folder_response = requests.get(folder_detail_url, headers=headers)
+            folder_response = GRAPH_CLIENT.get(folder_detail_url, headers=headers)
             folder_detail = folder_response.json() if folder_response.status_code == 200 else {}
 
             # 構造計算書・図面・証明書を選定
@@ -430,7 +430,7 @@ def process_changed_folders(access_token, user_email, changed_items):
 def process_folder_recursive(access_token, folder_url, user_email, current_path=""):
     headers = {"Authorization": f"Bearer {access_token}"}
     try:
-        response = requests.get(folder_url, headers=headers)
+        response = GRAPH_CLIENT.get(folder_url, headers=headers)
         response.raise_for_status()
         items = response.json().get('value', [])
 
@@ -445,7 +445,7 @@ def process_folder_recursive(access_token, folder_url, user_email, current_path=
                 if "納品" in folder_name or "成果物" in folder_name:
                     print(f"\n🎯 ターゲットフォルダ発見: {folder_name}")
                     # 中身を取得
-                    res_child = requests.get(child_url, headers=headers)
+                    res_child = GRAPH_CLIENT.get(child_url, headers=headers)
                     child_items = res_child.json().get('value', [])
 
                     # デバッグ: フォルダ内の全アイテムを表示
@@ -471,7 +471,7 @@ def process_folder_recursive(access_token, folder_url, user_email, current_path=
                     for child_item in child_items:
                         if "folder" in child_item:
                             sub_url = f"https://graph.microsoft.com/v1.0/users/{user_email}/drive/items/{child_item['id']}/children"
-                            res_sub = requests.get(sub_url, headers=headers)
+                            res_sub = GRAPH_CLIENT.get(sub_url, headers=headers)
                             sub_items = res_sub.json().get('value', [])
                             for sub_item in sub_items:
                                 sub_name = sub_item['name']
@@ -511,7 +511,7 @@ def process_folder_recursive(access_token, folder_url, user_email, current_path=
                     # 構造設計図書フォルダが見つかった場合、その中のファイルを取得
                     if kouzo_sekkei_folder:
                         kouzo_url = f"https://graph.microsoft.com/v1.0/users/{user_email}/drive/items/{kouzo_sekkei_folder['id']}/children"
-                        res_kouzo = requests.get(kouzo_url, headers=headers)
+                        res_kouzo = GRAPH_CLIENT.get(kouzo_url, headers=headers)
                         kouzo_items = res_kouzo.json().get('value', [])
                         all_calc_files, all_drawing_files, target_cert, target_review = select_project_files(kouzo_items)
 
@@ -597,15 +597,14 @@ def process_project_files(access_token, user_email, calc_files, drawing_files, c
     print(f"      物件名: {metadata['projectName'] or '不明'}")
 
     # ダウンロード処理
-    files_to_analyze = [] # (ファイル名, バイナリデータ) のリスト
+    files_to_analyze = [] # (ファイル名, 一時ファイル) のリスト
 
     # A. 全ての構造計算書をダウンロード
     print(f"   ⬇️ 構造計算書DL: {len(calc_files)}ファイル")
     for calc_file in calc_files:
         calc_name = calc_file['name']
-        calc_id = calc_file['id']
         print(f"      - {calc_name}")
-        calc_data = download_content(access_token, user_email, calc_id)
+        calc_data = download_content(access_token, user_email, calc_file)
         if not calc_data:
             print(f"      ⚠️ ダウンロード失敗: {calc_name}")
             continue
@@ -616,9 +615,8 @@ def process_project_files(access_token, user_email, calc_files, drawing_files, c
         print(f"   ⬇️ 構造図面DL: {len(drawing_files)}ファイル")
         for drawing_file in drawing_files:
             drawing_name = drawing_file['name']
-            drawing_id = drawing_file['id']
             print(f"      - {drawing_name}")
-            drawing_data = download_content(access_token, user_email, drawing_id)
+            drawing_data = download_content(access_token, user_email, drawing_file)
             if not drawing_data:
                 print(f"      ⚠️ ダウンロード失敗: {drawing_name}")
                 continue
@@ -629,7 +627,7 @@ def process_project_files(access_token, user_email, calc_files, drawing_files, c
     # C. 安全証明書のダウンロード (あれば)
     if cert_file:
         print(f"   ⬇️ 安全証明書DL: {cert_file['name']} ...")
-        cert_data = download_content(access_token, user_email, cert_file['id'])
+        cert_data = download_content(access_token, user_email, cert_file)
         if cert_data:
             files_to_analyze.append(("安全証明書", cert_data))
     else:
@@ -638,7 +636,7 @@ def process_project_files(access_token, user_email, calc_files, drawing_files, c
     # D. 回答書のダウンロード (あれば)
     if review_file:
         print(f"   ⬇️ 回答書DL: {review_file['name']} ...")
-        review_data = download_content(access_token, user_email, review_file['id'])
+        review_data = download_content(access_token, user_email, review_file)
         if review_data:
             files_to_analyze.append(("指摘回答書", review_data))
     else:
@@ -661,7 +659,11 @@ def process_project_files(access_token, user_email, calc_files, drawing_files, c
 
     # AI解析
     print("   🤖 AI解析中 (Gemini 2.5 Pro)...")
-    result_json = analyze_with_gemini(files_to_analyze, file_name_hints)
+    try:
+        result_json = analyze_with_gemini(files_to_analyze, file_name_hints)
+    finally:
+        for _, data in files_to_analyze:
+            data.close()
 
     if result_json:
         result_json["fileName"] = file_name
@@ -739,12 +741,11 @@ def process_project_files(access_token, user_email, calc_files, drawing_files, c
     else:
         print("   ❌ AI解析失敗")
 
-def download_content(access_token, user_email, file_id):
-    url = f"https://graph.microsoft.com/v1.0/users/{user_email}/drive/items/{file_id}/content"
+def download_content(access_token, user_email, file_item):
+    """ファイルを取得（PDFキャッシュになければ一時ファイルにストリーミングでダウンロード。使用後はclose()すること）"""
     headers = {"Authorization": f"Bearer {access_token}"}
     try:
-        res = requests.get(url, headers=headers)
-        if res.status_code == 200: return res.content
+        return fetch_pdf(file_item, headers, user_email)
     except: pass
     return None
 
@@ -756,7 +757,7 @@ def analyze_with_gemini(file_data_list, file_name_hints=None):
 
     parts = []
     for label, data in file_data_list:
-        parts.append(Part.from_data(data, mime_type="application/pdf"))
+        parts.append(Part.from_data(read_pdf_data(data), mime_type="application/pdf"))
 
     # ファイル名からのヒント情報を追加
     hints_section = ""
@@ -8,21 +8,25 @@ Uplan Knowledge Base - Batch Processor v3 (Parallel Processing Edition)
 - Cloud Run Jobs対応
 """
 
-import msal
 import requests
 import json
 import os
+import sys
 import gc
 import argparse
 import time
 from concurrent.futures import ProcessPoolExecutor, as_completed
 from typing import List, Dict, Tuple, Optional
-import vertexai
-from vertexai.generative_models import GenerativeModel, Part, GenerationConfig
-from google.cloud import secretmanager
-from google.cloud import firestore
+from vertexai.generative_models import Part, GenerationConfig
 from google.api_core import retry, exceptions
 from datetime import datetime, timezone, timedelta
+from batch_processor_v4_rate_optimized import (
+    iter_graph_items, resolve_changed_project_folders, fetch_drive_changes,
+    get_delta_link, save_delta_link, fetch_latest_delta_link, get_pending_project_folders,
+    get_access_token, init_shared_token_cache, TOKEN_PROVIDER,
+    fetch_pdf, read_file_data, close_file_data,
+    get_firestore_client, get_gemini_model, init_worker
+)
 
 # 日本時間のタイムゾーン
 JST = timezone(timedelta(hours=9))
@@ -38,54 +42,11 @@ DEFAULT_MAX_WORKERS = 5
 # ---------------------------------------------------------
 
 # 1. 認証周り
-def get_secret(secret_id):
-    """Secret Managerからシークレットを取得"""
-    client = secretmanager.SecretManagerServiceClient()
-    name = f"projects/{GCP_PROJECT_ID}/secrets/{secret_id}/versions/latest"
-    response = client.access_secret_version(request={"name": name})
-    return response.payload.data.decode("UTF-8")
-
-def get_access_token():
-    """Microsoft Graph API用のアクセストークンを取得"""
-    try:
-        client_id = get_secret("MS_CLIENT_ID")
-        tenant_id = get_secret("MS_TENANT_ID")
-        client_secret = get_secret("MS_CLIENT_SECRET")
-
-        authority = f"https://login.microsoftonline.com/{tenant_id}"
-        app = msal.ConfidentialClientApplication(client_id, authority=authority, client_credential=client_secret)
-        result = app.acquire_token_for_client(scopes=["https://graph.microsoft.com/.default"])
-        return result.get("access_token")
-    except Exception as e:
-        print(f"❌ 認証エラー: {e}")
-        return None
+# get_secret / get_access_token はv4と共通（シークレットとトークンをキャッシュし、期限前に更新）
 
 # 1-2. システム設定管理（デルタクエリ用スタンプ）
-def get_system_config():
-    """Firestoreからシステム設定（前回の同期状態）を取得"""
-    try:
-        db = firestore.Client(project=GCP_PROJECT_ID, database="uplan")
-        doc_ref = db.collection("system_config").document("onedrive_sync")
-        doc = doc_ref.get()
-        if doc.exists:
-            return doc.to_dict()
-        return None
-    except Exception as e:
-        print(f"⚠️ システム設定取得エラー: {e}")
-        return None
-
-def save_system_config(delta_link):
-    """Firestoreにシステム設定（同期状態）を保存"""
-    try:
-        db = firestore.Client(project=GCP_PROJECT_ID, database="uplan")
-        doc_ref = db.collection("system_config").document("onedrive_sync")
-        doc_ref.set({
-            "deltaLink": delta_link,
-            "last_run_at": firestore.SERVER_TIMESTAMP
-        })
-        print(f"✅ デルタリンクを保存しました")
-    except Exception as e:
-        print(f"❌ システム設定保存エラー: {e}")
+# ターゲットパスごとのデルタリンクは get_delta_link / save_delta_link（v4と共通）で管理
+# 失敗した案件フォルダはデルタリンクと一緒に保存し、次の差分更新で再処理する
 
 # 2. パス情報抽出ロジック
 def extract_project_metadata(folder_path):
@@ -177,45 +138,7 @@ def select_project_files(file_list):
 
     return all_calc_files, all_drawing_files, best_cert, best_review
 
-# 4. デルタクエリによる差分取得
-def fetch_drive_changes(access_token, user_email, delta_link=None):
-    """Microsoft Graph APIのデルタクエリを使用して、前回からの変更を取得"""
-    headers = {"Authorization": f"Bearer {access_token}"}
-    changed_items = []
-
-    if delta_link is None:
-        url = f"https://graph.microsoft.com/v1.0/users/{user_email}/drive/root:/delta"
-        print(f"📍 初回デルタクエリ実行")
-    else:
-        url = delta_link
-        print(f"📍 差分取得モード: 前回からの変更のみを取得")
-
-    try:
-        while url:
-            response = requests.get(url, headers=headers)
-            response.raise_for_status()
-            data = response.json()
-
-            items = data.get('value', [])
-            for item in items:
-                if 'deleted' in item:
-                    continue
-                if 'file' in item and item.get('name', '').lower().endswith('.pdf'):
-                    changed_items.append(item)
-                if 'folder' in item:
-                    changed_items.append(item)
-
-            url = data.get('@odata.nextLink')
-            if not url:
-                new_delta_link = data.get('@odata.deltaLink')
-                break
-
-        print(f"✅ デルタクエリ完了: {len(changed_items)}件の変更を検出")
-        return changed_items, new_delta_link
-
-    except Exception as e:
-        print(f"❌ デルタクエリエラー: {e}")
-        return [], None
+# 4. デルタクエリによる差分取得は fetch_drive_changes（v4と共通。ドライブ全体のデルタをターゲットパスで絞り込む）を使用
 
 # 5. フォルダ収集（並列処理用）
 def collect_all_project_folders(access_token, user_email, root_path):
@@ -231,9 +154,7 @@ def collect_all_project_folders(access_token, user_email, root_path):
     def scan_folder_recursive(folder_url, current_path=""):
         """再帰的にフォルダをスキャン"""
         try:
-            response = requests.get(folder_url, headers=headers, timeout=30)
-            response.raise_for_status()
-            items = response.json().get('value', [])
+            items = list(iter_graph_items(folder_url, headers, timeout=30))
 
             for item in items:
                 if "folder" not in item:
@@ -247,10 +168,11 @@ def collect_all_project_folders(access_token, user_email, root_path):
                 if ('構造設計図書' in folder_name or '構造計算書' in folder_name) and '○' not in folder_name:
                     # サブフォルダ（納品時など）も探索
                     sub_url = f"https://graph.microsoft.com/v1.0/users/{user_email}/drive/items/{folder_id}/children"
-                    sub_response = requests.get(sub_url, headers=headers, timeout=30)
-                    if sub_response.status_code == 200:
-                        sub_items = sub_response.json().get('value', [])
-
+                    try:
+                        sub_items = list(iter_graph_items(sub_url, headers, timeout=30))
+                    except requests.exceptions.HTTPError:
+                        sub_items = None
+                    if sub_items is not None:
                         # サブフォルダ内にも構造設計図書フォルダがあるかチェック
                         has_sub_folders = False
                         for sub_item in sub_items:
@@ -307,8 +229,7 @@ def analyze_with_gemini(file_data_list, file_name_hints=None):
     Gemini 2.0 Flash (Vertex AI) でPDFを解析
     file_data_list: [{"data": bytes, "mime_type": str, "name": str}, ...]
     """
-    vertexai.init(project=GCP_PROJECT_ID, location=LOCATION)
-    model = GenerativeModel("gemini-2.0-flash-exp")
+    model = get_gemini_model()
 
     parts = []
 
@@ -319,7 +240,7 @@ def analyze_with_gemini(file_data_list, file_name_hints=None):
 
     # PDFファイルを追加
     for file_info in file_data_list:
-        parts.append(Part.from_data(file_info["data"], mime_type=file_info["mime_type"]))
+        parts.append(Part.from_data(read_file_data(file_info), mime_type=file_info["mime_type"]))
         parts.append(f"[ファイル名: {file_info['name']}]")
 
     # プロンプト（簡略版 - 実際のプロンプトは既存のものを使用）
@@ -421,13 +342,13 @@ def analyze_with_gemini(file_data_list, file_name_hints=None):
         return None
 
 # 7. 単一案件の処理（並列実行される関数）
-def process_single_project(project_info: Dict, access_token: str, user_email: str) -> Tuple[bool, str]:
+def process_single_project(project_info: Dict, access_token: Optional[str], user_email: str) -> Tuple[bool, str]:
     """
     単一の案件フォルダを処理（並列実行される）
 
     Args:
         project_info: フォルダ情報
-        access_token: アクセストークン
+        access_token: アクセストークン（Noneの場合は実行時に共有キャッシュから取得）
         user_email: ユーザーメールアドレス
 
     Returns:
@@ -437,21 +358,21 @@ def process_single_project(project_info: Dict, access_token: str, user_email: st
     folder_name = project_info['name']
     full_path = project_info['full_path']
 
+    if access_token is None:
+        access_token = TOKEN_PROVIDER.get_token()
     headers = {"Authorization": f"Bearer {access_token}"}
 
     try:
         # フォルダの詳細情報とwebUrlを取得
-        folder_detail_url = f"https://graph.microsoft.com/v1.0/users/{user_email}/drive/items/{folder_id}"
+        folder_detail_url = f"https://graph.microsoft.com/v1.0/users/{user_email}/drive/items/{folder_id}?$select=id,webUrl"
         folder_detail_response = requests.get(folder_detail_url, headers=headers, timeout=30)
         folder_detail_response.raise_for_status()
         folder_detail = folder_detail_response.json()
         folder_web_url = folder_detail.get('webUrl', '')
 
-        # フォルダ内のファイル一覧を取得
+        # フォルダ内のファイル一覧を取得（全ページ）
         folder_url = f"https://graph.microsoft.com/v1.0/users/{user_email}/drive/items/{folder_id}/children"
-        response = requests.get(folder_url, headers=headers, timeout=60)
-        response.raise_for_status()
-        items = response.json().get('value', [])
+        items = list(iter_graph_items(folder_url, headers, timeout=60))
 
         # ファイルを選定
         calc_files, drawing_files, cert_file, review_file = select_project_files(items)
@@ -460,7 +381,7 @@ def process_single_project(project_info: Dict, access_token: str, user_email: st
             return False, f"構造計算書PDFが見つかりません"
 
         # 重複チェック: 既にこのfolder_idが登録されているか確認
-        db = firestore.Client(project=GCP_PROJECT_ID, database="uplan")
+        db = get_firestore_client()
         existing_query = db.collection("Projects_2026_01_07").where("file_id", "==", folder_id).limit(1).stream()
         existing_docs = list(existing_query)
 
@@ -505,22 +426,23 @@ def process_single_project(project_info: Dict, access_token: str, user_email: st
         file_name_hints = []
 
         for pdf_file in calc_files[:5]:  # 最大5ファイル
-            download_url = pdf_file.get('@microsoft.graph.downloadUrl')
-            if download_url:
-                pdf_response = requests.get(download_url, timeout=120)
-                if pdf_response.status_code == 200:
-                    file_data_list.append({
-                        "data": pdf_response.content,
-                        "mime_type": "application/pdf",
-                        "name": pdf_file['name']
-                    })
-                    file_name_hints.append(pdf_file['name'])
+            pdf_file_data = fetch_pdf(pdf_file, headers, user_email)
+            if pdf_file_data is not None:
+                file_data_list.append({
+                    "file": pdf_file_data,
+                    "mime_type": "application/pdf",
+                    "name": pdf_file['name']
+                })
+                file_name_hints.append(pdf_file['name'])
 
         if not file_data_list:
             return False, "PDFダウンロード失敗"
 
         # Gemini APIで解析
-        analysis_result = analyze_with_gemini_retry(file_data_list, file_name_hints)
+        try:
+            analysis_result = analyze_with_gemini_retry(file_data_list, file_name_hints)
+        finally:
+            close_file_data(file_data_list)
 
         # メモリ解放
         del file_data_list
@@ -533,7 +455,7 @@ def process_single_project(project_info: Dict, access_token: str, user_email: st
         metadata = extract_project_metadata(full_path)
 
         # Firestoreに保存
-        db = firestore.Client(project=GCP_PROJECT_ID, database="uplan")
+        db = get_firestore_client()
 
         # ドキュメントIDを生成（物件名_日時）
         from datetime import datetime
@@ -614,23 +536,27 @@ def process_projects_parallel(project_folders: List[Dict], max_workers: int = 5)
     Args:
         project_folders: 案件フォルダ情報のリスト
         max_workers: 並列処理数
+
+    Returns:
+        失敗した案件フォルダのリスト（認証失敗で処理できなかった場合はNone）
     """
     print(f"\n🚀 並列処理開始: {len(project_folders)}件を{max_workers}並列で処理")
 
-    # 各プロセスで使用するアクセストークンを取得
+    # 認証を事前に確認（トークンは共有キャッシュ経由で各プロセスが実行時に取得）
     token = get_access_token()
     if not token:
         print("❌ 認証失敗")
-        return
+        return None
 
     success_count = 0
     error_count = 0
+    failed_projects = []
 
     # ProcessPoolExecutorで並列処理
-    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=init_worker) as executor:
         # タスクを投入
         future_to_project = {
-            executor.submit(process_single_project, project, token, TARGET_USER_EMAIL): project
+            executor.submit(process_single_project, project, None, TARGET_USER_EMAIL): project
             for project in project_folders
         }
 
@@ -644,15 +570,18 @@ def process_projects_parallel(project_folders: List[Dict], max_workers: int = 5)
                     print(f"✅ [{success_count + error_count}/{len(project_folders)}] {project['name']}: {message}")
                 else:
                     error_count += 1
+                    failed_projects.append(project)
                     print(f"❌ [{success_count + error_count}/{len(project_folders)}] {project['name']}: {message}")
             except Exception as e:
                 error_count += 1
+                failed_projects.append(project)
                 print(f"❌ [{success_count + error_count}/{len(project_folders)}] {project['name']}: 例外 - {str(e)[:100]}")
 
             # 少し待機（レート制限対策）
             time.sleep(0.2)
 
     print(f"\n📊 処理完了: 成功 {success_count}件 / エラー {error_count}件 / 合計 {len(project_folders)}件")
+    return failed_projects
 
 # 9. メイン処理
 def main():
@@ -661,6 +590,7 @@ def main():
     from datetime import datetime
     start_time = time.time()
     start_datetime = datetime.now()
+    run_started_at = datetime.now(JST)
 
     parser = argparse.ArgumentParser(description='Uplan Knowledge Base - Batch Processor (並列処理版)')
     parser.add_argument('--target-path', type=str, default=DEFAULT_TARGET_PATH,
@@ -681,7 +611,8 @@ def main():
     print(f"⏰ 開始時刻: {start_datetime.strftime('%Y/%m/%d %H:%M:%S')}")
     print("=" * 80)
 
-    # 認証
+    # 認証（トークンは実行ごとの一時ディレクトリでワーカーと共有し、終了時に削除）
+    init_shared_token_cache()
     token = get_access_token()
     if not token:
         print("❌ 認証失敗のため終了します")
@@ -690,27 +621,55 @@ def main():
     if args.mode == 'delta':
         # 差分更新モード
         print("\n📊 差分更新モード: 前回からの変更のみを処理します")
-        system_config = get_system_config()
-        delta_link = system_config.get('deltaLink') if system_config else None
+        delta_link = get_delta_link(TARGET_USER_EMAIL, args.target_path)
 
         if not delta_link:
             print("⚠️ デルタリンクが見つかりません。全件スキャンモードで実行してください。")
             return
 
-        changed_items, new_delta_link = fetch_drive_changes(token, TARGET_USER_EMAIL, delta_link)
+        changed_items, new_delta_link = fetch_drive_changes(token, TARGET_USER_EMAIL, args.target_path, delta_link)
+        if not new_delta_link:
+            print("❌ 差分を取得できませんでした（デルタリンクが失効した場合は --mode full で再実行してください）")
+            sys.exit(1)
 
+        project_folders = []
         if not changed_items:
             print("✨ 変更はありませんでした")
-            return
-
-        # 変更されたフォルダを処理（ここでは簡略化のため省略）
-        print(f"📝 {len(changed_items)}件の変更を検出しました")
-        # TODO: 差分モードの詳細実装
+        else:
+            # 変更されたPDFの親フォルダから最も近い構造設計図書フォルダを特定
+            print(f"📝 {len(changed_items)}件の変更を検出しました")
+            try:
+                project_folders = resolve_changed_project_folders(token, TARGET_USER_EMAIL, args.target_path, changed_items)
+            except Exception as e:
+                print(f"❌ 変更された案件フォルダを特定できませんでした（デルタリンクは更新しません）: {e}")
+                sys.exit(1)
+
+        # 前回までに失敗した案件フォルダも再処理
+        changed_ids = {folder['id'] for folder in project_folders}
+        retry_folders = [folder for folder in get_pending_project_folders(TARGET_USER_EMAIL, args.target_path)
+                         if folder['id'] not in changed_ids]
+        if retry_folders:
+            print(f"🔁 前回失敗した案件フォルダを再処理: {len(retry_folders)}件")
+            project_folders += retry_folders
+
+        failed_projects = []
+        if project_folders:
+            failed_projects = process_projects_parallel(project_folders, max_workers=args.workers)
+        elif changed_items:
+            print("✨ 処理対象の案件フォルダはありませんでした")
+
+        if failed_projects is None:
+            print("⚠️ 案件を処理できなかったため、デルタリンクを更新しません")
+        elif new_delta_link:
+            save_delta_link(TARGET_USER_EMAIL, args.target_path, new_delta_link, run_started_at, failed_projects)
 
     else:
         # 全件スキャンモード
         print("\n📊 全件スキャンモード: すべてのフォルダを探索します")
 
+        # 収集前の時点を起点にデルタリンクを取得（ドライブ全体のリンクをターゲットパスごとのカーソルに保存）
+        new_delta_link = fetch_latest_delta_link(token, TARGET_USER_EMAIL)
+
         # フォルダ収集
         project_folders = collect_all_project_folders(token, TARGET_USER_EMAIL, args.target_path)
 
@@ -719,13 +678,13 @@ def main():
             return
 
         # 並列処理
-        process_projects_parallel(project_folders, max_workers=args.workers)
+        failed_projects = process_projects_parallel(project_folders, max_workers=args.workers)
 
-        # デルタリンク取得と保存
-        print("\n📍 初回デルタリンクを取得中...")
-        _, new_delta_link = fetch_drive_changes(token, TARGET_USER_EMAIL, None)
-        if new_delta_link:
-            save_system_config(new_delta_link)
+        # デルタリンクを保存（次回の差分取得用。失敗した案件フォルダは次回の差分更新で再処理）
+        if failed_projects is None:
+            print("⚠️ 案件を処理できなかったため、デルタリンクを更新しません")
+        elif new_delta_link:
+            save_delta_link(TARGET_USER_EMAIL, args.target_path, new_delta_link, run_started_at, failed_projects)
 
     # 実行時間トラッキング終了
     end_time = time.time()
@@ -13,31 +13,65 @@ import msal
 import requests
 import json
 import os
+import sys
+import atexit
 import gc
 import argparse
 import time
 import random
-from concurrent.futures import ProcessPoolExecutor, as_completed
+import hashlib
+import asyncio
+import sqlite3
+import tempfile
+import shutil
+import io
+import queue
+import threading
+import httpx
+import urllib.parse
+import unicodedata
+import base64
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from typing import List, Dict, Tuple, Optional
 import vertexai
 from vertexai.generative_models import GenerativeModel, Part, GenerationConfig
+from vertexai.batch_prediction import BatchPredictionJob
 from google.cloud import secretmanager
 from google.cloud import firestore
+from google.cloud import storage
 from google.api_core import retry, exceptions
 from datetime import datetime, timezone, timedelta
 import re
 
+# PDFのページ抽出（任意。未インストールの場合はページを絞らずにPDF全体を送信）
+try:
+    from pypdf import PdfReader, PdfWriter
+except ImportError:
+    PdfReader = PdfWriter = None
+
+# 構造図の画像化（任意。未インストールの場合はGraphのサムネイル、それもなければPDFのまま送信）
+try:
+    import pypdfium2 as pdfium
+    from PIL import Image
+except ImportError:
+    pdfium = Image = None
+
 # 日本時間のタイムゾーン
 JST = timezone(timedelta(hours=9))
 
 # --- 設定 ---
 GCP_PROJECT_ID = "uplan-knowledge-base"
 LOCATION = "us-central1"
+GEMINI_MODEL_NAME = "gemini-2.0-flash-exp"
+FIRESTORE_DATABASE = "uplan"
 TARGET_USER_EMAIL = "info@uplan2018.onmicrosoft.com"
 
 # デフォルト設定
 DEFAULT_TARGET_PATH = "001_Ｕ'plan_全社/01.構造設計/01.木造（在来軸組）"
 DEFAULT_MAX_WORKERS = 10  # 並列数を増やしてレート制限を分散
+DEFAULT_CRAWL_CONCURRENCY = 8  # フォルダ収集時のGraph API同時リクエスト数
+# フォルダツリーのローカルインデックス（前回からデルタで変更が報告されていないサブツリーは再クロールしない）
+DEFAULT_FOLDER_INDEX_PATH = os.environ.get("FOLDER_INDEX_PATH", ".cache/folder_index.sqlite3")
 # Firestoreルール: データ抽出のたびに新規コレクションを作成（形式: YYYY-MM-DD-HH:MM）
 DEFAULT_COLLECTION = datetime.now().strftime("%Y-%m-%d-%H:%M")
 
@@ -47,30 +81,1479 @@ MAX_RETRY_DELAY = 120.0     # 最大リトライ待機時間（秒）
 MAX_RETRIES = 5             # 最大リトライ回数
 JITTER_RANGE = 0.5          # ランダムジッター範囲（秒）
 
+# Graph API 一覧取得設定
+GRAPH_PAGE_SIZE = 999       # 1ページあたりの最大取得件数（$top）
+# パイプラインで使用するフィールドのみ取得（$select）
+GRAPH_ITEM_SELECT = "id,name,folder,file,size,parentReference,webUrl,lastModifiedDateTime,cTag,eTag,@microsoft.graph.downloadUrl"
+# デルタクエリでは削除フラグも含めて取得（ツリー構築に必要な最小限のフィールド）
+DELTA_ITEM_SELECT = "id,name,folder,file,parentReference,deleted,cTag,eTag"
+# 検索APIでの候補取得用（is_project_folder_nameの判定キーワードで検索）
+SEARCH_QUERIES = ("構造設計図書", "構造計算書")
+SEARCH_ITEM_SELECT = "id,name,folder,parentReference,cTag,eTag"
+GRAPH_API_BASE = "https://graph.microsoft.com/v1.0"
+GRAPH_BATCH_URL = f"{GRAPH_API_BASE}/$batch"
+GRAPH_BATCH_MAX_REQUESTS = 20  # $batch 1回あたりの最大リクエスト数（Graph APIの上限）
+GRAPH_BATCH_FLUSH_DELAY = 0.05  # 非同期バッチの送信待ち時間（秒）
+GRAPH_THROTTLE_STATUS_CODES = (429, 503)  # Retry-Afterに従ってリトライするステータス
+GRAPH_MIN_INTERVAL_STEP = 0.1   # スロットリング解消時にリクエスト間隔を縮める幅（秒）
+GRAPH_MAX_INTERVAL = 10.0       # スロットリング時のリクエスト間隔の上限（秒）
+GRAPH_POOL_CONNECTIONS = 4      # 接続プールを保持するホスト数（graph.microsoft.com + SharePointダウンロードホスト）
+GRAPH_POOL_MAXSIZE = 16         # ホストごとの最大接続数（フォルダ収集の同時リクエスト数以上にする）
+GRAPH_CONNECT_TIMEOUT = 10.0    # 接続タイムアウト（秒）。読み取りタイムアウトは呼び出し側のtimeout
+GRAPH_KEEPALIVE_EXPIRY = 60.0   # 非同期クライアントのアイドル接続の保持時間（秒）
+
+# PDFページ抽出設定（テキストレイヤーのキーワードで関連ページを選び、ページ数の上限内でGeminiに送る）
+PAGE_BUDGET_ENV = "PDF_PAGE_BUDGET"
+DEFAULT_PAGE_BUDGET = 40        # 1ファイルあたりの最大ページ数（0で無効）
+PAGE_ALWAYS_KEEP = 3            # 必ず含める先頭ページ数（表紙・概要）
+PAGE_MIN_TEXT_RATIO = 0.5       # テキストのあるページがこの割合未満なら（スキャンPDFとみなし）抽出しない
+# 抽出項目に関係するキーワードと重み
+PAGE_KEYWORDS = {
+    "構造計算概要": 10, "建築物の概要": 8, "建物概要": 8, "一般事項": 6, "目次": 6,
+    "計算ルート": 10, "ルート": 4, "許容応力度計算": 6, "保有水平耐力": 6, "限界耐力計算": 6,
+    "壁量計算": 5, "偏心率": 3, "層間変形角": 3,
+    "延べ面積": 6, "延床面積": 6, "床面積": 3, "階数": 6, "最高高さ": 3, "用途": 4,
+    "基礎": 4, "べた基礎": 6, "布基礎": 6, "杭": 4, "地盤": 4, "地耐力": 4, "地盤改良": 4,
+    "プログラム": 6, "ソフト": 4, "大臣認定": 5, "使用ソフト": 8,
+    "準耐火": 5, "耐火建築物": 5, "長期優良": 5, "適合性判定": 5,
+    "積雪": 3, "多雪": 3, "風圧": 2, "基準風速": 3, "地震地域係数": 3,
+}
+
+# 入力トークン予算（優先度順に構造計算書・証明書・審査表・図面を予算内で詰める）
+TOKEN_BUDGET_ENV = "PROMPT_TOKEN_BUDGET"
+TOKEN_COUNT_MODE_ENV = "TOKEN_COUNT_MODE"   # "estimate": ページ数から推定 / "api": count_tokensで計測
+DEFAULT_TOKEN_BUDGET = 300000   # 1リクエストあたりのPDF入力トークン上限
+PROMPT_RESERVED_TOKENS = 4000   # プロンプト・ファイル名ヒント用に確保するトークン
+PDF_TOKENS_PER_PAGE = 258       # GeminiがPDF1ページに割り当てるトークン数
+ESTIMATE_BYTES_PER_PAGE = 100 * 1024  # ページ数が読めない場合のファイルサイズからの推定
+MAX_CALC_CANDIDATES = 5         # 候補にする構造計算書の最大数
+MAX_DRAWING_CANDIDATES = 3      # 候補にする構造図の最大数
+FILE_KIND_LABELS = {
+    "calc": "構造計算書",
+    "cert": "安全証明書",
+    "review": "審査表",
+    "drawing": "構造図",
+}
+
+# 構造図の画像化設定（大屋根などの目視判定用。PDF全体の代わりに縮小したページ画像を送る）
+DRAWING_IMAGES_ENV = "DRAWING_IMAGES"       # "off" / "local"（pypdfium2で描画） / "thumbnail"（Graphのサムネイル）
+DRAWING_MAX_PAGES_ENV = "DRAWING_MAX_PAGES"
+DRAWING_DPI_ENV = "DRAWING_DPI"
+DEFAULT_DRAWING_MAX_PAGES = 4   # 1ファイルあたり画像化するページ数
+DEFAULT_DRAWING_DPI = 72        # 描画解像度
+DRAWING_MAX_SIDE = 768          # 長辺の最大ピクセル数（Geminiの1タイル = 258トークンに収める）
+DRAWING_JPEG_QUALITY = 70
+IMAGE_TILE_SIZE = 768           # Geminiが画像を分割するタイルの大きさ
+IMAGE_SMALL_SIZE = 384          # 両辺がこれ以下の画像は1タイル扱い
+
+# 分割解析（map-reduce）設定: ファイルごとに並列で抽出し、部分結果を決定的なルールで統合
+EXTRACTION_MODE_ENV = "EXTRACTION_MODE"     # "single" / "map-reduce" / "auto"
+MAP_REDUCE_WORKERS = 3          # ファイルごとの解析の同時実行数
+MAP_REDUCE_MIN_TOKENS = 150000  # autoモード: 構造計算書の合計がこれを超えたら分割解析
+ZONING_PATTERNS = ['南棟', '北棟', '左棟', '右棟', 'A棟', 'B棟', 'C棟']
+# 単一選択の項目で、部分結果が食い違う場合は後ろの選択肢（より厳しい条件）を採用
+SEVERITY_ORDERS = {
+    "structuralCalcRoute": ["ルート1（許容応力度計算）", "ルート2（許容応力度等計算）", "ルート3（保有水平耐力計算）"],
+    "floors": ["平屋", "2階建て", "3階建て", "4階建て以上"],
+    "totalFloorArea": ["〜100㎡", "101〜300㎡", "301〜1000㎡", "1001㎡〜"],
+    "foundationType": ["直接基礎（べた基礎、布基礎など）", "杭基礎"],
+    "groundCondition": ["良好", "軟弱"],
+}
+
+# テキストレイヤーからのルール抽出設定（計算ソフト・作成年月・計算ルートは正規表現で確定し、Geminiには残りを依頼）
+RULES_ONLY_ENV = "RULES_ONLY"
+RULE_TEXT_PAGES = 8             # ルール抽出で読む先頭ページ数（1ファイルあたり）
+RULE_DATE_PAGES = 2             # 作成年月を探す先頭ページ数（表紙）
+# 計算ソフトの製品名（表記揺れは大文字・NFKC正規化で吸収）
+SOFTWARE_PATTERN = re.compile(
+    r"(STRDESIGN|KIZUKURI|HOUSE-ST1|HOUSE-DOC|SS7|SS3|SS2|BUS-6|BUS-5|BUS-4|SEIN\s*La\s*CREA|ASCAL|MED-3|"
+    r"BUILD\.一貫\S*|Super\s*Build/\S+|WALL-1|KIZUKURI\s*LVL)"
+    r"(?:\s*(?:Ver\.?|Version|バージョン)\s*([0-9][0-9.\-]*[0-9]))?",
+    re.IGNORECASE
+)
+ROUTE_PATTERN = re.compile(r"ルート\s*([123])(?![0-9])")
+ROUTE_CHOICES = {
+    "1": "ルート1（許容応力度計算）",
+    "2": "ルート2（許容応力度等計算）",
+    "3": "ルート3（保有水平耐力計算）",
+}
+DATE_PATTERNS = [
+    (re.compile(r"(20[0-9]{2})\s*年\s*([0-9]{1,2})\s*月"), 0),
+    (re.compile(r"令和\s*([0-9]{1,2}|元)\s*年\s*([0-9]{1,2})\s*月"), 2018),
+    (re.compile(r"(20[0-9]{2})[/.]([0-9]{1,2})[/.][0-9]{1,2}"), 0),
+]
+DATE_CONTEXT_KEYWORDS = ("作成", "年月日", "日付", "発行")
+# ルール抽出する項目（フィールド名 → 解析結果のセクション）
+RULE_FIELDS = {
+    "software": "other",
+    "calcBookDate": "other",
+    "structuralCalcRoute": "legalTechnical",
+}
+
+# 重複PDFの解析共有（同じ実行内で入力PDFの組み合わせが同一の案件は1回だけ解析。空文字で無効）
+DEFAULT_ANALYSIS_DEDUP_PATH = os.environ.get("ANALYSIS_DEDUP_PATH", ".cache/analysis_dedup.sqlite3")
+ANALYSIS_DEDUP_WAIT_TIMEOUT = 15 * 60   # 他の案件の解析完了を待つ最大時間（秒）
+ANALYSIS_DEDUP_POLL_INTERVAL = 2.0      # 解析完了の確認間隔（秒）
+
+# パイプライン実行設定（--executor pipeline）
+DEFAULT_LIST_WORKERS = 4        # ファイル一覧取得ステージの同時実行数
+DEFAULT_DOWNLOAD_WORKERS = 4    # PDFダウンロードステージの同時実行数
+DEFAULT_PERSIST_WORKERS = 2     # Firestore保存ステージの同時実行数
+PIPELINE_QUEUE_SIZE = 8         # ステージ間キューの上限（ダウンロード済みで解析待ちのPDFが溜まりすぎないようにする）
+
+# PDFダウンロード設定（ストリーミングで一時ファイルに書き出し、メモリ使用量をチャンクサイズに抑える）
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024       # 1回の読み取りサイズ（1MiB）
+DOWNLOAD_SPOOL_MAX_SIZE = 1024 * 1024   # これを超えるとディスクに書き出す
+DOWNLOAD_CHUNK_TIMEOUT = 60.0           # チャンク1つの受信にかける最大時間（秒）
+# 事前認証済みダウンロードURL（@microsoft.graph.downloadUrl）の有効期限対策
+DOWNLOAD_URL_EXPIRED_STATUS_CODES = (401, 403)  # 有効期限切れと判断するステータス
+DOWNLOAD_URL_MAX_AGE = 15 * 60  # 一覧取得からこの秒数を過ぎたURLはダウンロード前にまとめて再取得
+# ダウンロード済みPDFのローカルキャッシュ（driveItem id + quickXorHash/cTag をキーにする。空文字で無効）
+# Cloud Run Jobsのファイルシステムはメモリ上にあり実行ごとに破棄されるため、デフォルトは無効（永続ボリュームを指定して有効化）
+DEFAULT_PDF_CACHE_DIR = os.environ.get("PDF_CACHE_DIR", "")
+DEFAULT_PDF_CACHE_MAX_BYTES = int(os.environ.get("PDF_CACHE_MAX_BYTES", str(1024 ** 3)))  # 1GiB
+# PDFのステージング先（gs://バケット名 または ローカル検証用の file:///ディレクトリ。空文字で無効=インライン送信）
+STAGING_BUCKET_ENV = "PDF_STAGING_BUCKET"
+STAGING_PREFIX = "pdf-staging/"
+STAGING_RETENTION_DAYS = 3  # ステージングしたPDFを自動削除するまでの日数（バッチ予測ジョブの実行中に消えないよう3日）
+STAGING_REUSE_MAX_DAYS = 1  # これより前にアップロードされたPDFは再利用せず上書きして作成日時を更新（自動削除までの残りを確保）
+
+# バッチ予測（--mode batch）設定: 案件ごとのリクエストをJSONLに書き出し、Vertex AIのバッチ予測ジョブで解析
+BATCH_PREFIX = "batch-prediction/"          # リクエスト・結果のJSONLを置くプレフィックス（ステージング先と同じバケット）
+BATCH_RETENTION_DAYS = 7
+BATCH_GEMINI_MODEL_NAME = "gemini-2.0-flash-001"  # バッチ予測は安定版モデルのみ対応
+BATCH_POLL_INTERVAL = 60        # ジョブの状態を確認する間隔（秒）
+BATCH_WAIT_MINUTES = 30         # ジョブの完了を待つ最大時間（分）。Cloud Runのタスクタイムアウト（3600秒）より短くする
+BATCH_MANIFEST_NAME = "manifest.json"  # 実行ごとのジョブ名・案件の対応・デルタカーソルを保存するファイル（再開・回収に使用）
+BATCH_KEY_LABEL = "project_key"  # リクエストのlabelsに入れる案件キー（結果と案件の対応付けに使用）
+
+# Graph APIトークン設定
+GRAPH_SCOPES = ["https://graph.microsoft.com/.default"]
+TOKEN_REFRESH_MARGIN = 300.0    # 有効期限の何秒前に更新するか
+# ワーカープロセス間で共有するトークンキャッシュ（同じコンテナ内のプロセスのみ）
+# mainが実行ごとの一時ディレクトリに作成して終了時に削除し、ワーカーは環境変数でパスを引き継ぐ（未設定ならプロセス内のみで保持）
+TOKEN_CACHE_ENV = "GRAPH_TOKEN_CACHE_PATH"
+DEFAULT_TOKEN_CACHE_PATH = os.environ.get(TOKEN_CACHE_ENV, "")
+
 # ---------------------------------------------------------
 
+# Secret Managerの取得結果（プロセス内キャッシュ）
+SECRET_CACHE = {}
+
 def get_secret(secret_id):
-    """Secret Managerからシークレットを取得"""
-    client = secretmanager.SecretManagerServiceClient()
-    name = f"projects/{GCP_PROJECT_ID}/secrets/{secret_id}/versions/latest"
-    response = client.access_secret_version(request={"name": name})
-    return response.payload.data.decode("UTF-8")
+    """Secret Managerからシークレットを取得（同じプロセス内では1回だけ取得）"""
+    if secret_id not in SECRET_CACHE:
+        client = secretmanager.SecretManagerServiceClient()
+        name = f"projects/{GCP_PROJECT_ID}/secrets/{secret_id}/versions/latest"
+        response = client.access_secret_version(request={"name": name})
+        SECRET_CACHE[secret_id] = response.payload.data.decode("UTF-8")
+    return SECRET_CACHE[secret_id]
+
+class GraphTokenProvider:
+    """
+    Microsoft Graph API用アクセストークンの取得・更新（プロセスごとに1つ）
+    - 有効期限のTOKEN_REFRESH_MARGIN秒前まではキャッシュしたトークンを返す
+    - 取得したトークンはcache_path（init_shared_token_cacheで作成する実行ごとの一時ファイル）に書き出し、
+      他のワーカープロセスはMSALを呼ばずに読み込む
+    - 長時間の並列処理でも、各タスクは実行時点で有効なトークンを使う
+    """
+
+    def __init__(self, cache_path=DEFAULT_TOKEN_CACHE_PATH):
+        self.cache_path = cache_path
+        self.access_token = None
+        self.expires_at = 0.0
+        self.app = None
+
+    def is_fresh(self, expires_at):
+        return time.time() < expires_at - TOKEN_REFRESH_MARGIN
+
+    def load_shared(self):
+        """他のプロセスが取得したトークンを読み込む"""
+        if not self.cache_path:
+            return False
+        try:
+            with open(self.cache_path, encoding="utf-8") as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if not cached.get('access_token') or not self.is_fresh(cached.get('expires_at', 0.0)):
+            return False
+        self.access_token = cached['access_token']
+        self.expires_at = cached['expires_at']
+        return True
+
+    def save_shared(self):
+        """取得したトークンを他のプロセス向けに書き出す（一時ファイル経由で置き換え）"""
+        if not self.cache_path:
+            return
+        try:
+            directory = os.path.dirname(self.cache_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            tmp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump({"access_token": self.access_token, "expires_at": self.expires_at}, f)
+            os.replace(tmp_path, self.cache_path)
+        except OSError as e:
+            print(f"⚠️ トークンキャッシュ書き込み失敗: {e}")
+
+    def acquire(self):
+        """MSALで新しいトークンを取得"""
+        if self.app is None:
+            client_id = get_secret("MS_CLIENT_ID")
+            tenant_id = get_secret("MS_TENANT_ID")
+            client_secret = get_secret("MS_CLIENT_SECRET")
+            authority = f"https://login.microsoftonline.com/{tenant_id}"
+            self.app = msal.ConfidentialClientApplication(client_id, authority=authority, client_credential=client_secret)
+
+        requested_at = time.time()
+        result = self.app.acquire_token_for_client(scopes=GRAPH_SCOPES)
+        if "access_token" not in result:
+            raise RuntimeError(result.get("error_description") or result.get("error") or "トークン取得失敗")
+        self.access_token = result["access_token"]
+        self.expires_at = requested_at + float(result.get("expires_in", 3600))
+        self.save_shared()
+
+    def get_token(self):
+        """有効なアクセストークンを返す（期限が近ければ更新）"""
+        if self.access_token and self.is_fresh(self.expires_at):
+            return self.access_token
+        if not self.load_shared():
+            self.acquire()
+        return self.access_token
+
+# プロセス内で共有するトークンプロバイダー
+TOKEN_PROVIDER = GraphTokenProvider()
+
+def init_shared_token_cache():
+    """
+    ワーカープロセスと共有するトークンキャッシュを実行ごとの一時ディレクトリ（権限700）に作成
+    パスは環境変数でワーカーに引き継ぎ、ディレクトリはこのプロセスの終了時に削除する
+    """
+    directory = tempfile.mkdtemp(prefix="graph-token-")
+    path = os.path.join(directory, "graph_token.json")
+    os.environ[TOKEN_CACHE_ENV] = path
+    TOKEN_PROVIDER.cache_path = path
+    owner_pid = os.getpid()
+
+    def cleanup():
+        # fork したワーカーには終了処理が引き継がれるため、作成したプロセスでのみ削除
+        if os.getpid() == owner_pid:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    atexit.register(cleanup)
+    return path
 
 def get_access_token():
     """Microsoft Graph API用のアクセストークンを取得"""
     try:
-        client_id = get_secret("MS_CLIENT_ID")
-        tenant_id = get_secret("MS_TENANT_ID")
-        client_secret = get_secret("MS_CLIENT_SECRET")
-
-        authority = f"https://login.microsoftonline.com/{tenant_id}"
-        app = msal.ConfidentialClientApplication(client_id, authority=authority, client_credential=client_secret)
-        result = app.acquire_token_for_client(scopes=["https://graph.microsoft.com/.default"])
-        return result.get("access_token")
+        return TOKEN_PROVIDER.get_token()
     except Exception as e:
         print(f"❌ 認証エラー: {e}")
         return None
 
+def graph_auth_headers(access_token=None):
+    """
+    Graph API用のAuthorizationヘッダーを作成
+    access_tokenがNoneの場合は、呼び出し時点でTOKEN_PROVIDERから有効なトークンを取得する（期限が近ければ更新）
+    """
+    return {"Authorization": f"Bearer {access_token or TOKEN_PROVIDER.get_token()}"}
+
+def get_retry_after(headers, attempt):
+    """Retry-Afterヘッダー（秒）があれば優先し、なければ指数バックオフで待機時間を決める"""
+    value = (headers or {}).get('Retry-After') or (headers or {}).get('retry-after')
+    try:
+        return min(max(float(value), 0.0), MAX_RETRY_DELAY)
+    except (TypeError, ValueError):
+        return exponential_backoff_with_jitter(attempt)
+
+class GraphClient:
+    """
+    Graph API・ダウンロードURL共通のHTTPクライアント（プロセスごとに1つ）
+    - 429/503はRetry-Afterに従って待機してリトライ（タイムアウト・接続エラーも指数バックオフでリトライ）
+    - スロットリング発生時はリクエスト間隔をAIMD（乗算増加・加算減少）で調整
+    - スロットリング・リトライ回数を集計
+    - requests.Sessionの接続プールを使い回し、リクエストごとのTLSハンドシェイクを省く
+    - パイプラインの一覧取得・ダウンロードのスレッドから同時に使うため、間隔・集計の更新はlockで保護する
+    """
+
+    def __init__(self):
+        self.throttled_count = 0
+        self.retry_count = 0
+        self.min_interval = 0.0
+        self.last_request_at = 0.0
+        self.session = None
+        self.session_pid = None
+        self.lock = threading.Lock()
+
+    def get_session(self):
+        """プロセスごとのSessionを返す（fork後の子プロセスでは親の接続を共有せず作り直す）"""
+        with self.lock:
+            if self.session is None or self.session_pid != os.getpid():
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=GRAPH_POOL_CONNECTIONS,
+                                                        pool_maxsize=GRAPH_POOL_MAXSIZE)
+                session.mount("https://", adapter)
+                self.session = session
+                self.session_pid = os.getpid()
+            return self.session
+
+    def record(self, retries=0, throttled=0):
+        """リトライ・スロットリング回数を集計（非同期のクロールからも呼ばれる）"""
+        with self.lock:
+            self.retry_count += retries
+            self.throttled_count += throttled
+
+    def on_throttle(self, count=1):
+        with self.lock:
+            self.throttled_count += count
+            self.min_interval = min(max(self.min_interval * 2, 0.5), GRAPH_MAX_INTERVAL)
+
+    def on_success(self):
+        with self.lock:
+            self.min_interval = max(self.min_interval - GRAPH_MIN_INTERVAL_STEP, 0.0)
+
+    def wait_for_slot(self):
+        """前のリクエストからmin_interval以上空けて送信する（送信時刻をlock内で予約し、待機はlockの外で行う）"""
+        with self.lock:
+            slot = max(time.time(), self.last_request_at + self.min_interval)
+            self.last_request_at = slot
+        wait = slot - time.time()
+        if wait > 0:
+            time.sleep(wait)
+
+    def request(self, method, url, max_attempts=MAX_RETRIES, **kwargs):
+        """リトライ付きでリクエストを送信（最終試行のレスポンスはステータスに関わらず返す）"""
+        timeout = kwargs.get('timeout')
+        if isinstance(timeout, (int, float)):
+            kwargs['timeout'] = (GRAPH_CONNECT_TIMEOUT, timeout)
+
+        for attempt in range(max_attempts):
+            self.wait_for_slot()
+
+            try:
+                response = self.get_session().request(method, url, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                if attempt == max_attempts - 1:
+                    raise
+                self.record(retries=1)
+                time.sleep(exponential_backoff_with_jitter(attempt))
+                continue
+
+            if response.status_code in GRAPH_THROTTLE_STATUS_CODES and attempt < max_attempts - 1:
+                self.on_throttle()
+                self.record(retries=1)
+                delay = get_retry_after(response.headers, attempt)
+                print(f"   🚦 スロットリング ({response.status_code}): {delay:.1f}秒後にリトライ")
+                response.close()
+                time.sleep(delay)
+                continue
+
+            self.on_success()
+            return response
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+# プロセス内で共有するGraphクライアント
+GRAPH_CLIENT = GraphClient()
+
+class DownloadUrlExpiredError(Exception):
+    """事前認証済みダウンロードURLの有効期限切れ"""
+
+def stream_download(url, headers=None, chunk_timeout=DOWNLOAD_CHUNK_TIMEOUT):
+    """
+    ファイルをチャンク単位で受信して一時ファイル（SpooledTemporaryFile）に書き出す
+    チャンク1つの受信がchunk_timeout秒を超えた場合は中断する
+    事前認証済みURL（headersなし）が401/403を返した場合はDownloadUrlExpiredErrorを送出する
+    Returns: 先頭にシーク済みの一時ファイル（200以外はNone）。使用後はclose()すること
+    """
+    response = GRAPH_CLIENT.get(url, headers=headers, stream=True, timeout=chunk_timeout)
+    with response:
+        if headers is None and response.status_code in DOWNLOAD_URL_EXPIRED_STATUS_CODES:
+            raise DownloadUrlExpiredError(f"ダウンロードURLの有効期限切れ ({response.status_code})")
+        if response.status_code != 200:
+            return None
+
+        spooled = tempfile.SpooledTemporaryFile(max_size=DOWNLOAD_SPOOL_MAX_SIZE)
+        try:
+            chunks = response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE)
+            while True:
+                chunk_started = time.monotonic()
+                chunk = next(chunks, None)
+                if chunk is None:
+                    break
+                if time.monotonic() - chunk_started > chunk_timeout:
+                    raise requests.exceptions.Timeout(f"チャンク受信が{chunk_timeout}秒を超えました: {url[:80]}")
+                spooled.write(chunk)
+        except Exception:
+            spooled.close()
+            raise
+
+    spooled.seek(0)
+    return spooled
+
+def read_pdf_data(data):
+    """バイト列またはファイルオブジェクトからPDFのバイト列を取得"""
+    if isinstance(data, (bytes, bytearray)):
+        return data
+    data.seek(0)
+    return data.read()
+
+def read_file_data(file_info):
+    """file_data_listの要素からバイト列を取得（一時ファイルの場合はここで初めて読み込む）"""
+    if "file" in file_info:
+        return read_pdf_data(file_info["file"])
+    return file_info["data"]
+
+class PdfCache:
+    """
+    ダウンロード済みPDFのローカルキャッシュ（プロセス間で同じディレクトリを共有）
+    - キーはdriveItem idとファイルのバージョン（quickXorHash、なければcTag）から作成するため、
+      ファイルが更新されると自動的に別キーになる
+    - 登録済みファイルのサイズ・最終アクセス日時と合計サイズは cache_dir/index.sqlite3 で管理し、
+      合計がmax_bytesを超えたら最終アクセスが古いものから削除（LRU。ディレクトリは走査しない）
+    """
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_PDF_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hit_count = 0
+        self.miss_count = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self.db_path = os.path.join(cache_dir, "index.sqlite3")
+        with self.connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, size INTEGER NOT NULL, accessed_at REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS entries_accessed_at ON entries (accessed_at)")
+            conn.execute("CREATE TABLE IF NOT EXISTS totals (id INTEGER PRIMARY KEY CHECK (id = 0), bytes INTEGER NOT NULL)")
+            conn.execute("INSERT OR IGNORE INTO totals (id, bytes) VALUES (0, 0)")
+
+    def connect(self):
+        # ワーカープロセス・スレッドから同時に使えるよう、操作ごとに接続する
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    @staticmethod
+    def cache_key(item):
+        """キャッシュキーを作成（バージョンを特定できないアイテムはNone）"""
+        version = item.get('file', {}).get('hashes', {}).get('quickXorHash') or item.get('cTag')
+        if not item.get('id') or not version:
+            return None
+        return hashlib.sha256(f"{item['id']}:{version}".encode("utf-8")).hexdigest()
+
+    def path_for(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.pdf")
+
+    def open(self, item):
+        """キャッシュ済みならファイルを開いて返す（最終アクセス日時を更新）"""
+        key = self.cache_key(item)
+        if key is None:
+            return None
+        try:
+            cached = open(self.path_for(key), "rb")
+        except OSError:
+            self.miss_count += 1
+            return None
+        try:
+            with self.connect() as conn:
+                conn.execute("UPDATE entries SET accessed_at = ? WHERE key = ?", (time.time(), key))
+        except sqlite3.Error:
+            pass  # 最終アクセス日時の更新に失敗しても、開いたファイルはそのまま読める
+        self.hit_count += 1
+        return cached
+
+    def put(self, item, source):
+        """ダウンロードしたファイルを登録し、キャッシュ上のファイルを開いて返す（登録できなければNone）"""
+        key = self.cache_key(item)
+        if key is None:
+            return None
+        path = self.path_for(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            source.seek(0)
+            with open(tmp_path, "wb") as f:
+                shutil.copyfileobj(source, f, DOWNLOAD_CHUNK_SIZE)
+            size = os.path.getsize(tmp_path)
+            if size > self.max_bytes:
+                os.remove(tmp_path)
+                return None
+            os.replace(tmp_path, path)
+            self.register(key, size)
+            return open(path, "rb")
+        except (OSError, sqlite3.Error) as e:
+            print(f"⚠️ PDFキャッシュ書き込み失敗: {e}")
+            return None
+
+    def register(self, key, size):
+        """登録したファイルのサイズを合計に加え、max_bytesを超えた分を最終アクセスが古いものから削除"""
+        conn = self.connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            previous = conn.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+            conn.execute("INSERT OR REPLACE INTO entries (key, size, accessed_at) VALUES (?, ?, ?)", (key, size, time.time()))
+            conn.execute("UPDATE totals SET bytes = bytes + ? WHERE id = 0", (size - (previous[0] if previous else 0),))
+            total = conn.execute("SELECT bytes FROM totals WHERE id = 0").fetchone()[0]
+            if total > self.max_bytes:
+                evicted = []
+                for old_key, old_size in conn.execute(
+                        "SELECT key, size FROM entries WHERE key != ? ORDER BY accessed_at", (key,)):
+                    if total <= self.max_bytes:
+                        break
+                    evicted.append(old_key)
+                    total -= old_size
+                conn.executemany("DELETE FROM entries WHERE key = ?", [(old_key,) for old_key in evicted])
+                conn.execute("UPDATE totals SET bytes = ? WHERE id = 0", (total,))
+                for old_key in evicted:
+                    try:
+                        os.remove(self.path_for(old_key))
+                    except OSError:
+                        pass
+            conn.commit()
+        finally:
+            conn.close()
+
+# プロセス内で共有するPDFキャッシュ（PDF_CACHE_DIRが空なら無効。デフォルトは無効）
+PDF_CACHE = PdfCache(DEFAULT_PDF_CACHE_DIR) if DEFAULT_PDF_CACHE_DIR else None
+
+def refresh_download_urls(items, headers, user_email=TARGET_USER_EMAIL):
+    """複数アイテムのダウンロードURLを$batchでまとめて再取得し、itemsを更新する"""
+    urls = [f"/users/{user_email}/drive/items/{item['id']}?$select=id,@microsoft.graph.downloadUrl" for item in items]
+    refreshed = 0
+    for item, sub in zip(items, graph_batch_get(urls, headers)):
+        download_url = sub.get('body', {}).get('@microsoft.graph.downloadUrl') if sub.get('status') == 200 else None
+        if download_url:
+            item['@microsoft.graph.downloadUrl'] = download_url
+            refreshed += 1
+    return refreshed
+
+def fetch_pdf(item, headers=None, user_email=TARGET_USER_EMAIL):
+    """
+    PDFを取得（キャッシュにあればダウンロードしない）
+    downloadUrlがない、または有効期限切れの場合は /items/{id}/content から取得する
+    （Graphが新しいダウンロードURLにリダイレクトする。headersがなければTOKEN_PROVIDERのトークンを使用）
+    Returns: 先頭にシーク済みのファイルオブジェクト（取得できなければNone）。使用後はclose()すること
+    """
+    if PDF_CACHE is not None:
+        cached = PDF_CACHE.open(item)
+        if cached is not None:
+            return cached
+
+    download_url = item.get('@microsoft.graph.downloadUrl')
+    downloaded = None
+    if download_url:
+        try:
+            downloaded = stream_download(download_url)
+        except DownloadUrlExpiredError:
+            print(f"   🔄 ダウンロードURLの有効期限切れ: {item.get('name', item['id'])}（再取得します）")
+            item.pop('@microsoft.graph.downloadUrl', None)
+            download_url = None
+    if not download_url:
+        if headers is None:
+            headers = {"Authorization": f"Bearer {TOKEN_PROVIDER.get_token()}"}
+        downloaded = stream_download(f"{GRAPH_API_BASE}/users/{user_email}/drive/items/{item['id']}/content",
+                                     headers=headers)
+    if downloaded is None or PDF_CACHE is None:
+        return downloaded
+
+    cached = PDF_CACHE.put(item, downloaded)
+    if cached is None:
+        downloaded.seek(0)
+        return downloaded
+    downloaded.close()
+    return cached
+
+def close_file_data(file_data_list):
+    """file_data_listの一時ファイルを閉じる（ディスクに書き出したファイルも削除される）"""
+    for file_info in file_data_list:
+        if "file" in file_info:
+            file_info["file"].close()
+
+def hash_file(data_file):
+    """ファイルの内容のSHA-256（チャンク単位で読み込む）"""
+    digest = hashlib.sha256()
+    data_file.seek(0)
+    for chunk in iter(lambda: data_file.read(DOWNLOAD_CHUNK_SIZE), b""):
+        digest.update(chunk)
+    data_file.seek(0)
+    return digest.hexdigest()
+
+class GcsPdfStager:
+    """
+    PDFをCloud Storageにアップロードし、GeminiにはURIで渡す（インライン送信の代わり）
+    オブジェクト名は内容のハッシュのため、同じPDFは一度だけアップロードされる
+    """
+
+    def __init__(self, bucket_name, prefix=STAGING_PREFIX):
+        self.bucket = storage.Client(project=GCP_PROJECT_ID).bucket(bucket_name)
+        self.prefix = prefix
+        self.uploaded_count = 0
+        self.reused_count = 0
+
+    def stage(self, data_file):
+        """PDFをステージングしてURIを返す（作成からSTAGING_REUSE_MAX_DAYSを過ぎたオブジェクトは上書きして自動削除を先に延ばす）"""
+        name = f"{self.prefix}{hash_file(data_file)}.pdf"
+        blob = self.bucket.get_blob(name)
+        reuse_after = datetime.now(timezone.utc) - timedelta(days=STAGING_REUSE_MAX_DAYS)
+        if blob is not None and blob.time_created and blob.time_created > reuse_after:
+            self.reused_count += 1
+        else:
+            self.bucket.blob(name).upload_from_file(data_file, rewind=True, content_type="application/pdf")
+            self.uploaded_count += 1
+        return f"gs://{self.bucket.name}/{name}"
+
+    def uri_for(self, name):
+        """プレフィックス配下のオブジェクトのURI"""
+        return f"gs://{self.bucket.name}/{self.prefix}{name}"
+
+    def put_jsonl(self, name, records):
+        """レコードをJSONLとしてアップロードしてURIを返す"""
+        blob = self.bucket.blob(f"{self.prefix}{name}")
+        blob.upload_from_string("".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records),
+                                content_type="application/jsonl")
+        return self.uri_for(name)
+
+    def iter_jsonl(self, uri_prefix):
+        """URI配下の *.jsonl を1レコードずつ読み込む"""
+        bucket_name, _, prefix = uri_prefix[len("gs://"):].partition("/")
+        for blob in self.bucket.client.list_blobs(bucket_name, prefix=prefix):
+            if blob.name.endswith(".jsonl"):
+                for line in blob.download_as_text().splitlines():
+                    if line.strip():
+                        yield json.loads(line)
+
+    def put_json(self, name, data):
+        """JSONをアップロードしてURIを返す（同じ名前は上書き）"""
+        self.bucket.blob(f"{self.prefix}{name}").upload_from_string(
+            json.dumps(data, ensure_ascii=False), content_type="application/json")
+        return self.uri_for(name)
+
+    def get_json(self, name):
+        """put_jsonで保存したJSONを読み込む（なければNone）"""
+        blob = self.bucket.get_blob(f"{self.prefix}{name}")
+        return json.loads(blob.download_as_text()) if blob is not None else None
+
+    def ensure_lifecycle(self, days=STAGING_RETENTION_DAYS):
+        """
+        プレフィックスに自動削除ルールを設定
+        既存のルールの日数がdaysより短い場合は（以前の設定で作成されたルールでも）daysに置き換える
+        """
+        self.bucket.reload()
+        rules = []
+        for rule in self.bucket.lifecycle_rules:
+            rule = dict(rule)
+            condition = dict(rule.get('condition', {}))
+            prefixes = condition.get('matchesPrefix', [])
+            if rule.get('action', {}).get('type') == 'Delete' and self.prefix in prefixes:
+                if condition.get('age', 0) >= days:
+                    return
+                # 他のプレフィックスと共有しているルールからは、このプレフィックスだけを外す
+                others = [prefix for prefix in prefixes if prefix != self.prefix]
+                if not others:
+                    continue
+                rule['condition'] = dict(condition, matchesPrefix=others)
+            rules.append(rule)
+        self.bucket.lifecycle_rules = rules
+        self.bucket.add_lifecycle_delete_rule(age=days, matches_prefix=[self.prefix])
+        self.bucket.patch()
+
+class LocalPdfStager:
+    """
+    GcsPdfStagerのローカル版（ディレクトリをバケットの代わりに使う。ローカル検証用）
+    返すURIは file:// 形式のため、実際のGemini APIには渡せない
+    """
+
+    def __init__(self, root_dir, prefix=STAGING_PREFIX):
+        self.directory = os.path.join(root_dir, prefix)
+        self.uploaded_count = 0
+        self.reused_count = 0
+
+    def stage(self, data_file):
+        """PDFをステージングしてURIを返す"""
+        path = os.path.abspath(os.path.join(self.directory, f"{hash_file(data_file)}.pdf"))
+        if os.path.exists(path):
+            self.reused_count += 1
+        else:
+            os.makedirs(self.directory, exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                shutil.copyfileobj(data_file, f, DOWNLOAD_CHUNK_SIZE)
+            os.replace(tmp_path, path)
+            data_file.seek(0)
+            self.uploaded_count += 1
+        return f"file://{path}"
+
+    def uri_for(self, name):
+        """プレフィックス配下のファイルのURI"""
+        return f"file://{os.path.abspath(os.path.join(self.directory, name))}"
+
+    def put_jsonl(self, name, records):
+        """レコードをJSONLとして書き出してURIを返す"""
+        path = os.path.join(self.directory, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        return self.uri_for(name)
+
+    def iter_jsonl(self, uri_prefix):
+        """URI配下の *.jsonl を1レコードずつ読み込む"""
+        for dir_path, _, file_names in os.walk(uri_prefix[len("file://"):]):
+            for file_name in sorted(file_names):
+                if file_name.endswith(".jsonl"):
+                    with open(os.path.join(dir_path, file_name), encoding="utf-8") as f:
+                        for line in f:
+                            if line.strip():
+                                yield json.loads(line)
+
+    def put_json(self, name, data):
+        """JSONを書き出してURIを返す（同じ名前は上書き）"""
+        path = os.path.join(self.directory, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+        return self.uri_for(name)
+
+    def get_json(self, name):
+        """put_jsonで保存したJSONを読み込む（なければNone）"""
+        try:
+            with open(os.path.join(self.directory, name), encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def ensure_lifecycle(self, days=STAGING_RETENTION_DAYS):
+        """保持期間を過ぎたファイルを削除（バケットのライフサイクルルールの代わり）"""
+        if not os.path.isdir(self.directory):
+            return
+        expires_before = time.time() - days * 86400
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if os.path.getmtime(path) < expires_before:
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+
+def create_pdf_stager(location, prefix=STAGING_PREFIX):
+    """ステージング先の指定（gs://bucket または file:///dir）からステージャーを作成"""
+    if location.startswith("gs://"):
+        return GcsPdfStager(location[len("gs://"):].strip('/'), prefix)
+    if location.startswith("file://"):
+        return LocalPdfStager(location[len("file://"):], prefix)
+    raise ValueError(f"ステージング先は gs:// または file:// で指定してください: {location}")
+
+# プロセスごとのステージャー（環境変数PDF_STAGING_BUCKETから初回使用時に作成）
+PDF_STAGER = None
+
+def get_pdf_stager():
+    """ステージングが有効ならステージャーを返す（無効ならNone）"""
+    global PDF_STAGER
+    location = os.environ.get(STAGING_BUCKET_ENV, "")
+    if not location:
+        return None
+    if PDF_STAGER is None:
+        PDF_STAGER = create_pdf_stager(location)
+    return PDF_STAGER
+
+def stage_file_data(file_data_list):
+    """
+    ステージングが有効なら、file_data_listのPDFをアップロードしてURIに置き換える
+    一時ファイルはアップロード後すぐに閉じるため、Gemini呼び出し中はPDFをメモリに保持しない
+    """
+    stager = get_pdf_stager()
+    if stager is None:
+        return
+    for file_info in file_data_list:
+        # 画像（縮小済みの構造図）は小さいためインラインで送る
+        if file_info["mime_type"] != "application/pdf":
+            continue
+        if "file" in file_info:
+            file_info["uri"] = stager.stage(file_info["file"])
+            file_info.pop("file").close()
+        elif "data" in file_info:
+            file_info["uri"] = stager.stage(io.BytesIO(file_info.pop("data")))
+
+def get_page_budget():
+    """1ファイルあたりの最大ページ数（環境変数PDF_PAGE_BUDGETで変更、0で無効）"""
+    return int(os.environ.get(PAGE_BUDGET_ENV, str(DEFAULT_PAGE_BUDGET)))
+
+def score_page_text(text):
+    """ページのテキストをキーワードで採点（同じキーワードは3回まで数える）"""
+    return sum(weight * min(text.count(keyword), 3) for keyword, weight in PAGE_KEYWORDS.items())
+
+def select_relevant_pages(page_texts, budget):
+    """採点結果から送信するページ番号を選ぶ（先頭ページは必ず含め、元の順序で返す）"""
+    keep = set(range(min(PAGE_ALWAYS_KEEP, len(page_texts))))
+    ranked = sorted(
+        (index for index, text in enumerate(page_texts) if index not in keep),
+        key=lambda index: (-score_page_text(page_texts[index]), index)
+    )
+    for index in ranked:
+        if len(keep) >= budget or score_page_text(page_texts[index]) == 0:
+            break
+        keep.add(index)
+    return sorted(keep)
+
+def prune_pdf_pages(data_file, budget):
+    """
+    PDFのテキストレイヤーから関連ページを選び、budgetページ以内の抜粋PDFを作成
+    Returns: (抜粋PDFの一時ファイル, 選択したページ数, 総ページ数)。抽出しない場合は (None, 総ページ数, 総ページ数)
+    """
+    data_file.seek(0)
+    reader = PdfReader(data_file)
+    total = len(reader.pages)
+    if total <= budget:
+        return None, total, total
+
+    page_texts = [(page.extract_text() or "") for page in reader.pages]
+    if sum(1 for text in page_texts if text.strip()) < total * PAGE_MIN_TEXT_RATIO:
+        return None, total, total
+
+    selected = select_relevant_pages(page_texts, budget)
+    writer = PdfWriter()
+    for index in selected:
+        writer.add_page(reader.pages[index])
+
+    pruned = tempfile.SpooledTemporaryFile(max_size=DOWNLOAD_SPOOL_MAX_SIZE)
+    writer.write(pruned)
+    pruned.seek(0)
+    return pruned, len(selected), total
+
+def prune_file_data(file_data_list):
+    """
+    file_data_listのPDFを関連ページの抜粋に置き換える（pypdfがない・無効の場合は何もしない）
+    抜粋した場合は "page_note" に選択ページ数を記録する
+    """
+    budget = get_page_budget()
+    if PdfReader is None or budget <= 0:
+        return
+    for file_info in file_data_list:
+        if "file" not in file_info:
+            continue
+        try:
+            pruned, kept, total = prune_pdf_pages(file_info["file"], budget)
+        except Exception as e:
+            print(f"   ⚠️ ページ抽出をスキップ（{file_info['name']}）: {str(e)[:80]}")
+            continue
+        if pruned is not None:
+            file_info.pop("file").close()
+            file_info["file"] = pruned
+            file_info["page_note"] = f"関連ページ抜粋 {kept}/{total}ページ"
+
+def is_rules_only():
+    """ルール抽出のみで再実行するか（環境変数RULES_ONLY、Geminiを呼ばずに既存ドキュメントを更新）"""
+    return os.environ.get(RULES_ONLY_ENV, "") == "1"
+
+def read_text_pages(data_file, max_pages):
+    """PDFの先頭max_pagesページのテキストをNFKC正規化して返す（全角数字・英字を半角に揃える）"""
+    data_file.seek(0)
+    reader = PdfReader(data_file)
+    texts = []
+    for page in reader.pages[:max_pages]:
+        texts.append(unicodedata.normalize("NFKC", page.extract_text() or ""))
+    data_file.seek(0)
+    return texts
+
+def match_software(text):
+    """計算ソフトを抽出（製品が1つに決まる場合のみ。最も多く出現した表記を返す）"""
+    counts = {}
+    products = set()
+    for match in SOFTWARE_PATTERN.finditer(text):
+        products.add(re.sub(r"\s+", " ", match.group(1)).upper())
+        label = re.sub(r"\s+", " ", match.group(0)).strip()
+        if match.group(2):
+            label = f"{match.group(1)} Ver.{match.group(2)}"
+        counts[label] = counts.get(label, 0) + 1
+    if len(products) != 1:
+        return None
+    # バージョン付きの表記を優先
+    return max(counts, key=lambda label: (counts[label] + (100 if "Ver." in label else 0), len(label)))
+
+def match_route(text):
+    """計算ルートを抽出（本文中のルート番号が1種類の場合のみ）"""
+    routes = set(ROUTE_PATTERN.findall(text))
+    if len(routes) != 1:
+        return None
+    return ROUTE_CHOICES[routes.pop()]
+
+def match_calc_book_date(cover_texts):
+    """表紙から作成年月を抽出（「作成」などの行を優先し、年月が1つに決まる場合のみ）"""
+    found = []
+    for text in cover_texts:
+        for line in text.splitlines():
+            for pattern, era_offset in DATE_PATTERNS:
+                for year, month in pattern.findall(line):
+                    year = (1 if year == "元" else int(year)) + era_offset
+                    month = int(month)
+                    if 1 <= month <= 12:
+                        found.append((f"{year}年{month}月", any(k in line for k in DATE_CONTEXT_KEYWORDS)))
+    for candidates in ({d for d, ctx in found if ctx}, {d for d, _ in found}):
+        if len(candidates) == 1:
+            return candidates.pop()
+        if candidates:
+            return None
+    return None
+
+def extract_rule_fields(file_data_list):
+    """
+    構造計算書のテキストレイヤーから正規表現で確定できる項目を抽出
+    Returns: {フィールド名: 値}（曖昧・見つからない項目は含めない。pypdfがない場合は空）
+    """
+    if PdfReader is None:
+        return {}
+    texts = []
+    cover_texts = []
+    for file_info in file_data_list:
+        if "file" not in file_info or file_info.get("kind", "calc") != "calc":
+            continue
+        try:
+            pages = read_text_pages(file_info["file"], RULE_TEXT_PAGES)
+        except Exception as e:
+            print(f"   ⚠️ テキスト抽出をスキップ（{file_info['name']}）: {str(e)[:80]}")
+            continue
+        texts.extend(pages)
+        if not cover_texts:
+            cover_texts = pages[:RULE_DATE_PAGES]
+
+    text = "\n".join(texts)
+    fields = {
+        "software": match_software(text),
+        "calcBookDate": match_calc_book_date(cover_texts),
+        "structuralCalcRoute": match_route(text),
+    }
+    return {name: value for name, value in fields.items() if value}
+
+def apply_rule_fields(analysis_result, rule_fields):
+    """
+    ルール抽出の値を解析結果に反映し、各項目の抽出元（"rule" / "model"）を fieldSources に記録
+    """
+    field_sources = {}
+    for section, values in analysis_result.items():
+        if isinstance(values, dict) and section != "fieldSources":
+            for name in values:
+                field_sources[name] = "model"
+    for name, value in rule_fields.items():
+        analysis_result.setdefault(RULE_FIELDS[name], {})[name] = value
+        field_sources[name] = "rule"
+    analysis_result["fieldSources"] = field_sources
+    return analysis_result
+
+def get_token_budget():
+    """1リクエストあたりのPDF入力トークン上限（環境変数PROMPT_TOKEN_BUDGETで変更）"""
+    return int(os.environ.get(TOKEN_BUDGET_ENV, str(DEFAULT_TOKEN_BUDGET)))
+
+def estimate_file_tokens(file_info):
+    """
+    PDFの入力トークン数をページ数から推定（ページ数 × PDF_TOKENS_PER_PAGE）
+    Returns: (トークン数, ページ数)。ページ数が読めない場合はファイルサイズから推定
+    """
+    if file_info["mime_type"].startswith("image/"):
+        return image_tokens(*file_info["image_size"]), 1
+
+    data_file = file_info["file"]
+    pages = None
+    if PdfReader is not None:
+        try:
+            data_file.seek(0)
+            pages = len(PdfReader(data_file).pages)
+        except Exception:
+            pages = None
+        finally:
+            data_file.seek(0)
+    if pages is None:
+        data_file.seek(0, os.SEEK_END)
+        pages = max(1, -(-data_file.tell() // ESTIMATE_BYTES_PER_PAGE))
+        data_file.seek(0)
+    return pages * PDF_TOKENS_PER_PAGE, pages
+
+def count_file_tokens(file_info, model=None):
+    """
+    PDFの入力トークン数を計測（TOKEN_COUNT_MODE=api なら count_tokens、それ以外はローカル推定）
+    Returns: (トークン数, ページ数 または None)
+    """
+    if os.environ.get(TOKEN_COUNT_MODE_ENV, "estimate") == "api" and model is not None:
+        try:
+            return model.count_tokens([build_file_part(file_info)]).total_tokens, None
+        except Exception as e:
+            print(f"   ⚠️ count_tokens失敗のため推定値を使用（{file_info['name']}）: {str(e)[:80]}")
+    return estimate_file_tokens(file_info)
+
+def pack_file_data(file_data_list, budget=None):
+    """
+    file_data_list（優先度順）をトークン予算内に詰める。予算を超えるファイルは閉じて除外する
+    先頭（最優先の構造計算書）は予算を超えても必ず含める
+    Returns: 送信するfile_data_list
+    """
+    budget = get_token_budget() if budget is None else budget
+    available = budget - PROMPT_RESERVED_TOKENS
+    model = None
+    if os.environ.get(TOKEN_COUNT_MODE_ENV, "estimate") == "api":
+        model = get_gemini_model()
+
+    packed = []
+    used = 0
+    for file_info in file_data_list:
+        tokens, pages = count_file_tokens(file_info, model)
+        label = FILE_KIND_LABELS.get(file_info.get("kind", "calc"), "PDF")
+        detail = f"{tokens:,} tokens" + (f"（{pages}ページ）" if pages else "")
+        if not packed or used + tokens <= available:
+            used += tokens
+            file_info["tokens"] = tokens
+            packed.append(file_info)
+            note = "（予算超過ですが最優先のため送信）" if used > available else ""
+            print(f"   📦 入力: [{label}] {file_info['name']} {detail}{note}")
+        else:
+            if "file" in file_info:
+                file_info.pop("file").close()
+            print(f"   ⏭️ 予算超過のため除外: [{label}] {file_info['name']} {detail}")
+    print(f"   📦 入力トークン合計: {used:,} / {available:,} tokens（{len(packed)}/{len(file_data_list)}ファイル）")
+    return packed
+
+def rank_calc_files(calc_files):
+    """構造計算書を優先度順に並べる（「構造計算書」を含む最大のファイルを本編とみなして先頭に）"""
+    if not calc_files:
+        return []
+    best = max(calc_files, key=lambda item: ("構造計算書" in item.get("name", ""), item.get("size", 0)))
+    return [best] + [item for item in calc_files if item is not best]
+
+def build_input_candidates(calc_files, drawing_files, cert_file, review_file):
+    """
+    Geminiに送る候補ファイルを優先度順に並べる
+    本編の構造計算書 → 安全証明書 → 審査表 → 残りの構造計算書 → 構造図
+    Returns: [(種別, アイテム), ...]
+    """
+    ranked_calc = rank_calc_files(calc_files)[:MAX_CALC_CANDIDATES]
+    candidates = [("calc", ranked_calc[0])] if ranked_calc else []
+    if cert_file:
+        candidates.append(("cert", cert_file))
+    if review_file:
+        candidates.append(("review", review_file))
+    candidates += [("calc", item) for item in ranked_calc[1:]]
+    candidates += [("drawing", item) for item in drawing_files[:MAX_DRAWING_CANDIDATES]]
+    return candidates
+
+def file_names(file_data_list):
+    """送信するファイルの名前（構造図のページ画像など、同じファイルの要素は1回だけ。順序は維持）"""
+    return list(dict.fromkeys(file_info['name'] for file_info in file_data_list))
+
+def file_label(file_info):
+    """プロンプト内のファイル名表記（種別・ページ抜粋の注記付き）"""
+    notes = []
+    kind = file_info.get("kind", "calc")
+    if kind != "calc":
+        notes.append(FILE_KIND_LABELS.get(kind, kind))
+    if file_info.get("page_note"):
+        notes.append(file_info["page_note"])
+    if notes:
+        return f"[ファイル名: {file_info['name']}（{'、'.join(notes)}）]"
+    return f"[ファイル名: {file_info['name']}]"
+
+def get_drawing_image_mode():
+    """構造図の画像化モード（環境変数DRAWING_IMAGES: off / local / thumbnail）"""
+    return os.environ.get(DRAWING_IMAGES_ENV, "off")
+
+def image_tokens(width, height):
+    """画像の入力トークン数（小さい画像は1タイル、それ以外は768pxタイルの数 × 258）"""
+    if width <= IMAGE_SMALL_SIZE and height <= IMAGE_SMALL_SIZE:
+        return PDF_TOKENS_PER_PAGE
+    return -(-width // IMAGE_TILE_SIZE) * -(-height // IMAGE_TILE_SIZE) * PDF_TOKENS_PER_PAGE
+
+def encode_drawing_image(image):
+    """PIL画像を長辺DRAWING_MAX_SIDE以内に縮小してJPEGに変換。Returns: (JPEGのバイト列, (幅, 高さ))"""
+    image = image.convert("RGB")
+    image.thumbnail((DRAWING_MAX_SIDE, DRAWING_MAX_SIDE))
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=DRAWING_JPEG_QUALITY, optimize=True)
+    return buffer.getvalue(), image.size
+
+def render_drawing_pages(data_file, max_pages, dpi):
+    """
+    PDFの先頭max_pagesページをpypdfium2で描画して縮小JPEGに変換
+    Returns: ([(JPEGのバイト列, (幅, 高さ)), ...], 総ページ数)
+    """
+    pdf = pdfium.PdfDocument(read_pdf_data(data_file))
+    try:
+        total = len(pdf)
+        images = []
+        for index in range(min(max_pages, total)):
+            page = pdf[index]
+            try:
+                images.append(encode_drawing_image(page.render(scale=dpi / 72).to_pil()))
+            finally:
+                page.close()
+        return images, total
+    finally:
+        pdf.close()
+
+def fetch_drawing_thumbnail(item, headers, user_email=TARGET_USER_EMAIL):
+    """Graphのサムネイル（1ページ目、CPU負荷なし）を取得して縮小JPEGに変換（取得できなければNone）"""
+    url = f"{GRAPH_API_BASE}/users/{user_email}/drive/items/{item['id']}/thumbnails?select=large"
+    response = GRAPH_CLIENT.get(url, headers=headers, timeout=30)
+    if response.status_code != 200:
+        return None
+    thumbnails = response.json().get('value', [])
+    large = thumbnails[0].get('large') if thumbnails else None
+    if not large or not large.get('url'):
+        return None
+
+    downloaded = stream_download(large['url'])
+    if downloaded is None:
+        return None
+    try:
+        data = downloaded.read()
+    finally:
+        downloaded.close()
+    if Image is None:
+        return data, (large.get('width', DRAWING_MAX_SIDE), large.get('height', DRAWING_MAX_SIDE))
+    return encode_drawing_image(Image.open(io.BytesIO(data)))
+
+def load_drawing_images(item, headers, user_email=TARGET_USER_EMAIL):
+    """
+    構造図PDFをページ画像に置き換える（local: pypdfium2で描画、失敗・未インストール時はサムネイル）
+    Returns: 画像のfile_data_list要素のリスト（画像化できなければNone。呼び出し側でPDFを送る）
+    """
+    mode = get_drawing_image_mode()
+    name = item['name']
+    if mode == "local" and pdfium is not None:
+        max_pages = int(os.environ.get(DRAWING_MAX_PAGES_ENV, str(DEFAULT_DRAWING_MAX_PAGES)))
+        dpi = int(os.environ.get(DRAWING_DPI_ENV, str(DEFAULT_DRAWING_DPI)))
+        pdf_file_data = fetch_pdf(item, headers, user_email)
+        if pdf_file_data is not None:
+            try:
+                images, total = render_drawing_pages(pdf_file_data, max_pages, dpi)
+                return [{
+                    "data": data,
+                    "mime_type": "image/jpeg",
+                    "name": name,
+                    "kind": "drawing",
+                    "image_size": size,
+                    "page_note": f"{index + 1}/{total}ページ目の画像"
+                } for index, (data, size) in enumerate(images)]
+            except Exception as e:
+                print(f"   ⚠️ 構造図の描画に失敗（サムネイルを使用）: {name}: {str(e)[:80]}")
+            finally:
+                pdf_file_data.close()
+
+    if mode in ("local", "thumbnail"):
+        try:
+            thumbnail = fetch_drawing_thumbnail(item, headers, user_email)
+        except Exception as e:
+            print(f"   ⚠️ サムネイル取得に失敗（PDFを送信）: {name}: {str(e)[:80]}")
+            thumbnail = None
+        if thumbnail is not None:
+            data, size = thumbnail
+            return [{
+                "data": data,
+                "mime_type": "image/jpeg",
+                "name": name,
+                "kind": "drawing",
+                "image_size": size,
+                "page_note": "1ページ目のサムネイル画像"
+            }]
+    return None
+
+def build_file_part(file_info):
+    """file_data_listの要素からGeminiのPartを作成（ステージング済みならURI参照）"""
+    if "uri" in file_info:
+        return Part.from_uri(file_info["uri"], mime_type=file_info["mime_type"])
+    return Part.from_data(read_file_data(file_info), mime_type=file_info["mime_type"])
+
+class AimdLimiter:
+    """
+    非同期リクエストの同時実行数をAIMD（加算増加・乗算減少）で調整するリミッター
+    asyncio.Semaphoreと同様に async with で使用する
+    """
+
+    def __init__(self, max_concurrency, min_concurrency=1):
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.limit = float(max_concurrency)
+        self.in_flight = 0
+        self.condition = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def __aexit__(self, exc_type, exc, tb):
+        async with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def on_success(self):
+        self.limit = min(self.limit + 1.0 / self.limit, float(self.max_concurrency))
+
+    def on_throttle(self):
+        self.limit = max(self.limit / 2, float(self.min_concurrency))
+
+async def graph_request_async(client, method, url, limiter=None, max_attempts=MAX_RETRIES, **kwargs):
+    """GraphClient.requestの非同期版（limiterがAimdLimiterなら同時実行数も調整）"""
+    for attempt in range(max_attempts):
+        try:
+            if limiter is not None:
+                async with limiter:
+                    response = await client.request(method, url, **kwargs)
+            else:
+                response = await client.request(method, url, **kwargs)
+        except httpx.TransportError:
+            if attempt == max_attempts - 1:
+                raise
+            GRAPH_CLIENT.record(retries=1)
+            await asyncio.sleep(exponential_backoff_with_jitter(attempt))
+            continue
+
+        if response.status_code in GRAPH_THROTTLE_STATUS_CODES and attempt < max_attempts - 1:
+            GRAPH_CLIENT.record(retries=1, throttled=1)
+            if isinstance(limiter, AimdLimiter):
+                limiter.on_throttle()
+            await asyncio.sleep(get_retry_after(response.headers, attempt))
+            continue
+
+        if isinstance(limiter, AimdLimiter):
+            limiter.on_success()
+        return response
+
+def with_list_params(url, select=GRAPH_ITEM_SELECT, top=GRAPH_PAGE_SIZE):
+    """一覧取得URLに$select/$topを付与"""
+    params = []
+    if select:
+        params.append(f"$select={select}")
+    if top:
+        params.append(f"$top={top}")
+    if not params:
+        return url
+    separator = '&' if '?' in url else '?'
+    return url + separator + "&".join(params)
+
+def iter_graph_items(url, headers, timeout=30, select=GRAPH_ITEM_SELECT, top=GRAPH_PAGE_SIZE):
+    """
+    Graph APIの一覧（children / search）を@odata.nextLinkを辿って全件返すジェネレータ
+    nextLinkには$select/$topが引き継がれるため、2ページ目以降はそのまま使用する
+    """
+    next_url = with_list_params(url, select, top)
+    while next_url:
+        response = GRAPH_CLIENT.get(next_url, headers=headers, timeout=timeout)
+        response.raise_for_status()
+        data = response.json()
+        yield from data.get('value', [])
+        next_url = data.get('@odata.nextLink')
+
+async def list_graph_items_async(client, url, get_headers, semaphore=None, timeout=30,
+                                 select=GRAPH_ITEM_SELECT, top=GRAPH_PAGE_SIZE):
+    """
+    iter_graph_itemsの非同期版（全ページを取得してリストで返す）
+    get_headersはページごとに呼び出し、その時点で有効なトークンのヘッダーを使う
+    """
+    items = []
+    next_url = with_list_params(url, select, top)
+    while next_url:
+        response = await graph_request_async(client, "GET", next_url, limiter=semaphore, headers=get_headers(),
+                                             timeout=timeout)
+        response.raise_for_status()
+        data = response.json()
+        items.extend(data.get('value', []))
+        next_url = data.get('@odata.nextLink')
+    return items
+
+def check_batch_response(sub_response, url):
+    """$batchのサブレスポンスがエラーの場合は例外を送出"""
+    status = sub_response.get('status', 500)
+    if status >= 400:
+        error = sub_response.get('body', {}).get('error', {})
+        raise requests.exceptions.HTTPError(f"{status} Error: {error.get('code', '')} for batch url: {url}")
+    return sub_response.get('body', {})
+
+def graph_batch_get(relative_urls, headers, timeout=60):
+    """
+    複数のGETを$batch（最大20件/回）にまとめて実行
+    relative_urls: "/users/{email}/drive/items/{id}" のようなGRAPH_API_BASEからの相対URL
+    スロットリング（429/503）されたサブリクエストのみ、Retry-After後に再送する
+    Returns: 入力と同じ順序のサブレスポンス（{"status": int, "body": dict, ...}）のリスト
+    """
+    results = [None] * len(relative_urls)
+    for start in range(0, len(relative_urls), GRAPH_BATCH_MAX_REQUESTS):
+        pending = list(range(start, min(start + GRAPH_BATCH_MAX_REQUESTS, len(relative_urls))))
+
+        for attempt in range(MAX_RETRIES):
+            payload = {"requests": [
+                {"id": str(i), "method": "GET", "url": relative_urls[i]} for i in pending
+            ]}
+            response = GRAPH_CLIENT.post(GRAPH_BATCH_URL, headers=headers, json=payload, timeout=timeout)
+            response.raise_for_status()
+
+            # サブレスポンスは順不同で返るため、idで呼び出し元の順序に戻す
+            by_id = {sub['id']: sub for sub in response.json().get('responses', [])}
+            throttled = []
+            delay = 0.0
+            for i in pending:
+                sub = by_id.get(str(i), {"status": 500, "body": {}})
+                results[i] = sub
+                if sub.get('status') in GRAPH_THROTTLE_STATUS_CODES:
+                    throttled.append(i)
+                    delay = max(delay, get_retry_after(sub.get('headers'), attempt))
+
+            if not throttled or attempt == MAX_RETRIES - 1:
+                break
+            GRAPH_CLIENT.on_throttle(len(throttled))
+            time.sleep(delay)
+            pending = throttled
+
+    return results
+
+class GraphBatcher:
+    """
+    非同期の呼び出し元から受け付けたGETを$batchにまとめて送信し、結果を各呼び出し元に振り分ける
+    GRAPH_BATCH_MAX_REQUESTS件たまるか、GRAPH_BATCH_FLUSH_DELAY秒経過した時点で送信する
+    スロットリングされたサブリクエストはRetry-After後に次のバッチへ回す
+    ヘッダーは送信のたびにget_headersで作成する（長時間のクロール中にトークンが失効しない）
+    """
+
+    def __init__(self, client, get_headers, semaphore=None, timeout=60):
+        self.client = client
+        self.get_headers = get_headers
+        self.semaphore = semaphore
+        self.timeout = timeout
+        self.pending = []
+        self.flush_handle = None
+        self.send_tasks = set()
+        self.batch_count = 0
+
+    async def get(self, relative_url):
+        """GETを予約し、対応するサブレスポンスを返す"""
+        future = asyncio.get_running_loop().create_future()
+        self.enqueue([(relative_url, future, 0)])
+        return await future
+
+    def enqueue(self, entries):
+        self.pending.extend(entries)
+        if len(self.pending) >= GRAPH_BATCH_MAX_REQUESTS:
+            self.flush()
+        elif self.flush_handle is None:
+            self.flush_handle = asyncio.get_running_loop().call_later(GRAPH_BATCH_FLUSH_DELAY, self.flush)
+
+    def flush(self):
+        """予約済みのGETを$batchとして送信"""
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+
+        while self.pending:
+            batch = self.pending[:GRAPH_BATCH_MAX_REQUESTS]
+            self.pending = self.pending[GRAPH_BATCH_MAX_REQUESTS:]
+            task = asyncio.get_running_loop().create_task(self.send(batch))
+            self.send_tasks.add(task)
+            task.add_done_callback(self.send_tasks.discard)
+
+    async def send(self, batch):
+        payload = {"requests": [
+            {"id": str(i), "method": "GET", "url": url} for i, (url, _, _) in enumerate(batch)
+        ]}
+        try:
+            response = await graph_request_async(self.client, "POST", GRAPH_BATCH_URL, limiter=self.semaphore,
+                                                 headers=self.get_headers(), json=payload, timeout=self.timeout)
+            response.raise_for_status()
+            self.batch_count += 1
+
+            by_id = {sub['id']: sub for sub in response.json().get('responses', [])}
+            throttled = []
+            delay = 0.0
+            for i, (url, future, attempt) in enumerate(batch):
+                sub = by_id.get(str(i), {"status": 500, "body": {}})
+                if sub.get('status') in GRAPH_THROTTLE_STATUS_CODES and attempt < MAX_RETRIES - 1:
+                    throttled.append((url, future, attempt + 1))
+                    delay = max(delay, get_retry_after(sub.get('headers'), attempt))
+                elif not future.done():
+                    future.set_result(sub)
+
+            if throttled:
+                GRAPH_CLIENT.record(throttled=len(throttled))
+                if isinstance(self.semaphore, AimdLimiter):
+                    self.semaphore.on_throttle()
+                await asyncio.sleep(delay)
+                self.enqueue(throttled)
+        except Exception as e:
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+# システム設定管理（デルタクエリ用スタンプ）
+# ターゲットパス（とドライブ）ごとに system_config/onedrive_sync/delta_cursors/{cursor_id} に保存する
+def get_delta_cursor_ref(db, user_email, root_path):
+    """ドライブ（ユーザー）とターゲットパスに対応するデルタカーソルのドキュメント参照"""
+    cursor_id = hashlib.sha256(f"{user_email}|{root_path}".encode("utf-8")).hexdigest()[:32]
+    return (db.collection("system_config").document("onedrive_sync")
+            .collection("delta_cursors").document(cursor_id))
+
+def get_delta_link(user_email, root_path):
+    """ターゲットパスの前回の同期状態（デルタリンク）を取得"""
+    try:
+        db = get_firestore_client()
+        doc = get_delta_cursor_ref(db, user_email, root_path).get()
+        if doc.exists:
+            return doc.to_dict().get("deltaLink")
+        return None
+    except Exception as e:
+        print(f"⚠️ システム設定取得エラー: {e}")
+        return None
+
+def get_pending_project_folders(user_email, root_path):
+    """前回までの実行で失敗し、次の差分更新で再処理する案件フォルダを取得"""
+    try:
+        db = get_firestore_client()
+        doc = get_delta_cursor_ref(db, user_email, root_path).get()
+        if doc.exists:
+            return doc.to_dict().get("pendingFolders") or []
+        return []
+    except Exception as e:
+        print(f"⚠️ システム設定取得エラー: {e}")
+        return []
+
+def save_delta_link(user_email, root_path, delta_link, run_started_at, pending_folders=None):
+    """
+    ターゲットパスのデルタリンクをトランザクションで保存
+    同じカーソルに後から開始した実行が既に保存している場合は上書きしない
+    pending_foldersには今回失敗した案件フォルダを渡す（デルタリンクと同時に保存し、次の差分更新で再処理する）
+    """
+    try:
+        db = get_firestore_client()
+        doc_ref = get_delta_cursor_ref(db, user_email, root_path)
+
+        @firestore.transactional
+        def update_cursor(transaction):
+            snapshot = doc_ref.get(transaction=transaction)
+            if snapshot.exists:
+                saved_started_at = snapshot.to_dict().get("run_started_at")
+                if saved_started_at and saved_started_at > run_started_at:
+                    return False
+            transaction.set(doc_ref, {
+                "deltaLink": delta_link,
+                "user_email": user_email,
+                "target_path": root_path,
+                "run_started_at": run_started_at,
+                "pendingFolders": [
+                    {key: folder.get(key) for key in ('id', 'name', 'path', 'full_path')}
+                    for folder in pending_folders or []
+                ],
+                "last_run_at": firestore.SERVER_TIMESTAMP
+            })
+            return True
+
+        if update_cursor(db.transaction()):
+            print(f"✅ デルタリンクを保存しました: {root_path}")
+            if pending_folders:
+                print(f"🔁 失敗した{len(pending_folders)}件は次回の差分更新で再処理します")
+        else:
+            print(f"⏭️  より新しい実行のデルタリンクが保存済みのため更新しません: {root_path}")
+    except Exception as e:
+        print(f"❌ システム設定保存エラー: {e}")
+
 def extract_project_metadata(folder_path):
     """フォルダパスから案件メタデータを抽出"""
     metadata = {
@@ -140,31 +1623,59 @@ def select_project_files(file_list):
 
     return all_calc_files, all_drawing_files, best_cert, best_review
 
+# プロセスごとのVertex AI・Firestoreクライアント（gRPCチャネルを案件間で使い回す）
+# キーにpidを含めるため、fork前に親プロセスで作成したクライアントを子プロセスが使うことはない
+WORKER_CLIENTS = {}
+WORKER_CLIENTS_LOCK = threading.Lock()
+
+def get_worker_client(name, factory):
+    """このプロセスのクライアントを返す（なければfactoryで作成）"""
+    key = (name, os.getpid())
+    client = WORKER_CLIENTS.get(key)
+    if client is None:
+        with WORKER_CLIENTS_LOCK:
+            client = WORKER_CLIENTS.get(key)
+            if client is None:
+                client = factory()
+                WORKER_CLIENTS[key] = client
+    return client
+
+def get_firestore_client():
+    """このプロセスのFirestoreクライアント"""
+    return get_worker_client("firestore", lambda: firestore.Client(project=GCP_PROJECT_ID, database=FIRESTORE_DATABASE))
+
+def create_gemini_model():
+    """Vertex AIを初期化してGeminiモデルを作成"""
+    vertexai.init(project=GCP_PROJECT_ID, location=LOCATION)
+    return GenerativeModel(GEMINI_MODEL_NAME)
+
+def get_gemini_model():
+    """このプロセスのGeminiモデル（vertexai.initはプロセスごとに1回）"""
+    return get_worker_client("gemini", create_gemini_model)
+
+def init_worker():
+    """
+    ProcessPoolExecutorのinitializer: ワーカープロセスの起動時にクライアントを作成
+    以降の案件は作成済みのクライアント（gRPCチャネル）を使い回す
+    """
+    start_time = time.time()
+    try:
+        get_firestore_client()
+        get_gemini_model()
+    except Exception as e:
+        # 初期化に失敗しても、案件の処理時に改めて作成する
+        print(f"   ⚠️ ワーカー初期化に失敗（pid {os.getpid()}）: {str(e)[:80]}")
+        return
+    print(f"   🔧 ワーカー初期化（pid {os.getpid()}）: クライアント作成 {time.time() - start_time:.2f}秒")
+
 def exponential_backoff_with_jitter(attempt: int) -> float:
     """指数バックオフ + ランダムジッター"""
     delay = min(INITIAL_RETRY_DELAY * (2 ** attempt), MAX_RETRY_DELAY)
     jitter = random.uniform(-JITTER_RANGE, JITTER_RANGE)
     return max(0.1, delay + jitter)
 
-def analyze_with_gemini_with_retry(file_data_list, file_name_hints=None, max_attempts=MAX_RETRIES):
-    """
-    Gemini APIを呼び出し（積極的なリトライ戦略）
-    指数バックオフ + ランダムジッターでレート制限を回避
-    """
-    vertexai.init(project=GCP_PROJECT_ID, location=LOCATION)
-    model = GenerativeModel("gemini-2.0-flash-exp")
-
-    parts = []
-
-    if file_name_hints:
-        hint_text = "【ファイル名ヒント】\n" + "\n".join([f"- {hint}" for hint in file_name_hints])
-        parts.append(hint_text)
-
-    for file_info in file_data_list:
-        parts.append(Part.from_data(file_info["data"], mime_type=file_info["mime_type"]))
-        parts.append(f"[ファイル名: {file_info['name']}]")
-
-    prompt = """
+# 解析プロンプト（抽出項目と出力形式。案件によらず共通）
+ANALYSIS_PROMPT = """
 以下の構造計算書PDFを解析し、JSON形式で情報を抽出してください。
 
 【抽出項目と選択肢】
@@ -258,31 +1769,73 @@ def analyze_with_gemini_with_retry(file_data_list, file_name_hints=None, max_att
 それでは解析を開始してください。
 """
 
-    parts.insert(0, prompt)
+# 生成パラメータ（オンライン・バッチ共通）
+GENERATION_CONFIG = {
+    "temperature": 0.1,
+    "top_p": 0.95,
+    "max_output_tokens": 8192,
+}
+
+def build_analysis_inputs(file_data_list, file_name_hints=None, rule_fields=None):
+    """
+    解析リクエストの入力を順に並べる（先頭がプロンプト）
+    Returns: 文字列 または file_data_listの要素 のリスト（呼び出し側でGeminiのPart・バッチのJSONに変換）
+    """
+    prompt = ANALYSIS_PROMPT
+    if rule_fields:
+        prompt += "\n【抽出済みの項目】\n以下の項目は構造計算書のテキストから抽出済みのため、JSONへの出力は不要です。\n"
+        prompt += "\n".join([f"- {name}: {value}" for name, value in rule_fields.items()])
+        prompt += "\nルート判定の根拠（routeReasoning）などの関連項目は、これらの値と矛盾しないように記述してください。\n"
+
+    inputs = [prompt]
+    if file_name_hints:
+        inputs.append("【ファイル名ヒント】\n" + "\n".join([f"- {hint}" for hint in file_name_hints]))
+    for file_info in file_data_list:
+        inputs.append(file_info)
+        inputs.append(file_label(file_info))
+    return inputs
+
+def analyze_with_gemini_with_retry(file_data_list, file_name_hints=None, max_attempts=MAX_RETRIES, rule_fields=None):
+    """
+    Gemini APIを呼び出し（積極的なリトライ戦略）
+    指数バックオフ + ランダムジッターでレート制限を回避
+    rule_fields: テキストレイヤーから抽出済みの項目（Geminiには出力不要と伝え、結果に上書きする）
+    """
+    model = get_gemini_model()
+
+    parts = [
+        item if isinstance(item, str) else build_file_part(item)
+        for item in build_analysis_inputs(file_data_list, file_name_hints, rule_fields)
+    ]
 
+    result = generate_json_with_retry(model, parts, max_attempts)
+    if not isinstance(result, dict):
+        return None
+    return apply_rule_fields(result, rule_fields or {})
+
+def parse_json_response(text):
+    """Geminiの応答テキストからJSONを取り出す（```json ブロックにも対応）"""
+    if "```json" in text:
+        json_str = text.split("```json")[1].split("```")[0].strip()
+    elif "```" in text:
+        json_str = text.split("```")[1].split("```")[0].strip()
+    else:
+        json_str = text.strip()
+    return json.loads(json_str)
+
+def generate_json_with_retry(model, parts, max_attempts=MAX_RETRIES):
+    """
+    generate_contentを呼び出し、応答からJSONを取り出す（失敗時はNone）
+    レート制限・一時的なエラーは指数バックオフ + ランダムジッターでリトライ
+    """
     # リトライループ
     for attempt in range(max_attempts):
         try:
             response = model.generate_content(
                 parts,
-                generation_config=GenerationConfig(
-                    temperature=0.1,
-                    top_p=0.95,
-                    max_output_tokens=8192,
-                )
+                generation_config=GenerationConfig(**GENERATION_CONFIG)
             )
-
-            text = response.text
-
-            if "```json" in text:
-                json_str = text.split("```json")[1].split("```")[0].strip()
-            elif "```" in text:
-                json_str = text.split("```")[1].split("```")[0].strip()
-            else:
-                json_str = text.strip()
-
-            result = json.loads(json_str)
-            return result
+            return parse_json_response(response.text)
 
         except exceptions.ResourceExhausted as e:
             # 429エラー: レート制限
@@ -309,235 +1862,1322 @@ def analyze_with_gemini_with_retry(file_data_list, file_name_hints=None, max_att
 
     return None
 
-def collect_all_project_folders(access_token, user_email, root_path):
-    """指定されたルートパス配下の全ての構造設計図書フォルダを収集"""
-    headers = {"Authorization": f"Bearer {access_token}"}
-    project_folders = []
-
-    print(f"📂 フォルダ収集開始: {root_path}")
+def get_extraction_mode():
+    """解析方式（環境変数EXTRACTION_MODE: single / map-reduce / auto）"""
+    return os.environ.get(EXTRACTION_MODE_ENV, "single")
+
+def use_map_reduce(file_data_list):
+    """分割解析を行うか（autoモードは棟別の構造計算書、または構造計算書の合計トークンが大きい場合）"""
+    mode = get_extraction_mode()
+    if mode == "single" or len(file_data_list) < 2:
+        return False
+    if mode == "map-reduce":
+        return True
+    calc_files = [file_info for file_info in file_data_list if file_info.get("kind", "calc") == "calc"]
+    if len(calc_files) < 2:
+        return False
+    if any(pattern in file_info['name'] for file_info in calc_files for pattern in ZONING_PATTERNS):
+        return True
+    return sum(file_info.get("tokens", 0) for file_info in calc_files) > MAP_REDUCE_MIN_TOKENS
+
+def merge_field(name, values):
+    """
+    部分結果の1項目を統合（values は優先度順）
+    リスト: 和集合（出現順） / 重大度のある単一選択: 最も厳しい値 / その他: 最初の空でない値
+    """
+    present = [value for value in values if value not in (None, "", [])]
+    if not present:
+        return next((value for value in values if value is not None), None)
+    values = present
+    if all(isinstance(value, list) for value in values):
+        merged = []
+        for value in values:
+            for choice in value:
+                if choice not in merged:
+                    merged.append(choice)
+        return merged
+    order = SEVERITY_ORDERS.get(name)
+    if order:
+        ranked = [value for value in values if value in order]
+        if ranked:
+            return max(ranked, key=order.index)
+    return values[0]
+
+def merge_partial_results(partials):
+    """
+    ファイルごとの解析結果（優先度順）を決定的なルールで1つに統合
+    ルート判定の根拠は、採用したルートを返した部分結果のものを使う
+    """
+    merged = {}
+    for partial in partials:
+        for section, values in partial.items():
+            if isinstance(values, dict) and section != "fieldSources":
+                merged.setdefault(section, {})
+                for name in values:
+                    merged[section].setdefault(name, None)
+
+    for section, fields in merged.items():
+        for name in fields:
+            fields[name] = merge_field(name, [partial.get(section, {}).get(name) for partial in partials])
+
+    route = merged.get("legalTechnical", {}).get("structuralCalcRoute")
+    if route:
+        for partial in partials:
+            legal_technical = partial.get("legalTechnical", {})
+            if legal_technical.get("structuralCalcRoute") == route and legal_technical.get("routeReasoning"):
+                merged["legalTechnical"]["routeReasoning"] = legal_technical["routeReasoning"]
+                break
+    return merged
 
-    def scan_folder_recursive(folder_url, current_path="", depth=0):
-        """再帰的にフォルダをスキャン（深さ制限付き）"""
-        if depth > 10:  # 深さ制限
-            return
+def summarize_partial_results(merged, partials, file_names, max_attempts=MAX_RETRIES):
+    """統合結果とファイルごとの要約から、物件特徴の要約を作成（テキストのみの小さな呼び出し）"""
+    model = get_gemini_model()
 
-        try:
-            response = requests.get(folder_url, headers=headers, timeout=30)
-            response.raise_for_status()
-            items = response.json().get('value', [])
+    partial_summaries = "\n".join([
+        f"- {name}: {partial.get('other', {}).get('projectSummary', '')}"
+        for name, partial in zip(file_names, partials)
+    ])
+    prompt = f"""
+以下は同じ物件の構造計算書をファイルごとに解析した結果です。
+ファイルごとの要約と統合済みの抽出結果をもとに、物件全体の特徴を300文字程度で要約してください。
+複数棟に分割されている場合は、棟ごとの違いにも触れてください。
 
-            for item in items:
-                if "folder" not in item:
-                    continue
+【ファイルごとの要約】
+{partial_summaries}
 
-                folder_name = item['name']
-                folder_id = item['id']
-                new_path = f"{current_path}/{folder_name}".lstrip('/')
-
-                # 構造設計図書フォルダを検出
-                if ('構造設計図書' in folder_name or '構造計算書' in folder_name) and '○' not in folder_name:
-                    sub_url = f"https://graph.microsoft.com/v1.0/users/{user_email}/drive/items/{folder_id}/children"
-                    sub_response = requests.get(sub_url, headers=headers, timeout=30)
-                    if sub_response.status_code == 200:
-                        sub_items = sub_response.json().get('value', [])
-
-                        has_sub_folders = False
-                        for sub_item in sub_items:
-                            if "folder" in sub_item:
-                                sub_name = sub_item['name']
-                                if ('構造設計図書' in sub_name or '構造計算書' in sub_name) and '○' not in sub_name:
-                                    project_folders.append({
-                                        'id': sub_item['id'],
-                                        'name': sub_item['name'],
-                                        'path': current_path,
-                                        'full_path': f"{new_path}/{sub_item['name']}"
-                                    })
-                                    has_sub_folders = True
-
-                        if not has_sub_folders:
-                            project_folders.append({
-                                'id': folder_id,
-                                'name': folder_name,
-                                'path': current_path,
-                                'full_path': new_path
-                            })
-                else:
-                    # 再帰的に探索
-                    child_url = f"https://graph.microsoft.com/v1.0/users/{user_email}/drive/items/{folder_id}/children"
-                    scan_folder_recursive(child_url, new_path, depth + 1)
+【統合済みの抽出結果】
+{json.dumps(merged, ensure_ascii=False)}
 
-        except requests.exceptions.Timeout:
-            print(f"⚠️ タイムアウト: {current_path}")
-        except Exception as e:
-            print(f"⚠️ フォルダスキャンエラー ({current_path}): {e}")
+【出力形式】
+```json
+{{"projectSummary": "..."}}
+```
+"""
+    result = generate_json_with_retry(model, [prompt], max_attempts)
+    if isinstance(result, dict):
+        return result.get("projectSummary")
+    return None
+
+def analyze_map_reduce(file_data_list, file_name_hints=None, rule_fields=None):
+    """
+    分割解析: ファイルごとに並列でGeminiに抽出させ（map）、部分結果を決定的なルールで統合（reduce）
+    最後に物件特徴の要約だけを小さな呼び出しで作成する
+    """
+    # 同じファイルの要素（構造図のページ画像など）はまとめて1回で解析
+    units = {}
+    for file_info in file_data_list:
+        units.setdefault(file_info['name'], []).append(file_info)
+
+    print(f"   🧩 分割解析: {len(units)}ファイルを個別に解析して統合")
+    # ファイル名ヒントは各呼び出しで送るファイルの名前だけにする（見えないファイルの名前をモデルに伝えない）
+    with ThreadPoolExecutor(max_workers=MAP_REDUCE_WORKERS) as executor:
+        partials = list(executor.map(
+            lambda name: analyze_with_gemini_with_retry(units[name], [name] if file_name_hints is not None else None,
+                                                        rule_fields=rule_fields),
+            units
+        ))
+
+    succeeded = [(name, partial) for name, partial in zip(units, partials) if partial]
+    for name, partial in zip(units, partials):
+        if not partial:
+            print(f"   ⚠️ 分割解析に失敗したファイルを除いて統合: {name}")
+    if not succeeded:
+        return None
+
+    file_names = [name for name, _ in succeeded]
+    partials = [partial for _, partial in succeeded]
+    merged = merge_partial_results(partials)
+
+    summary = summarize_partial_results(merged, partials, file_names)
+    if summary:
+        merged.setdefault("other", {})["projectSummary"] = summary
+
+    merged["partialResults"] = [{"fileName": name, "result": partial} for name, partial in succeeded]
+    return apply_rule_fields(merged, rule_fields or {})
+
+def is_project_folder_name(folder_name):
+    """構造設計図書フォルダか判定（○を含むダミーフォルダは除外）"""
+    return ('構造設計図書' in folder_name or '構造計算書' in folder_name) and '○' not in folder_name
+
+class FolderTreeIndex:
+    """
+    クロール済みフォルダツリーのローカルインデックス（SQLite）
+    driveItem idごとにパス・バージョン・子フォルダ一覧を保持し、
+    前回の実行以降にドライブのデルタで変更が報告されていないフォルダは子フォルダ一覧をGraph APIを呼ばずに再利用する
+    - OneDrive for Businessではフォルダに cTag が返らないため、バージョンは cTag がなければ eTag + lastModifiedDateTime
+    - フォルダの eTag/lastModifiedDateTime は配下の変更で更新されるとは限らないため、
+      再利用はデルタで無効化を済ませた実行（delta_synced）でのみ行う
+    """
+
+    def __init__(self, db_path):
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path)
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(folders)")]
+        if columns and 'version' not in columns:
+            # 旧形式（cTagのみで判定）のインデックスは作り直す
+            self.conn.execute("DROP TABLE folders")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS folders (
+                id TEXT PRIMARY KEY,
+                path TEXT NOT NULL,
+                name TEXT NOT NULL,
+                version TEXT,
+                children TEXT NOT NULL,
+                indexed_at TEXT NOT NULL
+            )
+        """)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.delta_synced = False
+        self.pending_delta_link = None
+        self.reused_count = 0
+        self.stored_count = 0
+        self.invalidated_count = 0
+
+    def get(self, folder_id):
+        """インデックス済みのフォルダ情報を取得（未登録ならNone）"""
+        row = self.conn.execute(
+            "SELECT path, name, version, children FROM folders WHERE id = ?", (folder_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        path, name, version, children = row
+        return {'id': folder_id, 'path': path, 'name': name, 'version': version,
+                'children': json.loads(children)}
+
+    def get_unchanged_children(self, folder):
+        """デルタでの無効化が済んでいて、バージョンが前回と一致する場合のみ、保存済みの子フォルダ一覧を返す"""
+        version = folder_version(folder)
+        if not self.delta_synced or not folder.get('id') or not version:
+            return None
+        cached = self.get(folder['id'])
+        if cached is None or cached['version'] != version:
+            return None
+        self.reused_count += 1
+        return cached['children']
+
+    def put(self, folder, path, children):
+        """フォルダと子フォルダ一覧を登録（既存は上書き）"""
+        self.conn.execute(
+            "INSERT OR REPLACE INTO folders (id, path, name, version, children, indexed_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (folder['id'], path, folder.get('name', ''), folder_version(folder),
+             json.dumps(children, ensure_ascii=False), datetime.now(JST).isoformat())
+        )
+        self.stored_count += 1
+
+    def invalidate(self, folder_id):
+        """フォルダ自身と、子フォルダ一覧にそのフォルダを含むエントリ（移動・削除前の親）を削除"""
+        cursor = self.conn.execute(
+            "DELETE FROM folders WHERE id = ? OR children LIKE ?", (folder_id, f'%"{folder_id}"%')
+        )
+        self.invalidated_count += cursor.rowcount
+
+    def clear(self):
+        self.conn.execute("DELETE FROM folders")
+
+    def get_delta_link(self, user_email):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (f"delta:{user_email}",)).fetchone()
+        return row[0] if row else None
+
+    def set_delta_link(self, user_email, delta_link):
+        self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (f"delta:{user_email}", delta_link))
+
+    def iter_folders(self, root_path):
+        """root_path配下（root_path自身を含む）のインデックス済みフォルダを列挙"""
+        prefix = root_path.rstrip('/') + '/'
+        for folder_id, path, name, children in self.conn.execute("SELECT id, path, name, children FROM folders"):
+            if path == root_path or path.startswith(prefix):
+                yield {'id': folder_id, 'path': path, 'name': name, 'children': json.loads(children)}
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+def folder_version(folder):
+    """フォルダのバージョン（cTag。返らないドライブでは eTag + lastModifiedDateTime）"""
+    if folder.get('cTag'):
+        return folder['cTag']
+    if folder.get('eTag'):
+        return f"{folder['eTag']}|{folder.get('lastModifiedDateTime') or ''}"
+    return None
+
+def to_folder_entry(item):
+    """一覧のアイテムからインデックスに保存するフォルダ情報を抽出"""
+    return {'id': item['id'], 'name': item['name'], 'cTag': item.get('cTag'), 'eTag': item.get('eTag'),
+            'lastModifiedDateTime': item.get('lastModifiedDateTime')}
+
+def sync_folder_index(folder_index, access_token, user_email):
+    """
+    前回の実行で保存したドライブ全体のデルタリンクから変更を取得し、変更されたフォルダとその親のエントリを無効化
+    OneDrive for Business/SharePointではパス指定のデルタが使えない場合があるため、ドライブのルートで取得する
+    （クロール対象外の変更はインデックスに該当エントリがないため影響しない）
+    デルタリンクがない・失効している場合はインデックスを空にし、今回は再利用せずに全件クロールする
+    新しいデルタリンクはクロール完了後に commit_folder_index で保存する
+    """
+    delta_link = folder_index.get_delta_link(user_email)
+    if delta_link:
+        try:
+            for items, page_delta_link in iter_delta_pages(access_token, user_email, delta_link=delta_link):
+                for item in items:
+                    if 'folder' not in item and 'deleted' not in item:
+                        continue
+                    folder_index.invalidate(item['id'])
+                    parent_id = item.get('parentReference', {}).get('id')
+                    if parent_id:
+                        folder_index.invalidate(parent_id)
+                if page_delta_link:
+                    folder_index.pending_delta_link = page_delta_link
+            folder_index.delta_synced = folder_index.pending_delta_link is not None
+        except Exception as e:
+            print(f"⚠️ フォルダインデックスのデルタ同期エラー（全件クロールします）: {e}")
+            folder_index.pending_delta_link = None
 
-    start_url = f"https://graph.microsoft.com/v1.0/users/{user_email}/drive/root:/{root_path}:/children"
-    scan_folder_recursive(start_url, root_path)
+    if not folder_index.delta_synced:
+        folder_index.clear()
+        url = f"{GRAPH_API_BASE}/users/{user_email}/drive/root/delta?token=latest"
+        try:
+            response = GRAPH_CLIENT.get(url, headers=graph_auth_headers(access_token), timeout=30)
+            response.raise_for_status()
+            folder_index.pending_delta_link = response.json().get('@odata.deltaLink')
+        except Exception as e:
+            print(f"⚠️ フォルダインデックスのデルタリンク取得エラー（次回も全件クロール）: {e}")
 
+def commit_folder_index(folder_index, user_email):
+    """クロール完了後、同期開始時点のデルタリンクを保存（クロール中の変更は次回のデルタで無効化される）"""
+    if folder_index.pending_delta_link:
+        folder_index.set_delta_link(user_email, folder_index.pending_delta_link)
+
+async def collect_all_project_folders_async(access_token, user_email, root_path, concurrency=DEFAULT_CRAWL_CONCURRENCY,
+                                            folder_index=None, on_found=None):
+    """
+    指定されたルートパス配下の全ての構造設計図書フォルダを非同期で収集
+    同時リクエスト数をconcurrencyで制限しつつ、複数フォルダの一覧を並行して取得する
+    folder_indexを渡すと、前回から変更のないフォルダは子フォルダ一覧をインデックスから再利用する
+    on_foundを渡すと、案件フォルダを検出するたびに（探索順ではなく検出順で）呼び出す
+    access_tokenがNoneの場合は、リクエストごとにTOKEN_PROVIDERから有効なトークンを取得する
+    """
+    def get_headers():
+        return graph_auth_headers(access_token)
+
+    semaphore = AimdLimiter(concurrency)
+    # (探索順キー, フォルダ情報) のリスト。最後にキーでソートして逐次探索と同じ順序に揃える
+    found_folders = []
+
+    def add_found(order_key, project_folder):
+        found_folders.append((order_key, project_folder))
+        if on_found is not None:
+            on_found(project_folder)
+
+    async def list_child_folders(client, batcher, folder, folder_path, use_batch=False):
+        """
+        フォルダ直下の子フォルダ一覧を取得
+        インデックスに変更のないエントリがあれば再利用し、なければGraph APIで全ページ取得して登録する
+        """
+        if folder_index is not None:
+            cached_children = folder_index.get_unchanged_children(folder)
+            if cached_children is not None:
+                return cached_children
+
+        if folder.get('id') is None:
+            # ルートはパス指定で取得
+            url = f"{GRAPH_API_BASE}/users/{user_email}/drive/root:/{root_path}:/children"
+            items = await list_graph_items_async(client, url, get_headers, semaphore=semaphore)
+        elif use_batch:
+            # 構造設計図書フォルダのサブフォルダ一覧は$batchにまとめる
+            url = with_list_params(f"/users/{user_email}/drive/items/{folder['id']}/children")
+            body = check_batch_response(await batcher.get(url), url)
+            items = body.get('value', [])
+            if body.get('@odata.nextLink'):
+                items += await list_graph_items_async(client, body['@odata.nextLink'], get_headers,
+                                                      semaphore=semaphore, select=None, top=None)
+        else:
+            url = f"{GRAPH_API_BASE}/users/{user_email}/drive/items/{folder['id']}/children"
+            items = await list_graph_items_async(client, url, get_headers, semaphore=semaphore)
+
+        children = [to_folder_entry(item) for item in items if "folder" in item]
+        if folder_index is not None and folder.get('id') is not None:
+            folder_index.put(folder, folder_path, children)
+        return children
+
+    async def scan_project_folder(client, batcher, folder, current_path, new_path, order_key):
+        """構造設計図書フォルダ内のサブフォルダ（納品時など）を確認"""
+        try:
+            sub_folders = await list_child_folders(client, batcher, folder, new_path, use_batch=True)
+        except Exception as e:
+            print(f"⚠️ サブフォルダ取得エラー ({new_path}): {e}")
+            return
+
+        has_sub_folders = False
+        for sub_index, sub_folder in enumerate(sub_folders):
+            if is_project_folder_name(sub_folder['name']):
+                add_found(order_key + (sub_index,), {
+                    'id': sub_folder['id'],
+                    'name': sub_folder['name'],
+                    'path': current_path,
+                    'full_path': f"{new_path}/{sub_folder['name']}"
+                })
+                has_sub_folders = True
+
+        if not has_sub_folders:
+            add_found(order_key, {
+                'id': folder['id'],
+                'name': folder['name'],
+                'path': current_path,
+                'full_path': new_path
+            })
+
+    async def scan_folder(client, batcher, folder, current_path="", depth=0, order_key=()):
+        """フォルダを並行してスキャン（深さ制限付き）"""
+        if depth > 10:  # 深さ制限
+            return
+
+        try:
+            child_folders = await list_child_folders(client, batcher, folder, current_path)
+        except httpx.TimeoutException:
+            print(f"⚠️ タイムアウト: {current_path}")
+            return
+        except Exception as e:
+            print(f"⚠️ フォルダスキャンエラー ({current_path}): {e}")
+            return
+
+        tasks = []
+        for index, child in enumerate(child_folders):
+            new_path = f"{current_path}/{child['name']}".lstrip('/')
+
+            if is_project_folder_name(child['name']):
+                tasks.append(scan_project_folder(client, batcher, child, current_path, new_path, order_key + (index,)))
+            else:
+                tasks.append(scan_folder(client, batcher, child, new_path, depth + 1, order_key + (index,)))
+
+        await asyncio.gather(*tasks)
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency,
+                          keepalive_expiry=GRAPH_KEEPALIVE_EXPIRY)
+    timeout = httpx.Timeout(30.0, connect=GRAPH_CONNECT_TIMEOUT)
+    async with httpx.AsyncClient(limits=limits, timeout=timeout) as client:
+        batcher = GraphBatcher(client, get_headers, semaphore=semaphore)
+        await scan_folder(client, batcher, {'id': None, 'name': root_path}, root_path)
+
+    found_folders.sort(key=lambda entry: entry[0])
+    return [folder for _, folder in found_folders]
+
+def collect_all_project_folders(access_token, user_email, root_path, concurrency=DEFAULT_CRAWL_CONCURRENCY,
+                                index_path=None, on_found=None):
+    """
+    指定されたルートパス配下の全ての構造設計図書フォルダを収集
+    index_pathを指定すると、フォルダツリーのローカルインデックスを使って変更のないサブツリーの再クロールを省略する
+    on_foundを渡すと、案件フォルダを検出するたびに呼び出す（パイプライン実行で収集完了を待たずに処理を始める）
+    access_tokenがNoneの場合は、リクエストごとにTOKEN_PROVIDERから有効なトークンを取得する（長時間のクロール向け）
+    """
+    print(f"📂 フォルダ収集開始: {root_path} (同時リクエスト数: {concurrency})")
+
+    throttled_before = GRAPH_CLIENT.throttled_count
+    folder_index = FolderTreeIndex(index_path) if index_path else None
+    try:
+        if folder_index is not None:
+            sync_folder_index(folder_index, access_token, user_email)
+        project_folders = asyncio.run(
+            collect_all_project_folders_async(access_token, user_email, root_path, concurrency, folder_index, on_found)
+        )
+        if folder_index is not None:
+            commit_folder_index(folder_index, user_email)
+    finally:
+        if folder_index is not None:
+            folder_index.close()
+
+    if folder_index is not None:
+        print(f"♻️  フォルダインデックス: 再利用 {folder_index.reused_count}件 / 更新 {folder_index.stored_count}件 / "
+              f"デルタで無効化 {folder_index.invalidated_count}件 ({index_path})")
+    throttled = GRAPH_CLIENT.throttled_count - throttled_before
+    if throttled:
+        print(f"🚦 Graphスロットリング: {throttled}回（Retry-Afterに従って再試行済み）")
     print(f"✅ フォルダ収集完了: {len(project_folders)}件の案件を検出")
     return project_folders
 
-def process_single_project(project_info: Dict, access_token: str, user_email: str, collection_name: str) -> Tuple[bool, str, float]:
+def iter_delta_pages(access_token, user_email, delta_link=None):
     """
-    単一の案件フォルダを処理（並列実行される）
-    各プロセスが独立したレート制限枠を持つ
+    ドライブのルートに対するデルタクエリの結果をページ単位で順に返すジェネレータ
+    （OneDrive for Business/SharePointではパス指定のデルタが使えないため、常にドライブ全体）
+    access_tokenがNoneの場合は、ページごとにTOKEN_PROVIDERから有効なトークンを取得する
+    Yields: (items, delta_link) - delta_linkは最終ページでのみ設定される
+    """
+    if delta_link:
+        url = delta_link
+    else:
+        url = with_list_params(f"{GRAPH_API_BASE}/users/{user_email}/drive/root/delta", select=DELTA_ITEM_SELECT)
+
+    while url:
+        response = GRAPH_CLIENT.get(url, headers=graph_auth_headers(access_token), timeout=60)
+        response.raise_for_status()
+        data = response.json()
+        url = data.get('@odata.nextLink')
+        yield data.get('value', []), data.get('@odata.deltaLink')
+
+def materialize_folder_tree(access_token, user_email, root_path):
+    """
+    デルタクエリ1回分の列挙から対象パス配下のフォルダツリーをメモリ上に構築
+    OneDrive for Business/SharePointではパス指定のデルタが使えないため、ドライブのルートで列挙する
+    ページを順に読み流し、フォルダのみ親IDで紐付けて保持する（ファイルは保持しない）
+    デルタの結果にはparentReference.pathが含まれないため、対象パスのフォルダIDから親IDで辿れるフォルダだけを残す
+    Returns: (root_id, children_by_parent, delta_link)
+    """
+    headers = {"Authorization": f"Bearer {access_token}"}
+    root_url = f"{GRAPH_API_BASE}/users/{user_email}/drive/root:/{root_path}?$select=id,name"
+    root_response = GRAPH_CLIENT.get(root_url, headers=headers, timeout=30)
+    root_response.raise_for_status()
+    root_id = root_response.json()['id']
+
+    folders = {}
+    delta_link = None
+    page_count = 0
+    for items, page_delta_link in iter_delta_pages(access_token, user_email):
+        page_count += 1
+        for item in items:
+            if 'deleted' in item or 'folder' not in item:
+                continue
+            folders[item['id']] = {
+                'id': item['id'],
+                'name': item['name'],
+                'parent_id': item.get('parentReference', {}).get('id'),
+                'cTag': item.get('cTag'),
+                'eTag': item.get('eTag')
+            }
+        if page_delta_link:
+            delta_link = page_delta_link
+
+    all_children = {}
+    for folder in folders.values():
+        all_children.setdefault(folder['parent_id'], []).append(folder)
+
+    # 対象パス配下（root_idから辿れる）フォルダのみ残す
+    children_by_parent = {}
+    pending = [root_id]
+    while pending:
+        children = all_children.get(pending.pop())
+        if children:
+            children.sort(key=lambda folder: folder['name'])
+            children_by_parent[children[0]['parent_id']] = children
+            pending.extend(folder['id'] for folder in children)
+    target_count = sum(len(children) for children in children_by_parent.values())
+
+    print(f"🧭 デルタ列挙完了: {page_count}ページ / フォルダ {len(folders)}件（うち対象パス配下 {target_count}件）")
+    return root_id, children_by_parent, delta_link
+
+def find_project_folders_in_tree(children_by_parent, root_id, root_path):
+    """
+    メモリ上のフォルダツリーから構造設計図書フォルダを検出
+    判定ルールはcollect_all_project_folders_asyncと同じ（サブフォルダ優先・○除外・深さ制限）
+    """
+    project_folders = []
+
+    def scan(folder_id, current_path, depth=0):
+        if depth > 10:  # 深さ制限
+            return
+
+        for child in children_by_parent.get(folder_id, []):
+            new_path = f"{current_path}/{child['name']}".lstrip('/')
+
+            if is_project_folder_name(child['name']):
+                sub_folders = [sub for sub in children_by_parent.get(child['id'], [])
+                               if is_project_folder_name(sub['name'])]
+                for sub_folder in sub_folders:
+                    project_folders.append({
+                        'id': sub_folder['id'],
+                        'name': sub_folder['name'],
+                        'path': current_path,
+                        'full_path': f"{new_path}/{sub_folder['name']}"
+                    })
+                if not sub_folders:
+                    project_folders.append({
+                        'id': child['id'],
+                        'name': child['name'],
+                        'path': current_path,
+                        'full_path': new_path
+                    })
+            else:
+                scan(child['id'], new_path, depth + 1)
+
+    scan(root_id, root_path)
+    return project_folders
+
+def collect_project_folders_from_delta(access_token, user_email, root_path):
+    """
+    デルタクエリの列挙結果だけで構造設計図書フォルダを収集（フォルダごとのHTTP呼び出しなし）
+    Returns: (project_folders, delta_link)
+    """
+    print(f"📂 フォルダ収集開始（デルタ列挙）: {root_path}")
+
+    root_id, children_by_parent, delta_link = materialize_folder_tree(access_token, user_email, root_path)
+    project_folders = find_project_folders_in_tree(children_by_parent, root_id, root_path)
+
+    print(f"✅ フォルダ収集完了: {len(project_folders)}件の案件を検出")
+    return project_folders, delta_link
+
+def drive_path_of(item):
+    """parentReference.path（/drive/root:/... 形式）からドライブルート相対のフルパスを作成（パスがなければNone）"""
+    parent_path = item.get('parentReference', {}).get('path')
+    if not parent_path or 'root:' not in parent_path:
+        return None
+    parent_path = urllib.parse.unquote(parent_path.split('root:', 1)[1]).strip('/')
+    return f"{parent_path}/{item['name']}".lstrip('/')
+
+def to_search_candidate(item):
+    """検索結果・アイテム取得結果から候補フォルダ情報を抽出"""
+    return {
+        'id': item['id'],
+        'name': item.get('name', ''),
+        'full_path': drive_path_of(item),
+        'parent_id': item.get('parentReference', {}).get('id')
+    }
+
+def search_project_folder_candidates(access_token, user_email):
+    """
+    検索API（search(q=...)）で構造設計図書フォルダの候補を取得
+    Returns: {id: 候補フォルダ情報}（ターゲットパス外のフォルダも含む）
+    """
+    headers = {"Authorization": f"Bearer {access_token}"}
+    candidates = {}
+    for keyword in SEARCH_QUERIES:
+        url = f"{GRAPH_API_BASE}/users/{user_email}/drive/root/search(q='{keyword}')"
+        for item in iter_graph_items(url, headers, timeout=30, select=SEARCH_ITEM_SELECT, top=None):
+            if 'folder' in item and is_project_folder_name(item.get('name', '')):
+                candidates.setdefault(item['id'], to_search_candidate(item))
+    return candidates
+
+def select_project_folders_from_candidates(candidates, root_path):
+    """
+    候補フォルダのパスから案件フォルダを選定
+    判定ルールはcollect_all_project_folders_asyncと同じ（サブフォルダ優先・○除外・深さ制限）
+    """
+    prefix = root_path.rstrip('/') + '/'
+    top_level = {}
+    sub_level = {}
+
+    for candidate in candidates:
+        full_path = candidate.get('full_path')
+        if not full_path or not full_path.startswith(prefix) or not is_project_folder_name(candidate['name']):
+            continue
+
+        ancestors = full_path[len(prefix):].split('/')[:-1]
+        if len(ancestors) > 10:  # 深さ制限
+            continue
+
+        project_positions = [i for i, name in enumerate(ancestors) if is_project_folder_name(name)]
+        if not project_positions:
+            top_level[full_path] = candidate
+        elif project_positions == [len(ancestors) - 1]:
+            # 構造設計図書フォルダ直下のサブフォルダ（納品時など）
+            sub_level.setdefault(full_path.rsplit('/', 1)[0], []).append(candidate)
+        # それより深い位置のフォルダはクロールでも探索されないため対象外
+
+    project_folders = []
+    for folder_path in sorted(set(top_level) | set(sub_level)):
+        parent_path = folder_path.rsplit('/', 1)[0]
+        sub_folders = sorted(sub_level.get(folder_path, []), key=lambda c: c['full_path'])
+        for sub_folder in sub_folders:
+            project_folders.append({
+                'id': sub_folder['id'],
+                'name': sub_folder['name'],
+                'path': parent_path,
+                'full_path': sub_folder['full_path']
+            })
+        if not sub_folders and folder_path in top_level:
+            folder = top_level[folder_path]
+            project_folders.append({
+                'id': folder['id'],
+                'name': folder['name'],
+                'path': parent_path,
+                'full_path': folder_path
+            })
+    return project_folders
+
+def collect_project_folders_from_search(access_token, user_email, root_path, index_path=None):
+    """
+    検索APIで構造設計図書フォルダを収集（フォルダツリーを辿らないため数回のHTTP呼び出しで完了）
+    index_pathを指定すると、フォルダツリーのインデックスと突き合わせて
+    検索インデックスへの反映遅れで漏れたフォルダを補い、パスが取得できなかった候補を補完する
+    """
+    print(f"📂 フォルダ収集開始（検索）: {root_path}")
+    headers = {"Authorization": f"Bearer {access_token}"}
+
+    candidates = search_project_folder_candidates(access_token, user_email)
+    print(f"🔍 検索結果: {len(candidates)}件の候補フォルダ")
+
+    to_verify = [c for c in candidates.values() if c['full_path'] is None]
+    if index_path and os.path.exists(index_path):
+        folder_index = FolderTreeIndex(index_path)
+        try:
+            index_only = {}
+            for folder in folder_index.iter_folders(root_path):
+                for child in folder['children']:
+                    if is_project_folder_name(child['name']) and child['id'] not in candidates:
+                        index_only.setdefault(child['id'], {
+                            'id': child['id'],
+                            'name': child['name'],
+                            'full_path': f"{folder['path']}/{child['name']}",
+                            'parent_id': folder['id']
+                        })
+        finally:
+            folder_index.close()
+        if index_only:
+            print(f"🗂️  インデックスのみに存在: {len(index_only)}件（現在の状態を確認します）")
+        to_verify += list(index_only.values())
+
+    # パス不明・インデックスのみの候補は現在のパスを$batchでまとめて確認（削除済みは除外）
+    if to_verify:
+        urls = [f"/users/{user_email}/drive/items/{c['id']}?$select=id,name,folder,parentReference" for c in to_verify]
+        for candidate, sub in zip(to_verify, graph_batch_get(urls, headers)):
+            candidates.pop(candidate['id'], None)
+            if sub.get('status') == 200 and 'folder' in sub.get('body', {}):
+                candidates[candidate['id']] = to_search_candidate(sub['body'])
+
+    project_folders = select_project_folders_from_candidates(candidates.values(), root_path)
+
+    print(f"✅ フォルダ収集完了: {len(project_folders)}件の案件を検出")
+    return project_folders
+
+def is_in_target_path(item, root_path):
+    """
+    デルタのアイテムがターゲットパス配下か（parentReference.pathで判定）
+    パスが返らない場合は判定できないためTrue（resolve_changed_project_foldersで親を辿って除外する）
+    """
+    path = drive_path_of(item)
+    if path is None:
+        return True
+    root = root_path.strip('/').casefold()
+    path = path.casefold()
+    return path == root or path.startswith(f"{root}/")
+
+def fetch_latest_delta_link(access_token, user_email):
+    """
+    現時点を起点とするドライブ全体のデルタリンクを取得（token=latestのため全件列挙は行わない）
+    リンクはドライブ単位だが、保存はターゲットパスごとのカーソル（save_delta_link）に行う
+    """
+    headers = {"Authorization": f"Bearer {access_token}"}
+    url = f"{GRAPH_API_BASE}/users/{user_email}/drive/root/delta?token=latest"
+    try:
+        response = GRAPH_CLIENT.get(url, headers=headers, timeout=30)
+        response.raise_for_status()
+        return response.json().get('@odata.deltaLink')
+    except Exception as e:
+        print(f"❌ デルタリンク取得エラー: {e}")
+        return None
+
+def fetch_drive_changes(access_token, user_email, root_path, delta_link):
+    """
+    ドライブ全体のデルタリンクを起点に前回からの変更を取得し、ターゲットパス配下の変更に絞り込む
+    Returns: (changed_items, new_delta_link) - changed_itemsは削除以外のPDFとフォルダ（取得に失敗した場合は ([], None)）
+    """
+    changed_items = []
+    new_delta_link = None
+    outside_count = 0
+    print("📍 差分取得モード: 前回からの変更のみを取得")
+
+    try:
+        for items, page_delta_link in iter_delta_pages(access_token, user_email, delta_link):
+            for item in items:
+                if 'deleted' in item:
+                    continue
+                if 'folder' not in item and not ('file' in item and item.get('name', '').lower().endswith('.pdf')):
+                    continue
+                if not is_in_target_path(item, root_path):
+                    outside_count += 1
+                    continue
+                changed_items.append(item)
+            if page_delta_link:
+                new_delta_link = page_delta_link
+
+        print(f"✅ デルタクエリ完了: {len(changed_items)}件の変更を検出（ターゲットパス外 {outside_count}件を除外）")
+        return changed_items, new_delta_link
+
+    except Exception as e:
+        print(f"❌ デルタクエリエラー: {e}")
+        return [], None
+
+def resolve_changed_project_folders(access_token, user_email, root_path, changed_items):
+    """
+    デルタクエリで検出された変更を案件フォルダに対応付け
+    - 変更されたPDFは親フォルダごとにまとめ、親から上位へ辿って最も近い構造設計図書フォルダを特定
+    - 新規追加された構造設計図書フォルダはそのまま対象にする
+    ターゲットパス外の変更や、構造設計図書フォルダ配下でない変更は除外する
+    Returns: collect_all_project_folders と同じ形式の案件フォルダ情報のリスト
+    """
+    headers = {"Authorization": f"Bearer {access_token}"}
+
+    root_url = f"{GRAPH_API_BASE}/users/{user_email}/drive/root:/{root_path}?$select=id"
+    root_response = GRAPH_CLIENT.get(root_url, headers=headers, timeout=30)
+    root_response.raise_for_status()
+    root_id = root_response.json()['id']
+
+    # デルタに含まれるフォルダは親を辿る際にそのまま使い、足りない祖先だけAPIで取得する
+    known_folders = {}
+    for item in changed_items:
+        if 'folder' in item:
+            known_folders[item['id']] = {
+                'id': item['id'],
+                'name': item['name'],
+                'parent_id': item.get('parentReference', {}).get('id')
+            }
+
+    def get_folder(folder_id):
+        if folder_id not in known_folders:
+            url = f"{GRAPH_API_BASE}/users/{user_email}/drive/items/{folder_id}?$select=id,name,parentReference"
+            try:
+                response = GRAPH_CLIENT.get(url, headers=headers, timeout=30)
+                response.raise_for_status()
+                folder = response.json()
+                known_folders[folder_id] = {
+                    'id': folder['id'],
+                    'name': folder['name'],
+                    'parent_id': folder.get('parentReference', {}).get('id')
+                }
+            except Exception as e:
+                print(f"⚠️ フォルダ情報取得エラー ({folder_id}): {e}")
+                known_folders[folder_id] = None
+        return known_folders[folder_id]
+
+    def resolve(start_id):
+        """start_idからルートまで辿り、最も近い構造設計図書フォルダの案件情報を返す"""
+        chain = []  # start_id からルート直下までのフォルダ（下から順）
+        folder_id = start_id
+        while folder_id != root_id:
+            folder = get_folder(folder_id)
+            if folder is None or folder['parent_id'] is None or len(chain) > 20:
+                return None  # ターゲットパス外
+            chain.append(folder)
+            folder_id = folder['parent_id']
+
+        names = [folder['name'] for folder in reversed(chain)]
+        for i, folder in enumerate(chain):
+            if not is_project_folder_name(folder['name']):
+                continue
+            full_path = "/".join([root_path] + names[:len(chain) - i])
+            # pathは構造設計図書フォルダ（入れ子の場合は外側）の親フォルダ
+            outer = i
+            while outer + 1 < len(chain) and is_project_folder_name(chain[outer + 1]['name']):
+                outer += 1
+            path = "/".join([root_path] + names[:len(chain) - outer - 1])
+            return {'id': folder['id'], 'name': folder['name'], 'path': path, 'full_path': full_path}
+        return None
+
+    # 変更されたPDFを親フォルダごとにまとめる
+    changed_folder_ids = []
+    for item in changed_items:
+        if 'file' in item:
+            parent_id = item.get('parentReference', {}).get('id')
+        elif is_project_folder_name(item.get('name', '')):
+            parent_id = item['id']
+        else:
+            continue
+        if parent_id and parent_id not in changed_folder_ids:
+            changed_folder_ids.append(parent_id)
+
+    print(f"\n📁 変更があったフォルダ: {len(changed_folder_ids)}件")
+
+    project_folders = []
+    seen_ids = set()
+    for folder_id in changed_folder_ids:
+        project = resolve(folder_id)
+        if project and project['id'] not in seen_ids:
+            seen_ids.add(project['id'])
+            project_folders.append(project)
+
+    print(f"✅ 変更のあった案件フォルダ: {len(project_folders)}件")
+    return project_folders
+
+def input_signature(files):
+    """解析対象PDFの組み合わせを表すキー（quickXorHashの集合。ハッシュがないファイルを含む場合はNone）"""
+    hashes = [item.get('file', {}).get('hashes', {}).get('quickXorHash') for item in files]
+    if not hashes or not all(hashes):
+        return None
+    return hashlib.sha256("\n".join(sorted(hashes)).encode("utf-8")).hexdigest()
+
+class AnalysisDedupIndex:
+    """
+    入力PDFの組み合わせごとの解析結果を、同じ実行（コレクション）内の案件間で共有するインデックス（SQLite）
+    最初の案件が解析を担当し、同じ組み合わせの案件は完了を待って結果を再利用する
+    ワーカープロセス・スレッドから同時に使えるよう、操作ごとに接続する
+    """
+
+    def __init__(self, db_path, run_id):
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        self.db_path = db_path
+        self.run_id = run_id
+        with self.connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS analyses (
+                    run_id TEXT NOT NULL,
+                    signature TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    owner_folder_id TEXT NOT NULL,
+                    result TEXT,
+                    updated_at TEXT NOT NULL,
+                    PRIMARY KEY (run_id, signature)
+                )
+            """)
+
+    def connect(self):
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    def lookup(self, signature):
+        """解析済みなら (解析結果, 解析した案件のフォルダID) を返す"""
+        with self.connect() as conn:
+            row = conn.execute(
+                "SELECT result, owner_folder_id FROM analyses WHERE run_id = ? AND signature = ? AND status = 'done'",
+                (self.run_id, signature)
+            ).fetchone()
+        return (json.loads(row[0]), row[1]) if row else None
+
+    def acquire(self, signature, folder_id, timeout=ANALYSIS_DEDUP_WAIT_TIMEOUT):
+        """
+        解析の担当を取得する
+        Returns: None=この案件が解析する / (解析結果, 解析した案件のフォルダID)=他の案件の結果を再利用
+        担当の案件が失敗・タイムアウトした場合はNoneを返し、この案件が解析する
+        中断した実行が残した担当（ANALYSIS_DEDUP_WAIT_TIMEOUTより前に更新された 'running'）は引き継いで解析する
+        """
+        deadline = time.time() + timeout
+        while True:
+            now = datetime.now(JST)
+            stale_before = (now - timedelta(seconds=ANALYSIS_DEDUP_WAIT_TIMEOUT)).isoformat()
+            with self.connect() as conn:
+                claimed = conn.execute(
+                    "INSERT OR IGNORE INTO analyses (run_id, signature, status, owner_folder_id, updated_at) VALUES (?, ?, 'running', ?, ?)",
+                    (self.run_id, signature, folder_id, now.isoformat())
+                ).rowcount
+                if not claimed:
+                    claimed = conn.execute(
+                        "UPDATE analyses SET owner_folder_id = ?, updated_at = ? "
+                        "WHERE run_id = ? AND signature = ? AND status = 'running' AND updated_at < ?",
+                        (folder_id, now.isoformat(), self.run_id, signature, stale_before)
+                    ).rowcount
+                    if claimed:
+                        print(f"   ♻️ 中断された解析の担当を引き継ぎます: {signature[:12]}")
+            if claimed:
+                return None
+
+            shared = self.lookup(signature)
+            if shared is not None:
+                return shared
+            if time.time() > deadline:
+                return None
+            time.sleep(ANALYSIS_DEDUP_POLL_INTERVAL)
+
+    def complete(self, signature, folder_id, result):
+        """解析結果を登録（待っている案件が再利用する）"""
+        with self.connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO analyses (run_id, signature, status, owner_folder_id, result, updated_at) VALUES (?, ?, 'done', ?, ?, ?)",
+                (self.run_id, signature, folder_id, json.dumps(result, ensure_ascii=False), datetime.now(JST).isoformat())
+            )
+
+    def release(self, signature, folder_id):
+        """解析に失敗した場合に担当を解除（待っている案件が代わりに解析する）"""
+        with self.connect() as conn:
+            conn.execute(
+                "DELETE FROM analyses WHERE run_id = ? AND signature = ? AND status = 'running' AND owner_folder_id = ?",
+                (self.run_id, signature, folder_id)
+            )
+
+    def prune_other_runs(self):
+        """
+        他の実行（コレクション）の行を削除し、件数を返す
+        同時に実行中の可能性がある実行（ANALYSIS_DEDUP_WAIT_TIMEOUT以内に更新された行があるもの）は残す
+        """
+        active_after = (datetime.now(JST) - timedelta(seconds=ANALYSIS_DEDUP_WAIT_TIMEOUT)).isoformat()
+        with self.connect() as conn:
+            return conn.execute(
+                "DELETE FROM analyses WHERE run_id != ? AND run_id NOT IN "
+                "(SELECT run_id FROM analyses WHERE updated_at >= ?)",
+                (self.run_id, active_after)
+            ).rowcount
+
+# プロセスごとの重複PDFインデックス（実行=コレクションごとに作成）
+ANALYSIS_DEDUP_INDEXES = {}
+
+def get_analysis_dedup_index(collection_name):
+    """重複PDFの解析共有が有効ならインデックスを返す（無効ならNone）"""
+    if not DEFAULT_ANALYSIS_DEDUP_PATH:
+        return None
+    if collection_name not in ANALYSIS_DEDUP_INDEXES:
+        ANALYSIS_DEDUP_INDEXES[collection_name] = AnalysisDedupIndex(DEFAULT_ANALYSIS_DEDUP_PATH, collection_name)
+    return ANALYSIS_DEDUP_INDEXES[collection_name]
+
+def list_project_stage(job, user_email, collection_name):
+    """
+    パイプライン: 案件フォルダのファイル一覧を取得し、解析対象のPDFを選定（登録済みならスキップ）
+    job: {'project': 案件フォルダ情報, 'access_token': トークン（Noneなら実行時に取得）}
     """
+    project_info = job['project']
+    folder_id = project_info['id']
+
+    access_token = job.get('access_token') or TOKEN_PROVIDER.get_token()
+    headers = {"Authorization": f"Bearer {access_token}"}
+
+    # フォルダの詳細情報（webUrl）とファイル一覧を1回の$batchで取得
+    folder_detail_url = f"/users/{user_email}/drive/items/{folder_id}?$select=id,webUrl"
+    folder_url = with_list_params(f"/users/{user_email}/drive/items/{folder_id}/children")
+    detail_response, children_response = graph_batch_get([folder_detail_url, folder_url], headers, timeout=60)
+    folder_detail = check_batch_response(detail_response, folder_detail_url)
+    job['folder_web_url'] = folder_detail.get('webUrl', '')
+
+    children_body = check_batch_response(children_response, folder_url)
+    items = children_body.get('value', [])
+    if children_body.get('@odata.nextLink'):
+        items += list(iter_graph_items(children_body['@odata.nextLink'], headers, timeout=60, select=None, top=None))
+
+    # ファイルを選定
+    calc_files, drawing_files, cert_file, review_file = select_project_files(items)
+
+    if not calc_files:
+        job['result'] = (False, "構造計算書PDFが見つかりません", 0.0)
+        return job
+
+    # 重複チェック（重複PDFの解析を共有した案件はlinked_file_idsに登録されている）
+    db = get_firestore_client()
+    existing_query = db.collection(collection_name).where("file_id", "==", folder_id).limit(1).stream()
+    existing_docs = list(existing_query)
+    if not existing_docs:
+        linked_query = db.collection(collection_name).where("linked_file_ids", "array_contains", folder_id).limit(1).stream()
+        existing_docs = list(linked_query)
+
+    # ルール抽出のみの再実行では、登録済みの案件だけを対象に既存ドキュメントを更新する
+    if is_rules_only():
+        if not existing_docs:
+            job['result'] = (False, "スキップ（未登録のためルール抽出の対象外）", 0.0)
+            return job
+        job['existing_doc_id'] = existing_docs[0].id
+    elif len(existing_docs) > 0:
+        existing_doc = existing_docs[0]
+        existing_data = existing_doc.to_dict()
+        existing_project_name = existing_data.get('project_name', 'N/A')
+        job['result'] = (False, f"スキップ（登録済み: {existing_project_name}）", 0.0)
+        return job
+
+    job.update({
+        'headers': headers,
+        'listed_at': time.time(),
+        'calc_files': calc_files,
+        'drawing_files': drawing_files,
+        'cert_file': cert_file,
+        'review_file': review_file,
+        'candidates': build_input_candidates(calc_files, drawing_files, cert_file, review_file),
+    })
+    job['input_signature'] = None if is_rules_only() else input_signature([item for _, item in job['candidates']])
+    return job
+
+def download_project_stage(job, user_email, collection_name):
+    """パイプライン: 構造計算書PDFを取得（キャッシュになければ一時ファイルにストリーミング）"""
+    file_data_list = []
+    candidates = job['candidates']
+    # ルール抽出のみの再実行では構造計算書だけを取得
+    if is_rules_only():
+        candidates = [(kind, item) for kind, item in candidates if kind == "calc"]
+    file_name_hints = [pdf_file['name'] for _, pdf_file in candidates]
+
+    # 同じPDFの組み合わせが解析済みならダウンロードしない
+    dedup_index = get_analysis_dedup_index(collection_name)
+    if dedup_index is not None and job.get('input_signature'):
+        shared = dedup_index.lookup(job['input_signature'])
+        if shared is not None:
+            job['shared_analysis'] = shared
+            job['file_data_list'] = []
+            job['file_name_hints'] = file_name_hints
+            return job
+    file_name_hints = []
+
+    # キュー待ちの間にトークンの期限が近づいている場合に備えて取り直す
+    if not job.get('access_token'):
+        job['headers'] = {"Authorization": f"Bearer {TOKEN_PROVIDER.get_token()}"}
+
+    # キュー待ちで一覧取得から時間が経った場合は、ダウンロードURLをまとめて再取得
+    if time.time() - job.get('listed_at', time.time()) > DOWNLOAD_URL_MAX_AGE:
+        refresh_download_urls([item for _, item in candidates], job['headers'], user_email)
+
+    try:
+        for kind, pdf_file in candidates:
+            # 構造図は縮小したページ画像に置き換える（有効な場合）
+            if kind == "drawing" and get_drawing_image_mode() != "off":
+                drawing_images = load_drawing_images(pdf_file, job['headers'], user_email)
+                if drawing_images:
+                    file_data_list.extend(drawing_images)
+                    file_name_hints.append(pdf_file['name'])
+                    continue
+            pdf_file_data = fetch_pdf(pdf_file, job['headers'], user_email)
+            if pdf_file_data is not None:
+                file_data_list.append({
+                    "file": pdf_file_data,
+                    "mime_type": "application/pdf",
+                    "name": pdf_file['name'],
+                    "kind": kind
+                })
+                file_name_hints.append(pdf_file['name'])
+    except Exception:
+        close_file_data(file_data_list)
+        raise
+
+    if not any(file_info['kind'] == "calc" for file_info in file_data_list):
+        close_file_data(file_data_list)
+        job['result'] = (False, "PDFダウンロード失敗", 0.0)
+        return job
+
+    job['file_data_list'] = file_data_list
+    job['file_name_hints'] = file_name_hints
+    return job
+
+def analyze_project_stage(job, collection_name):
+    """
+    パイプライン: Gemini APIで解析（ステージングが有効ならURIで渡す）
+    同じPDFの組み合わせを他の案件が解析済み・解析中の場合は、その結果を再利用する
+    """
+    file_data_list = job.pop('file_data_list')
+    folder_id = job['project']['id']
+    signature = job.get('input_signature')
+    dedup_index = get_analysis_dedup_index(collection_name) if signature else None
+    analysis_result = None
+    elapsed = 0.0
+    try:
+        shared = job.pop('shared_analysis', None)
+        if shared is None and dedup_index is not None:
+            shared = dedup_index.acquire(signature, folder_id)
+
+        if shared is not None:
+            analysis_result, job['shared_from'] = shared
+        elif is_rules_only():
+            # テキストレイヤーのルール抽出のみ（Geminiは呼ばない）
+            start_time = time.time()
+            rule_fields = extract_rule_fields(file_data_list)
+            elapsed = time.time() - start_time
+            if not rule_fields:
+                job['result'] = (False, "ルール抽出で確定できる項目がありません", elapsed)
+                return job
+            analysis_result = apply_rule_fields({}, rule_fields)
+        else:
+            try:
+                # 計算ソフト・作成年月・計算ルートはテキストレイヤーから抽出（確定した項目はGeminiに依頼しない）
+                rule_fields = extract_rule_fields(file_data_list)
+
+                # 関連ページのみに絞る（テキストレイヤーのキーワード採点）
+                prune_file_data(file_data_list)
+
+                # 優先度順にトークン予算内で送信するファイルを選ぶ（除外したファイルは閉じる）
+                file_data_list = pack_file_data(file_data_list)
+                job['packed_count'] = len(file_data_list)
+                job['file_name_hints'] = file_names(file_data_list)
+
+                # ステージングが有効ならCloud StorageにアップロードしてURIで渡す（リトライ時も再送しない）
+                stage_file_data(file_data_list)
+
+                # Gemini APIで解析（積極的なリトライ）
+                start_time = time.time()
+                if use_map_reduce(file_data_list):
+                    analysis_result = analyze_map_reduce(file_data_list, job['file_name_hints'], rule_fields=rule_fields)
+                else:
+                    analysis_result = analyze_with_gemini_with_retry(
+                        file_data_list, job['file_name_hints'], rule_fields=rule_fields
+                    )
+                elapsed = time.time() - start_time
+            finally:
+                if dedup_index is not None:
+                    if analysis_result:
+                        dedup_index.complete(signature, folder_id, analysis_result)
+                    else:
+                        dedup_index.release(signature, folder_id)
+    finally:
+        close_file_data(file_data_list)
+
+    del file_data_list
+    gc.collect()
+
+    if not analysis_result:
+        job['result'] = (False, "AI解析失敗", elapsed)
+        return job
+
+    job['analysis_result'] = analysis_result
+    job['elapsed'] = elapsed
+    return job
+
+def persist_rule_fields(job, collection_name):
+    """ルール抽出のみの再実行: 既存ドキュメントの該当項目と抽出元だけを更新"""
+    analysis_result = job['analysis_result']
+    field_sources = analysis_result.get("fieldSources", {})
+    other = analysis_result.get("other", {})
+    legal_technical = analysis_result.get("legalTechnical", {})
+
+    update_data = {"field_sources": field_sources, "rules_extracted_at": datetime.now(JST).isoformat()}
+    if "software" in other:
+        update_data["software"] = other["software"]
+    if "calcBookDate" in other:
+        update_data["calc_book_date"] = other["calcBookDate"]
+    if "structuralCalcRoute" in legal_technical:
+        update_data["structural_calc_route"] = legal_technical["structuralCalcRoute"]
+
+    db = get_firestore_client()
+    db.collection(collection_name).document(job['existing_doc_id']).set(update_data, merge=True)
+
+    job['result'] = (True, f"成功: ルール抽出 {len(field_sources)}項目を更新", job['elapsed'])
+    return job
+
+def persist_project_stage(job, collection_name):
+    """パイプライン: 解析結果をFirestoreに保存"""
+    if job.get('existing_doc_id'):
+        return persist_rule_fields(job, collection_name)
+
+    project_info = job['project']
     folder_id = project_info['id']
     folder_name = project_info['name']
     full_path = project_info['full_path']
+    analysis_result = job['analysis_result']
+    folder_web_url = job['folder_web_url']
+    calc_files = job['calc_files']
+    drawing_files = job['drawing_files']
+    cert_file = job['cert_file']
+    review_file = job['review_file']
+
+    # フォルダ名から作成年月を抽出
+    created_year_month = None
+    date_match = re.match(r'^(\d{4})(\d{2})\d{2}', folder_name)
+    if date_match:
+        year = date_match.group(1)
+        month = date_match.group(2).lstrip('0')
+        created_year_month = f"{year}年{month}月"
+
+    # プロジェクト名を抽出
+    project_name = None
+    path_parts = full_path.split('/')
+    if len(path_parts) >= 5:
+        last_part = path_parts[-1]
+        if not re.match(r'^\d{4,7}_', last_part):
+            project_name = last_part
+        elif len(path_parts) >= 6:
+            number_folder = last_part
+            name_match = re.match(r'^\d{4,7}_(.+?)(?:／|$)', number_folder)
+            if name_match:
+                project_name = name_match.group(1)
+
+    # フォルダパスからメタデータ抽出
+    metadata = extract_project_metadata(full_path)
+
+    # 解析結果を取得
+    basic = analysis_result.get("basic", {})
+    legal_technical = analysis_result.get("legalTechnical", {})
+    project_conditions = analysis_result.get("projectConditions", {})
+    other = analysis_result.get("other", {})
+
+    # Firestoreに保存
+    # Firestoreルール: ドキュメントIDは物件名をそのまま使用（特殊文字のみ置換）
+    doc_id = (other.get("projectName", project_name) or "不明物件").replace("/", "-").replace(":", "-")
+
+    # 取引先名をフォルダパスから抽出
+    client_name = metadata['clientName'] or ""
+
+    save_data = {
+        # 基本情報
+        "structure_type": basic.get("structureType", ""),
+        "primary_use": basic.get("primaryUse", ""),
+        "floors": basic.get("floors", ""),
+        "total_floor_area": basic.get("totalFloorArea", ""),
+
+        # 法律・技術的要件
+        "performance_requirements": legal_technical.get("performanceRequirements", []),
+        "structural_calc_route": legal_technical.get("structuralCalcRoute", ""),
+        "route_reasoning": legal_technical.get("routeReasoning", ""),
+        "foundation_type": legal_technical.get("foundationType", ""),
+        "design_features": legal_technical.get("designFeatures", []),
+        "lateral_resistance": legal_technical.get("lateralResistance", []),
+
+        # プロジェクトの条件
+        "regional_conditions": project_conditions.get("regionalConditions", []),
+        "ground_condition": project_conditions.get("groundCondition", ""),
+        "client_name": client_name,
+        "inspection_agency": project_conditions.get("inspectionAgency", ""),
+
+        # その他
+        "project_summary": other.get("projectSummary", ""),
+        "project_name": other.get("projectName", project_name or ""),
+        "calc_book_date": other.get("calcBookDate", created_year_month or ""),
+        "software": other.get("software", ""),
+
+        # メタデータ
+        "folder_url": folder_web_url,
+        "extracted_at": datetime.now(JST).isoformat(),
+        "file_id": folder_id,
+        "folder_name": folder_name,
+        "folder_path": full_path,
+        "file_count": {
+            "calc": len(calc_files),
+            "drawing": len(drawing_files),
+            "cert": 1 if cert_file else 0,
+            "review": 1 if review_file else 0
+        },
+
+        # 各項目の抽出元（"rule": テキストレイヤーの正規表現 / "model": Gemini）
+        "field_sources": analysis_result.get("fieldSources", {}),
+
+        # 生の解析結果を保存（デバッグ用）
+        "raw_analysis_result": analysis_result,
+
+        "analysis_shared_from": job.get('shared_from', "")
+    }
 
-    headers = {"Authorization": f"Bearer {access_token}"}
+    db = get_firestore_client()
+    doc_ref = db.collection(collection_name).document(doc_id)
+    # 解析結果はドキュメント全体を上書きする（前回の解析結果のキーや、物件名が同じ別案件の内容を残さない）
+    # 同じPDFを含む案件フォルダ（解析を共有した場合）は、同じ解析元のドキュメントに書き込まれていればlinked_file_idsに引き継ぐ
+    analysis_source = job.get('shared_from') or folder_id
+
+    @firestore.transactional
+    def write_document(transaction):
+        linked_file_ids = [folder_id]
+        snapshot = doc_ref.get(transaction=transaction)
+        if snapshot.exists:
+            previous = snapshot.to_dict()
+            if (previous.get("analysis_shared_from") or previous.get("file_id")) == analysis_source:
+                linked_file_ids = list(dict.fromkeys(previous.get("linked_file_ids", []) + linked_file_ids))
+        transaction.set(doc_ref, dict(save_data, linked_file_ids=linked_file_ids))
+
+    write_document(db.transaction())
+
+    if job.get('shared_from'):
+        job['result'] = (True, f"成功: 重複PDFのため解析結果を共有（解析元: {job['shared_from']}）", job['elapsed'])
+    else:
+        job['result'] = (True, f"成功: {job.get('packed_count', len(calc_files))}ファイル解析", job['elapsed'])
+    return job
+
+def process_single_project(project_info: Dict, access_token: Optional[str], user_email: str, collection_name: str) -> Tuple[bool, str, float]:
+    """
+    単一の案件フォルダを処理（並列実行される）
+    各プロセスが独立したレート制限枠を持つ
+    access_tokenがNoneの場合は、実行時点でTOKEN_PROVIDERから有効なトークンを取得する
+    パイプラインの各ステージ（一覧取得 → ダウンロード → 解析 → 保存）を順に実行する
+    """
+    throttled_before = GRAPH_CLIENT.throttled_count
 
     try:
         # 処理開始時にランダムな初期遅延を入れて、リクエストを分散
         initial_delay = random.uniform(0, 2.0)
         time.sleep(initial_delay)
 
-        # フォルダの詳細情報とwebUrlを取得
-        folder_detail_url = f"https://graph.microsoft.com/v1.0/users/{user_email}/drive/items/{folder_id}"
-        folder_detail_response = requests.get(folder_detail_url, headers=headers, timeout=30)
-        folder_detail_response.raise_for_status()
-        folder_detail = folder_detail_response.json()
-        folder_web_url = folder_detail.get('webUrl', '')
-
-        # フォルダ内のファイル一覧を取得
-        folder_url = f"https://graph.microsoft.com/v1.0/users/{user_email}/drive/items/{folder_id}/children"
-        response = requests.get(folder_url, headers=headers, timeout=60)
-        response.raise_for_status()
-        items = response.json().get('value', [])
-
-        # ファイルを選定
-        calc_files, drawing_files, cert_file, review_file = select_project_files(items)
-
-        if not calc_files:
-            return False, f"構造計算書PDFが見つかりません", 0.0
-
-        # 重複チェック
-        db = firestore.Client(project=GCP_PROJECT_ID, database="uplan")
-        existing_query = db.collection(collection_name).where("file_id", "==", folder_id).limit(1).stream()
-        existing_docs = list(existing_query)
-
-        if len(existing_docs) > 0:
-            existing_doc = existing_docs[0]
-            existing_data = existing_doc.to_dict()
-            existing_project_name = existing_data.get('project_name', 'N/A')
-            return False, f"スキップ（登録済み: {existing_project_name}）", 0.0
-
-        # フォルダ名から作成年月を抽出
-        created_year_month = None
-        date_match = re.match(r'^(\d{4})(\d{2})\d{2}', folder_name)
-        if date_match:
-            year = date_match.group(1)
-            month = date_match.group(2).lstrip('0')
-            created_year_month = f"{year}年{month}月"
-
-        # プロジェクト名を抽出
-        project_name = None
-        path_parts = full_path.split('/')
-        if len(path_parts) >= 5:
-            last_part = path_parts[-1]
-            if not re.match(r'^\d{4,7}_', last_part):
-                project_name = last_part
-            elif len(path_parts) >= 6:
-                number_folder = last_part
-                name_match = re.match(r'^\d{4,7}_(.+?)(?:／|$)', number_folder)
-                if name_match:
-                    project_name = name_match.group(1)
-
-        # PDFをダウンロード
-        file_data_list = []
-        file_name_hints = []
-
-        for pdf_file in calc_files[:5]:
-            download_url = pdf_file.get('@microsoft.graph.downloadUrl')
-            if download_url:
-                pdf_response = requests.get(download_url, timeout=120)
-                if pdf_response.status_code == 200:
-                    file_data_list.append({
-                        "data": pdf_response.content,
-                        "mime_type": "application/pdf",
-                        "name": pdf_file['name']
-                    })
-                    file_name_hints.append(pdf_file['name'])
-
-        if not file_data_list:
-            return False, "PDFダウンロード失敗", 0.0
-
-        # Gemini APIで解析（積極的なリトライ）
-        start_time = time.time()
-        analysis_result = analyze_with_gemini_with_retry(file_data_list, file_name_hints)
-        elapsed = time.time() - start_time
-
-        del file_data_list
-        gc.collect()
-
-        if not analysis_result:
-            return False, "AI解析失敗", elapsed
-
-        # フォルダパスからメタデータ抽出
-        metadata = extract_project_metadata(full_path)
-
-        # 解析結果を取得
-        basic = analysis_result.get("basic", {})
-        legal_technical = analysis_result.get("legalTechnical", {})
-        project_conditions = analysis_result.get("projectConditions", {})
-        other = analysis_result.get("other", {})
-
-        # Firestoreに保存
-        # Firestoreルール: ドキュメントIDは物件名をそのまま使用（特殊文字のみ置換）
-        doc_id = (other.get("projectName", project_name) or "不明物件").replace("/", "-").replace(":", "-")
-
-        # 取引先名をフォルダパスから抽出
-        client_name = metadata['clientName'] or ""
-
-        save_data = {
-            # 基本情報
-            "structure_type": basic.get("structureType", ""),
-            "primary_use": basic.get("primaryUse", ""),
-            "floors": basic.get("floors", ""),
-            "total_floor_area": basic.get("totalFloorArea", ""),
-
-            # 法律・技術的要件
-            "performance_requirements": legal_technical.get("performanceRequirements", []),
-            "structural_calc_route": legal_technical.get("structuralCalcRoute", ""),
-            "route_reasoning": legal_technical.get("routeReasoning", ""),
-            "foundation_type": legal_technical.get("foundationType", ""),
-            "design_features": legal_technical.get("designFeatures", []),
-            "lateral_resistance": legal_technical.get("lateralResistance", []),
-
-            # プロジェクトの条件
-            "regional_conditions": project_conditions.get("regionalConditions", []),
-            "ground_condition": project_conditions.get("groundCondition", ""),
-            "client_name": client_name,
-            "inspection_agency": project_conditions.get("inspectionAgency", ""),
-
-            # その他
-            "project_summary": other.get("projectSummary", ""),
-            "project_name": other.get("projectName", project_name or ""),
-            "calc_book_date": other.get("calcBookDate", created_year_month or ""),
-            "software": other.get("software", ""),
-
-            # メタデータ
-            "folder_url": folder_web_url,
-            "extracted_at": datetime.now(JST).isoformat(),
-            "file_id": folder_id,
-            "folder_name": folder_name,
-            "folder_path": full_path,
-            "file_count": {
-                "calc": len(calc_files),
-                "drawing": len(drawing_files),
-                "cert": 1 if cert_file else 0,
-                "review": 1 if review_file else 0
-            },
-
-            # 生の解析結果を保存（デバッグ用）
-            "raw_analysis_result": analysis_result
-        }
-
-        collection_ref = db.collection(collection_name)
-        collection_ref.document(doc_id).set(save_data)
+        job = {'project': project_info, 'access_token': access_token}
+        stages = [
+            lambda job: list_project_stage(job, user_email, collection_name),
+            lambda job: download_project_stage(job, user_email, collection_name),
+            lambda job: analyze_project_stage(job, collection_name),
+            lambda job: persist_project_stage(job, collection_name),
+        ]
+        for stage in stages:
+            job = stage(job)
+            if 'result' in job:
+                break
 
-        return True, f"成功: {len(calc_files)}ファイル解析", elapsed
+        success, message, elapsed = job['result']
+        throttled = GRAPH_CLIENT.throttled_count - throttled_before
+        if success and throttled:
+            message += f" (Graphスロットリング {throttled}回)"
+        return success, message, elapsed
 
     except Exception as e:
         return False, f"エラー: {str(e)[:100]}", 0.0
@@ -546,23 +3186,27 @@ def process_projects_parallel(project_folders: List[Dict], max_workers: int, col
     """
     複数の案件フォルダを並列処理
     各ワーカーが独立したプロセスで実行されるため、レート制限が分散される
+    Returns: 失敗した案件フォルダのリスト（認証失敗などで処理できなかった場合はNone）
     """
     print(f"\n🚀 並列処理開始: {len(project_folders)}件を{max_workers}並列で処理")
     print(f"💡 レート制限対策: 各ワーカーが独立したレート制限枠を持ちます")
 
+    # 認証を事前に確認（取得したトークンは共有キャッシュに書き出され、ワーカーが読み込む）
     token = get_access_token()
     if not token:
         print("❌ 認証失敗")
-        return
+        return None
 
     success_count = 0
     error_count = 0
     skipped_count = 0
     total_elapsed = 0.0
+    failed_projects = []
 
-    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=init_worker) as executor:
+        # トークンは渡さず、各タスクが実行時に有効期限を確認して取得する（長時間実行での401を防ぐ）
         future_to_project = {
-            executor.submit(process_single_project, project, token, TARGET_USER_EMAIL, collection_name): project
+            executor.submit(process_single_project, project, None, TARGET_USER_EMAIL, collection_name): project
             for project in project_folders
         }
 
@@ -580,10 +3224,12 @@ def process_projects_parallel(project_folders: List[Dict], max_workers: int, col
                     print(f"⏭️  [{success_count + error_count + skipped_count}/{len(project_folders)}] {project['name']}: {message}")
                 else:
                     error_count += 1
+                    failed_projects.append(project)
                     print(f"❌ [{success_count + error_count + skipped_count}/{len(project_folders)}] {project['name']}: {message}")
 
             except Exception as e:
                 error_count += 1
+                failed_projects.append(project)
                 print(f"❌ [{success_count + error_count + skipped_count}/{len(project_folders)}] {project['name']}: 例外 - {str(e)[:100]}")
 
     avg_time = total_elapsed / success_count if success_count > 0 else 0
@@ -591,11 +3237,586 @@ def process_projects_parallel(project_folders: List[Dict], max_workers: int, col
     print(f"\n📊 処理完了: 成功 {success_count}件 / スキップ {skipped_count}件 / エラー {error_count}件 / 合計 {len(project_folders)}件")
     print(f"⏱️  平均処理時間: {avg_time:.1f}秒/件")
     print(f"⏱️  総処理時間: {total_elapsed:.1f}秒 ({total_elapsed/60:.1f}分)")
+    return failed_projects
+
+# パイプラインの終了マーカー
+PIPELINE_DONE = object()
+
+def run_stage_pipeline(source, stages, on_result, queue_size=PIPELINE_QUEUE_SIZE):
+    """
+    有界キューでつないだステージをスレッドで並行実行する
+    source: ジョブを順にyieldするイテラブル（探索ステージ）
+    stages: [(ステージ名, 関数, 同時実行数)]。関数はジョブを受け取り、次のステージへ渡すジョブを返す
+            ジョブに 'result'（(success, message, elapsed)）が設定された時点でそのジョブは完了
+    on_result: 完了したジョブを受け取るコールバック（呼び出しは直列化される）
+    """
+    queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+    result_lock = threading.Lock()
+
+    def finish(job):
+        with result_lock:
+            on_result(job)
+
+    def feed():
+        try:
+            for job in source:
+                queues[0].put(job)
+        except Exception as e:
+            print(f"⚠️ 案件フォルダの探索エラー: {e}")
+        finally:
+            for _ in range(stages[0][2]):
+                queues[0].put(PIPELINE_DONE)
+
+    def make_worker(index, remaining):
+        name, func, _ = stages[index]
+
+        def work():
+            try:
+                while True:
+                    job = queues[index].get()
+                    if job is PIPELINE_DONE:
+                        break
+                    try:
+                        job = func(job)
+                    except Exception as e:
+                        job['result'] = (False, f"エラー（{name}）: {str(e)[:100]}", 0.0)
+
+                    try:
+                        if 'result' in job:
+                            finish(job)
+                        elif index + 1 < len(stages):
+                            queues[index + 1].put(job)
+                        else:
+                            job['result'] = (False, "処理結果なし", 0.0)
+                            finish(job)
+                    except Exception as e:
+                        print(f"⚠️ パイプライン結果処理エラー（{name}）: {e}")
+            finally:
+                # 最後のワーカーが終了したら次のステージに終了を伝える（例外で抜けた場合も後続が止まらないようにする）
+                with remaining['lock']:
+                    remaining['count'] -= 1
+                    last = remaining['count'] == 0
+                if last and index + 1 < len(stages):
+                    for _ in range(stages[index + 1][2]):
+                        queues[index + 1].put(PIPELINE_DONE)
+
+        return work
+
+    threads = [threading.Thread(target=feed, name="discover", daemon=True)]
+    for index, (name, _, workers) in enumerate(stages):
+        remaining = {'count': workers, 'lock': threading.Lock()}
+        for worker_index in range(workers):
+            threads.append(threading.Thread(target=make_worker(index, remaining), name=f"{name}-{worker_index}", daemon=True))
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+def process_projects_pipelined(project_source, max_workers: int, collection_name: str,
+                               list_workers: int = DEFAULT_LIST_WORKERS,
+                               download_workers: int = DEFAULT_DOWNLOAD_WORKERS,
+                               persist_workers: int = DEFAULT_PERSIST_WORKERS):
+    """
+    案件フォルダをパイプライン（探索 → 一覧取得 → ダウンロード → 解析 → 保存）で処理
+    ステージごとに同時実行数を設定し、Gemini解析中に次の案件のダウンロードを進める
+    project_sourceはリストのほか、探索中の案件を順にyieldするイテラブルでもよい（検出した案件から処理を開始）
+    解析ステージの同時実行数はmax_workers
+    Returns: 失敗した案件フォルダのリスト（認証失敗などで処理できなかった場合はNone）
+    """
+    print(f"\n🚀 パイプライン処理開始: 一覧取得{list_workers} / ダウンロード{download_workers} / 解析{max_workers} / 保存{persist_workers}並列")
+
+    # 認証を事前に確認（各ステージは実行時にTOKEN_PROVIDERから有効なトークンを取得）
+    if not get_access_token():
+        print("❌ 認証失敗")
+        return None
+
+    counts = {'success': 0, 'skipped': 0, 'error': 0}
+    total_elapsed = 0.0
+    failed_projects = []
+
+    def on_result(job):
+        nonlocal total_elapsed
+        success, message, elapsed = job['result']
+        total_elapsed += elapsed
+        name = job['project']['name']
+        if success:
+            counts['success'] += 1
+            print(f"✅ [{sum(counts.values())}] {name}: {message} ({elapsed:.1f}秒)")
+        elif "スキップ" in message:
+            counts['skipped'] += 1
+            print(f"⏭️  [{sum(counts.values())}] {name}: {message}")
+        else:
+            counts['error'] += 1
+            failed_projects.append(job['project'])
+            print(f"❌ [{sum(counts.values())}] {name}: {message}")
+
+    stages = [
+        ("list", lambda job: list_project_stage(job, TARGET_USER_EMAIL, collection_name), list_workers),
+        ("download", lambda job: download_project_stage(job, TARGET_USER_EMAIL, collection_name), download_workers),
+        ("analyze", lambda job: analyze_project_stage(job, collection_name), max_workers),
+        ("persist", lambda job: persist_project_stage(job, collection_name), persist_workers),
+    ]
+    run_stage_pipeline(({'project': project} for project in project_source), stages, on_result)
+
+    total = sum(counts.values())
+    avg_time = total_elapsed / counts['success'] if counts['success'] > 0 else 0
+    print(f"\n📊 処理完了: 成功 {counts['success']}件 / スキップ {counts['skipped']}件 / エラー {counts['error']}件 / 合計 {total}件")
+    print(f"⏱️  平均解析時間: {avg_time:.1f}秒/件")
+    print(f"⏱️  総解析時間: {total_elapsed:.1f}秒 ({total_elapsed/60:.1f}分)")
+    return failed_projects
+
+def local_batch_stub_response(request):
+    """LocalBatchPredictionJobのデフォルト応答（空のJSON。オフライン検証用）"""
+    return {"candidates": [{"content": {"role": "model", "parts": [{"text": "```json\n{}\n```"}]}, "finishReason": "STOP"}]}
+
+class LocalBatchPredictionJob:
+    """
+    BatchPredictionJobのローカル代替（file:// のJSONLを読み、Vertex AIと同じ形式の結果JSONLを書き出す）
+    --mode batch の経路をオフラインで検証するため、ステージング先が file:// の場合に使用
+    refresh()のたびに PENDING → RUNNING → SUCCEEDED と進み、応答は responder(request) で作成する
+    """
+
+    responder = staticmethod(local_batch_stub_response)
+
+    def __init__(self, input_dataset, output_uri_prefix):
+        self.input_dataset = input_dataset
+        self.output_uri_prefix = output_uri_prefix
+        self.state = "JOB_STATE_PENDING"
+        self.output_location = None
+        self.error = None
+
+    @classmethod
+    def submit(cls, source_model, input_dataset, output_uri_prefix):
+        """ジョブを作成（実際の処理はrefresh()で行う）"""
+        return cls(input_dataset, output_uri_prefix)
+
+    @classmethod
+    def resume(cls, input_dataset, output_uri_prefix):
+        """投入済みのジョブを再開（結果が書き出し済みなら完了状態で返す）"""
+        job = cls(input_dataset, output_uri_prefix)
+        if os.path.exists(os.path.join(output_uri_prefix[len("file://"):], "predictions.jsonl")):
+            job.output_location = output_uri_prefix
+            job.state = "JOB_STATE_SUCCEEDED"
+        else:
+            job.state = "JOB_STATE_RUNNING"
+        return job
+
+    @property
+    def resource_name(self):
+        return f"local:{self.output_uri_prefix}"
+
+    @property
+    def has_ended(self):
+        return self.state in ("JOB_STATE_SUCCEEDED", "JOB_STATE_FAILED")
+
+    @property
+    def has_succeeded(self):
+        return self.state == "JOB_STATE_SUCCEEDED"
+
+    def refresh(self):
+        """ジョブの状態を進める（RUNNINGの次の確認で全リクエストを処理）"""
+        if self.state == "JOB_STATE_PENDING":
+            self.state = "JOB_STATE_RUNNING"
+            return
+        if self.state != "JOB_STATE_RUNNING":
+            return
+        try:
+            output_dir = self.output_uri_prefix[len("file://"):]
+            os.makedirs(output_dir, exist_ok=True)
+            with open(self.input_dataset[len("file://"):], encoding="utf-8") as src, \
+                 open(os.path.join(output_dir, "predictions.jsonl"), "w", encoding="utf-8") as dst:
+                for line in src:
+                    if not line.strip():
+                        continue
+                    record = json.loads(line)
+                    output = {"status": "", "processed_time": datetime.now(timezone.utc).isoformat(),
+                              "request": record["request"]}
+                    try:
+                        output["response"] = self.responder(record["request"])
+                    except Exception as e:
+                        output["status"] = str(e)
+                    dst.write(json.dumps(output, ensure_ascii=False) + "\n")
+            self.output_location = self.output_uri_prefix
+            self.state = "JOB_STATE_SUCCEEDED"
+        except Exception as e:
+            self.error = e
+            self.state = "JOB_STATE_FAILED"
+
+def submit_batch_job(input_uri, output_uri_prefix):
+    """バッチ予測ジョブを投入（file:// ならローカル代替、gs:// ならVertex AI）"""
+    if input_uri.startswith("file://"):
+        return LocalBatchPredictionJob.submit(BATCH_GEMINI_MODEL_NAME, input_uri, output_uri_prefix)
+    vertexai.init(project=GCP_PROJECT_ID, location=LOCATION)
+    return BatchPredictionJob.submit(
+        source_model=BATCH_GEMINI_MODEL_NAME,
+        input_dataset=input_uri,
+        output_uri_prefix=output_uri_prefix
+    )
+
+def get_batch_job(manifest):
+    """マニフェストに保存したジョブを取得（file:// ならローカル代替を再開、gs:// ならVertex AIのジョブ名から取得）"""
+    if manifest['input_uri'].startswith("file://"):
+        return LocalBatchPredictionJob.resume(manifest['input_uri'], manifest['output_uri_prefix'])
+    vertexai.init(project=GCP_PROJECT_ID, location=LOCATION)
+    return BatchPredictionJob(manifest['job_name'])
+
+def is_stub_batch_job(batch_job):
+    """ローカル代替のデフォルト応答（空のJSON）で処理するジョブか（結果をFirestoreに保存しない）"""
+    return isinstance(batch_job, LocalBatchPredictionJob) and batch_job.responder is local_batch_stub_response
+
+def wait_for_batch_job(batch_job, poll_interval, wait_minutes):
+    """
+    ジョブの完了をポーリングで待つ
+    Returns: 完了したらTrue、wait_minutes分を過ぎても終わらなければFalse（ジョブはそのまま実行を続ける）
+    """
+    start_time = time.time()
+    deadline = start_time + wait_minutes * 60
+    while True:
+        batch_job.refresh()
+        if batch_job.has_ended:
+            return True
+        if time.time() >= deadline:
+            return False
+        print(f"   ⏳ {batch_job.state}（経過 {(time.time() - start_time) / 60:.1f}分）")
+        time.sleep(poll_interval)
+
+def batch_key(folder_id):
+    """案件フォルダIDからバッチリクエストのキーを作成（labelsの値に使える小文字英数字）"""
+    return hashlib.sha256(folder_id.encode("utf-8")).hexdigest()[:32]
+
+def to_batch_part(item):
+    """build_analysis_inputsの要素をバッチリクエストのpart（JSON）に変換"""
+    if isinstance(item, str):
+        return {"text": item}
+    if "uri" in item:
+        return {"fileData": {"fileUri": item["uri"], "mimeType": item["mime_type"]}}
+    return {"inlineData": {"mimeType": item["mime_type"],
+                           "data": base64.b64encode(read_file_data(item)).decode("ascii")}}
+
+def build_batch_request(key, inputs):
+    """バッチ予測のJSONL1行分（GenerateContentRequest）を作成"""
+    generation_config = {
+        re.sub(r"_([a-z])", lambda m: m.group(1).upper(), name): value
+        for name, value in GENERATION_CONFIG.items()
+    }
+    return {
+        "request": {
+            "contents": [{"role": "user", "parts": [to_batch_part(item) for item in inputs]}],
+            "generationConfig": generation_config,
+            "labels": {BATCH_KEY_LABEL: key}
+        }
+    }
+
+def parse_batch_output(record):
+    """
+    バッチ予測の結果1行から解析結果を取り出す
+    Returns: (解析結果 または None, エラーメッセージ)
+    """
+    if record.get("status"):
+        return None, f"バッチ予測エラー: {str(record['status'])[:100]}"
+    try:
+        parts = record["response"]["candidates"][0]["content"]["parts"]
+        result = parse_json_response("".join(part.get("text", "") for part in parts))
+    except (KeyError, IndexError, json.JSONDecodeError) as e:
+        return None, f"バッチ予測の応答を解析できません: {str(e)[:80]}"
+    if not isinstance(result, dict):
+        return None, "バッチ予測の応答がJSONオブジェクトではありません"
+    return result, ""
+
+def prepare_batch_stage(job, collection_name):
+    """
+    バッチ: 解析リクエスト（JSONLの1行）を作成
+    ルール抽出・ページ抽出・トークン予算の選定はオンラインと同じ。PDFはステージングしてURIで参照する
+    """
+    file_data_list = job.pop('file_data_list')
+    try:
+        shared = job.pop('shared_analysis', None)
+        if shared is not None:
+            # 以前の実行で同じPDFの組み合わせを解析済み
+            job['analysis_result'], job['shared_from'] = shared
+        else:
+            rule_fields = extract_rule_fields(file_data_list)
+            prune_file_data(file_data_list)
+            file_data_list = pack_file_data(file_data_list)
+            stage_file_data(file_data_list)
+            job['rule_fields'] = rule_fields
+            job['packed_count'] = len(file_data_list)
+            job['batch_key'] = batch_key(job['project']['id'])
+            inputs = build_analysis_inputs(file_data_list, file_names(file_data_list), rule_fields)
+            job['batch_request'] = build_batch_request(job['batch_key'], inputs)
+    finally:
+        close_file_data(file_data_list)
+
+    job['result'] = (True, "バッチリクエスト作成", 0.0)
+    return job
+
+def report_batch_job(job, counts, failed_projects):
+    """バッチ: 案件1件の結果を表示して集計（失敗した案件はfailed_projectsに追加）"""
+    success, message, elapsed = job['result']
+    name = job['project']['name']
+    if success:
+        counts['success'] += 1
+        print(f"✅ [{sum(counts.values())}] {name}: {message}")
+    elif "スキップ" in message:
+        counts['skipped'] += 1
+        print(f"⏭️  [{sum(counts.values())}] {name}: {message}")
+    else:
+        counts['error'] += 1
+        failed_projects.append(job['project'])
+        print(f"❌ [{sum(counts.values())}] {name}: {message}")
+
+def batch_manifest_job(job):
+    """
+    バッチ: 保存に必要な案件の情報をマニフェスト（JSON）に書ける形で取り出す
+    ファイル一覧は件数のみ使うため名前だけ残す。共有先の案件はbatch_primary_keyで解析元を参照する
+    """
+    entry = {key: job.get(key) for key in
+             ('folder_web_url', 'rule_fields', 'batch_key', 'input_signature', 'packed_count', 'analysis_result', 'shared_from')}
+    entry['project'] = {key: job['project'].get(key) for key in ('id', 'name', 'path', 'full_path')}
+    entry['calc_files'] = [item['name'] for item in job['calc_files']]
+    entry['drawing_files'] = [item['name'] for item in job['drawing_files']]
+    entry['cert_file'] = job['cert_file']['name'] if job.get('cert_file') else None
+    entry['review_file'] = job['review_file']['name'] if job.get('review_file') else None
+    if job.get('batch_primary'):
+        entry['batch_primary_key'] = job['batch_primary']['batch_key']
+    return entry
+
+def process_projects_batch(project_source, max_workers: int, collection_name: str,
+                           list_workers: int = DEFAULT_LIST_WORKERS,
+                           download_workers: int = DEFAULT_DOWNLOAD_WORKERS,
+                           persist_workers: int = DEFAULT_PERSIST_WORKERS,
+                           poll_interval: float = BATCH_POLL_INTERVAL,
+                           wait_minutes: float = BATCH_WAIT_MINUTES,
+                           delta_cursor: Optional[Dict] = None,
+                           persist_stage=None):
+    """
+    案件フォルダをVertex AIのバッチ予測で処理（オンラインのレート制限枠を使わない大量バックフィル用）
+    1. 一覧取得 → ダウンロード → リクエスト作成 をパイプラインで実行し、案件ごとに1行のJSONLを作成
+    2. ジョブ名・案件の対応・デルタカーソルをマニフェストに保存してからジョブを投入し、最大wait_minutes分ポーリング
+    3. 完了したら collect_batch_run で結果を保存。時間内に終わらなければ、--batch-collect で後から回収する
+    同じPDFの組み合わせの案件は1リクエストにまとめ、結果を共有する
+    Returns: 失敗した案件フォルダのリスト（認証失敗・ジョブ失敗・回収待ちの場合はNone。デルタリンクを進めない）
+    """
+    stager = get_pdf_stager()
+    if stager is None:
+        print("❌ バッチモードには --staging-bucket の指定が必要です（PDFをURIで参照するため）")
+        return None
+
+    print(f"\n🚀 バッチリクエスト作成開始: 一覧取得{list_workers} / ダウンロード{download_workers} / リクエスト作成{max_workers}並列")
+
+    if not get_access_token():
+        print("❌ 認証失敗")
+        return None
+
+    counts = {'success': 0, 'skipped': 0, 'error': 0}
+    prepared = []
+    failed_projects = []
+
+    def on_prepared(job):
+        if job['result'][0] and ('batch_request' in job or 'analysis_result' in job):
+            prepared.append(job)
+        else:
+            report_batch_job(job, counts, failed_projects)
+
+    stages = [
+        ("list", lambda job: list_project_stage(job, TARGET_USER_EMAIL, collection_name), list_workers),
+        ("download", lambda job: download_project_stage(job, TARGET_USER_EMAIL, collection_name), download_workers),
+        ("prepare", lambda job: prepare_batch_stage(job, collection_name), max_workers),
+    ]
+    run_stage_pipeline(({'project': project} for project in project_source), stages, on_prepared)
+
+    # 同じPDFの組み合わせの案件は最初の案件のリクエストにまとめる
+    records = []
+    primary_jobs = {}
+    for job in prepared:
+        if 'batch_request' not in job:
+            continue
+        primary = primary_jobs.setdefault(job.get('input_signature') or job['batch_key'], job)
+        if primary is job:
+            records.append(job['batch_request'])
+        else:
+            job['batch_primary'] = primary
+        del job['batch_request']
+
+    run_id = datetime.now(JST).strftime('%Y%m%d_%H%M%S')
+    batch_stager = create_pdf_stager(os.environ[STAGING_BUCKET_ENV], BATCH_PREFIX)
+    manifest = {
+        "run_id": run_id,
+        "collection": collection_name,
+        "status": "prepared",
+        "input_uri": None,
+        "output_uri_prefix": batch_stager.uri_for(f"{run_id}/output"),
+        "job_name": None,
+        "delta_cursor": delta_cursor,
+        "failed_projects": failed_projects,
+        "jobs": [batch_manifest_job(job) for job in prepared],
+    }
+    print(f"\n📝 マニフェスト: {batch_stager.uri_for(f'{run_id}/{BATCH_MANIFEST_NAME}')}")
+
+    batch_job = None
+    if records:
+        manifest['input_uri'] = batch_stager.put_jsonl(f"{run_id}/requests.jsonl", records)
+        # ジョブ投入前に保存し、投入後にジョブ名を追記（タスクが途中で終了しても --batch-collect で回収できる）
+        batch_stager.put_json(f"{run_id}/{BATCH_MANIFEST_NAME}", manifest)
+        print(f"📤 バッチ予測ジョブを投入: {len(records)}リクエスト（{len(prepared) - len(records)}件は同一PDFのため共有）")
+        print(f"   入力: {manifest['input_uri']}")
+        batch_job = submit_batch_job(manifest['input_uri'], manifest['output_uri_prefix'])
+        manifest['job_name'] = batch_job.resource_name
+        manifest['status'] = "submitted"
+        batch_stager.put_json(f"{run_id}/{BATCH_MANIFEST_NAME}", manifest)
+        print(f"   ジョブ: {manifest['job_name']}")
+
+        if not wait_for_batch_job(batch_job, poll_interval, wait_minutes):
+            print(f"⏸️  {wait_minutes:g}分以内にジョブが完了しませんでした（ジョブは実行を続けます）")
+            print(f"   完了後に回収: --mode batch --staging-bucket {os.environ[STAGING_BUCKET_ENV]} --batch-collect {run_id}")
+            return None
+    else:
+        batch_stager.put_json(f"{run_id}/{BATCH_MANIFEST_NAME}", manifest)
+
+    failed = collect_batch_run(manifest, batch_stager, batch_job, persist_workers=persist_workers,
+                               persist_stage=persist_stage, counts=counts)
+    total = sum(counts.values())
+    print(f"\n📊 処理完了: 成功 {counts['success']}件 / スキップ {counts['skipped']}件 / エラー {counts['error']}件 / 合計 {total}件")
+    return failed
+
+def collect_batch_run(manifest, batch_stager, batch_job, persist_workers: int = DEFAULT_PERSIST_WORKERS,
+                      persist_stage=None, counts=None):
+    """
+    バッチ: 終了したジョブの結果をlabelsの案件キーで案件に対応付け、オンラインと同じsave_dataで保存
+    ジョブが失敗した場合は、以前の実行の解析結果を共有する案件のみ保存してNoneを返す（デルタリンクを進めない）
+    ローカル代替のデフォルト応答（空のJSON）はFirestoreに保存しない（persist_stageを指定した場合はそれを使用）
+    Returns: 失敗した案件フォルダのリスト（ジョブ失敗時はNone）
+    """
+    collection_name = manifest['collection']
+    counts = counts if counts is not None else {'success': 0, 'skipped': 0, 'error': 0}
+    failed_projects = list(manifest['failed_projects'])
+    dry_run = persist_stage is None and is_stub_batch_job(batch_job)
+    if persist_stage is None:
+        persist_stage = lambda job: persist_project_stage(job, collection_name)
+    if dry_run:
+        print("🧪 ローカル代替のデフォルト応答のため、Firestoreには保存しません")
+        persist_stage = lambda job: dict(job, result=(True, "ドライラン: 保存せず", 0.0))
+
+    job_failed = batch_job is not None and not batch_job.has_succeeded
+    results = {}
+    if batch_job is not None and not job_failed:
+        print(f"✅ バッチ予測ジョブ完了 → {batch_job.output_location}")
+        for record in batch_stager.iter_jsonl(batch_job.output_location):
+            key = record.get("request", {}).get("labels", {}).get(BATCH_KEY_LABEL)
+            if key:
+                results[key] = parse_batch_output(record)
+    elif job_failed:
+        print(f"❌ バッチ予測ジョブ失敗: {batch_job.state} {getattr(batch_job, 'error', '')}")
+
+    jobs = [dict(entry) for entry in manifest['jobs']]
+    primaries = {job['batch_key']: job for job in jobs if job.get('batch_key') and not job.get('batch_primary_key')}
+
+    # 結果を保存（オンラインと同じsave_data）
+    def persist(job):
+        if job.get('analysis_result') is None:
+            primary = primaries.get(job.get('batch_primary_key') or job['batch_key'], job)
+            analysis_result, message = results.get(primary['batch_key'], (None, "バッチ予測の結果がありません"))
+            if analysis_result is None:
+                job['result'] = (False, message, 0.0)
+                return job
+            job['analysis_result'] = apply_rule_fields(json.loads(json.dumps(analysis_result)), primary['rule_fields'])
+            if primary is not job:
+                job['shared_from'] = primary['project']['id']
+        job['elapsed'] = 0.0
+        try:
+            return persist_stage(job)
+        except Exception as e:
+            job['result'] = (False, f"エラー（persist）: {str(e)[:100]}", 0.0)
+            return job
+
+    # 解析結果を重複PDFの共有インデックスに登録（同じコレクションへのオンライン実行でも再利用）
+    dedup_index = None if dry_run else get_analysis_dedup_index(collection_name)
+    if dedup_index is not None:
+        for job in primaries.values():
+            analysis_result, _ = results.get(job['batch_key'], (None, ""))
+            if analysis_result is not None and job.get('input_signature'):
+                dedup_index.complete(job['input_signature'], job['project']['id'],
+                                     apply_rule_fields(json.loads(json.dumps(analysis_result)), job['rule_fields']))
+
+    # ジョブ失敗時は解析済みの結果を共有する案件のみ保存（残りはデルタリンクを進めずに次回再処理）
+    persist_jobs = [job for job in jobs if job.get('analysis_result') is not None] if job_failed else jobs
+    print(f"\n💾 解析結果を保存: {len(persist_jobs)}件")
+    with ThreadPoolExecutor(max_workers=persist_workers) as executor:
+        for job in executor.map(persist, persist_jobs):
+            report_batch_job(job, counts, failed_projects)
+
+    manifest['status'] = "failed" if job_failed else "collected"
+    manifest['failed_projects'] = failed_projects
+    batch_stager.put_json(f"{manifest['run_id']}/{BATCH_MANIFEST_NAME}", manifest)
+    return None if job_failed else failed_projects
+
+def resume_batch_run(run_id, persist_workers: int = DEFAULT_PERSIST_WORKERS,
+                     poll_interval: float = BATCH_POLL_INTERVAL,
+                     wait_minutes: float = BATCH_WAIT_MINUTES,
+                     persist_stage=None):
+    """
+    バッチ: 以前の実行で投入したジョブをマニフェストから取得し、完了していれば結果を保存
+    回収済みの実行は再保存せず、前回の結果を返す
+    Returns: (失敗した案件フォルダのリスト（未完了・ジョブ失敗の場合はNone）, マニフェストのデルタカーソル)
+    """
+    batch_stager = create_pdf_stager(os.environ[STAGING_BUCKET_ENV], BATCH_PREFIX)
+    manifest = batch_stager.get_json(f"{run_id}/{BATCH_MANIFEST_NAME}")
+    if manifest is None:
+        print(f"❌ マニフェストが見つかりません: {batch_stager.uri_for(f'{run_id}/{BATCH_MANIFEST_NAME}')}")
+        return None, None
+    delta_cursor = manifest.get('delta_cursor')
+    if manifest['status'] == "collected":
+        print(f"⏭️  回収済みの実行です: {run_id}")
+        return manifest['failed_projects'], delta_cursor
+    if manifest['status'] == "failed":
+        print(f"❌ ジョブが失敗した実行です（--mode batch で再実行してください）: {run_id}")
+        return None, delta_cursor
+
+    batch_job = None
+    if manifest['job_name']:
+        print(f"📥 バッチ予測ジョブを回収: {manifest['job_name']}")
+        batch_job = get_batch_job(manifest)
+        if not wait_for_batch_job(batch_job, poll_interval, wait_minutes):
+            print(f"⏸️  ジョブはまだ実行中です（{batch_job.state}）。完了後に再度 --batch-collect {run_id} を実行してください")
+            return None, delta_cursor
+    elif manifest['input_uri']:
+        # ジョブ投入前にタスクが終了した（投入されたかは確認できないため再実行する）
+        print(f"❌ ジョブ名が記録されていません（--mode batch で再実行してください）: {run_id}")
+        return None, delta_cursor
+
+    counts = {'success': 0, 'skipped': 0, 'error': 0}
+    failed = collect_batch_run(manifest, batch_stager, batch_job, persist_workers=persist_workers,
+                               persist_stage=persist_stage, counts=counts)
+    total = sum(counts.values())
+    print(f"\n📊 回収完了: 成功 {counts['success']}件 / スキップ {counts['skipped']}件 / エラー {counts['error']}件 / 合計 {total}件")
+    return failed, delta_cursor
+
+def iter_crawled_project_folders(access_token, user_email, root_path, concurrency, index_path=None):
+    """フォルダ収集を別スレッドで実行し、検出した案件フォルダから順にyieldする"""
+    found = queue.Queue()  # 探索側を止めないよう上限なし（案件フォルダ情報のみのため小さい）
+
+    def crawl():
+        try:
+            collect_all_project_folders(access_token, user_email, root_path, concurrency=concurrency,
+                                        index_path=index_path, on_found=found.put)
+        except Exception as e:
+            print(f"⚠️ フォルダ収集エラー: {e}")
+        finally:
+            found.put(PIPELINE_DONE)
+
+    threading.Thread(target=crawl, name="crawl", daemon=True).start()
+    while True:
+        project_folder = found.get()
+        if project_folder is PIPELINE_DONE:
+            return
+        yield project_folder
 
 def main():
     """メイン処理"""
     start_time = time.time()
     start_datetime = datetime.now()
+    run_started_at = datetime.now(JST)
 
     parser = argparse.ArgumentParser(description='Uplan Knowledge Base - Batch Processor v4 (Rate Limit Optimized)')
     parser.add_argument('--target-path', type=str, default=DEFAULT_TARGET_PATH,
@@ -604,6 +3825,47 @@ def main():
                        help=f'並列処理数 (デフォルト: {DEFAULT_MAX_WORKERS})')
     parser.add_argument('--collection', type=str, default=DEFAULT_COLLECTION,
                        help=f'保存先コレクション (デフォルト: {DEFAULT_COLLECTION})')
+    parser.add_argument('--crawl-concurrency', type=int, default=DEFAULT_CRAWL_CONCURRENCY,
+                       help=f'フォルダ収集時の同時リクエスト数 (デフォルト: {DEFAULT_CRAWL_CONCURRENCY})')
+    parser.add_argument('--mode', choices=['full', 'delta', 'batch'], default='full',
+                       help='実行モード: full=全件スキャン, delta=前回からの変更のみ処理, batch=全件をVertex AIのバッチ予測で処理（--staging-bucket必須）')
+    parser.add_argument('--discovery', choices=['crawl', 'delta', 'search'], default='crawl',
+                       help='案件フォルダの探索方法: crawl=フォルダ一覧の再帰取得, delta=デルタクエリ1回の列挙からツリーを構築, '
+                            'search=検索APIで候補を取得しフォルダインデックスと突き合わせ')
+    parser.add_argument('--folder-index', type=str, default=DEFAULT_FOLDER_INDEX_PATH,
+                       help=f'フォルダツリーのローカルインデックス (デフォルト: {DEFAULT_FOLDER_INDEX_PATH})')
+    parser.add_argument('--no-folder-index', action='store_true',
+                       help='フォルダツリーのインデックスを使わずに全フォルダを再クロール')
+    parser.add_argument('--executor', choices=['process', 'pipeline'], default='process',
+                       help='実行方式: process=案件ごとにプロセスで逐次処理, pipeline=ステージごとの並列パイプライン')
+    parser.add_argument('--list-workers', type=int, default=DEFAULT_LIST_WORKERS,
+                       help=f'パイプライン: ファイル一覧取得の同時実行数 (デフォルト: {DEFAULT_LIST_WORKERS})')
+    parser.add_argument('--download-workers', type=int, default=DEFAULT_DOWNLOAD_WORKERS,
+                       help=f'パイプライン: PDFダウンロードの同時実行数 (デフォルト: {DEFAULT_DOWNLOAD_WORKERS})')
+    parser.add_argument('--persist-workers', type=int, default=DEFAULT_PERSIST_WORKERS,
+                       help=f'パイプライン: Firestore保存の同時実行数 (デフォルト: {DEFAULT_PERSIST_WORKERS})')
+    parser.add_argument('--page-budget', type=int, default=get_page_budget(),
+                       help=f'1ファイルあたりGeminiに送る最大ページ数。キーワードで関連ページを選ぶ（0で全ページ送信、デフォルト: {DEFAULT_PAGE_BUDGET}）')
+    parser.add_argument('--token-budget', type=int, default=get_token_budget(),
+                       help=f'1リクエストあたりのPDF入力トークン上限。構造計算書・証明書・審査表・図面の順に詰める（デフォルト: {DEFAULT_TOKEN_BUDGET}）')
+    parser.add_argument('--count-tokens', action='store_true',
+                       help='トークン数をcount_tokens APIで計測（デフォルトはページ数から推定）')
+    parser.add_argument('--extraction', choices=['single', 'map-reduce', 'auto'], default=get_extraction_mode(),
+                       help='解析方式: single=全ファイルを1リクエスト, map-reduce=ファイルごとに解析して統合, auto=棟別・大容量の構造計算書のみ分割（デフォルト: single）')
+    parser.add_argument('--drawing-images', choices=['off', 'local', 'thumbnail'], default=get_drawing_image_mode(),
+                       help='構造図をPDFの代わりに縮小画像で送る: local=pypdfium2で描画（失敗時はサムネイル）, thumbnail=Graphのサムネイル（デフォルト: off）')
+    parser.add_argument('--drawing-max-pages', type=int, default=DEFAULT_DRAWING_MAX_PAGES,
+                       help=f'構造図1ファイルあたり画像化するページ数（デフォルト: {DEFAULT_DRAWING_MAX_PAGES}）')
+    parser.add_argument('--drawing-dpi', type=int, default=DEFAULT_DRAWING_DPI,
+                       help=f'構造図の描画解像度（長辺{DRAWING_MAX_SIDE}pxに縮小、デフォルト: {DEFAULT_DRAWING_DPI}）')
+    parser.add_argument('--rules-only', action='store_true',
+                       help='Geminiを呼ばず、登録済み案件の計算ソフト・作成年月・計算ルートをテキストレイヤーから再抽出して更新')
+    parser.add_argument('--staging-bucket', type=str, default=os.environ.get(STAGING_BUCKET_ENV, ""),
+                       help='PDFのステージング先（gs://バケット名 または file:///ディレクトリ）。指定するとGeminiにURIで渡す')
+    parser.add_argument('--batch-wait', type=float, default=BATCH_WAIT_MINUTES,
+                       help=f'バッチ: ジョブの完了を待つ最大時間（分）。過ぎたら --batch-collect で後から回収（デフォルト: {BATCH_WAIT_MINUTES}）')
+    parser.add_argument('--batch-collect', type=str, default=None, metavar='RUN_ID',
+                       help='バッチ: 以前の実行で投入したジョブの結果を回収して保存し、その実行のデルタリンクを保存（--mode batch と併用）')
 
     args = parser.parse_args()
 
@@ -612,26 +3874,173 @@ def main():
     print("=" * 80)
     print(f"📂 ターゲットパス: {args.target_path}")
     print(f"⚙️  並列処理数: {args.workers}")
+    print(f"🔄 実行モード: {args.mode}")
+    print(f"🏭 実行方式: {args.executor}")
+    print(f"🔎 探索方法: {args.discovery}")
+    print(f"🕸️  フォルダ収集の同時リクエスト数: {args.crawl_concurrency}")
+    print(f"🗂️  フォルダインデックス: {'無効' if args.no_folder_index else args.folder_index}")
+    if args.rules_only:
+        print("📏 ルール抽出のみ: 登録済み案件の計算ソフト・作成年月・計算ルートを更新（Geminiは使用しない）")
+    print(f"📑 ページ抽出: {f'最大{args.page_budget}ページ/ファイル' if args.page_budget > 0 else '無効（全ページ送信）'}")
+    print(f"🧮 入力トークン予算: {args.token_budget:,} tokens（{'count_tokensで計測' if args.count_tokens else 'ページ数から推定'}）")
+    print(f"🧩 解析方式: {args.extraction}")
+    if args.drawing_images != 'off':
+        print(f"🖼️  構造図の画像化: {args.drawing_images}（最大{args.drawing_max_pages}ページ、{args.drawing_dpi}dpi）")
+    print(f"☁️  PDFステージング: {args.staging_bucket or '無効（インライン送信）'}")
+    if args.mode == 'batch':
+        print(f"⏳ バッチジョブの待機: 最大{args.batch_wait:g}分" + (f"（回収: {args.batch_collect}）" if args.batch_collect else ""))
     print(f"💾 保存先コレクション: {args.collection}")
     print(f"⏰ 開始時刻: {start_datetime.strftime('%Y/%m/%d %H:%M:%S')}")
     print(f"🔄 レート制限対策: 指数バックオフ + ランダムジッター + プロセス分散")
     print("=" * 80)
 
-    # 認証
+    # 認証（トークンは実行ごとの一時ディレクトリでワーカーと共有し、終了時に削除）
+    init_shared_token_cache()
     token = get_access_token()
     if not token:
         print("❌ 認証失敗のため終了します")
         return
 
-    # フォルダ収集
-    project_folders = collect_all_project_folders(token, TARGET_USER_EMAIL, args.target_path)
+    # ページ抽出・PDFステージング（ワーカープロセスは環境変数から設定を引き継ぐ）
+    os.environ[PAGE_BUDGET_ENV] = str(args.page_budget)
+    os.environ[TOKEN_BUDGET_ENV] = str(args.token_budget)
+    os.environ[EXTRACTION_MODE_ENV] = args.extraction
+    os.environ[DRAWING_IMAGES_ENV] = args.drawing_images
+    os.environ[DRAWING_MAX_PAGES_ENV] = str(args.drawing_max_pages)
+    os.environ[DRAWING_DPI_ENV] = str(args.drawing_dpi)
+    if args.drawing_images == 'local' and pdfium is None:
+        print("⚠️ pypdfium2/Pillowがインストールされていないため、構造図はGraphのサムネイルを使用します")
+    if args.count_tokens:
+        os.environ[TOKEN_COUNT_MODE_ENV] = "api"
+    if args.rules_only:
+        os.environ[RULES_ONLY_ENV] = "1"
+        if PdfReader is None:
+            print("❌ --rules-only にはpypdfが必要です")
+            return
+    if args.page_budget > 0 and PdfReader is None:
+        print("⚠️ pypdfがインストールされていないため、ページ抽出は行いません")
+    if args.mode == 'batch' and (not args.staging_bucket or args.rules_only):
+        print("❌ --mode batch には --staging-bucket の指定が必要です（--rules-only とは併用できません）")
+        return
+    if args.staging_bucket:
+        os.environ[STAGING_BUCKET_ENV] = args.staging_bucket
+        try:
+            get_pdf_stager().ensure_lifecycle()
+            if args.mode == 'batch':
+                create_pdf_stager(args.staging_bucket, BATCH_PREFIX).ensure_lifecycle(BATCH_RETENTION_DAYS)
+        except Exception as e:
+            print(f"⚠️ ステージング先の自動削除ルール設定に失敗しました（手動で設定してください）: {e}")
 
-    if not project_folders:
-        print("⚠️ 案件フォルダが見つかりませんでした")
+    if args.batch_collect:
+        if args.mode != 'batch':
+            print("❌ --batch-collect は --mode batch と併用してください")
+            return
+        # 以前の実行で投入したバッチ予測ジョブを回収し、その実行の開始時点のデルタリンクを保存
+        failed_projects, delta_cursor = resume_batch_run(args.batch_collect, persist_workers=args.persist_workers,
+                                                         wait_minutes=args.batch_wait)
+        if failed_projects is None or not delta_cursor:
+            print("⚠️ 回収できなかったため、デルタリンクを更新しません")
+        elif delta_cursor.get('delta_link'):
+            save_delta_link(delta_cursor['user_email'], delta_cursor['target_path'], delta_cursor['delta_link'],
+                            datetime.fromisoformat(delta_cursor['run_started_at']), failed_projects)
         return
 
-    # 並列処理
-    process_projects_parallel(project_folders, max_workers=args.workers, collection_name=args.collection)
+    # 重複PDFの共有インデックスから以前の実行（他のコレクション）の行を削除（ファイルが増え続けないように）
+    dedup_index = get_analysis_dedup_index(args.collection)
+    if dedup_index is not None:
+        pruned = dedup_index.prune_other_runs()
+        if pruned:
+            print(f"🧹 重複PDFインデックス: 以前の実行の{pruned}件を削除")
+
+    def process_projects(project_folders):
+        """案件フォルダを処理し、失敗した案件フォルダのリストを返す（処理できなかった場合はNone）"""
+        if args.mode == 'batch':
+            # 回収を後の実行に持ち越す場合に備え、デルタリンクをマニフェストに保存
+            delta_cursor = {"user_email": TARGET_USER_EMAIL, "target_path": args.target_path,
+                            "delta_link": new_delta_link, "run_started_at": run_started_at.isoformat()}
+            return process_projects_batch(project_folders, max_workers=args.workers, collection_name=args.collection,
+                                          list_workers=args.list_workers, download_workers=args.download_workers,
+                                          persist_workers=args.persist_workers, wait_minutes=args.batch_wait,
+                                          delta_cursor=delta_cursor)
+        if args.executor == 'pipeline':
+            return process_projects_pipelined(project_folders, max_workers=args.workers, collection_name=args.collection,
+                                              list_workers=args.list_workers, download_workers=args.download_workers,
+                                              persist_workers=args.persist_workers)
+        return process_projects_parallel(project_folders, max_workers=args.workers, collection_name=args.collection)
+
+    if args.mode == 'delta':
+        # 差分更新モード: 変更のあった案件フォルダのみ処理
+        print("\n📊 差分更新モード: 前回からの変更のみを処理します")
+        delta_link = get_delta_link(TARGET_USER_EMAIL, args.target_path)
+
+        if not delta_link:
+            print("⚠️ デルタリンクが見つかりません。全件スキャンモードで実行してください。")
+            return
+
+        changed_items, new_delta_link = fetch_drive_changes(token, TARGET_USER_EMAIL, args.target_path, delta_link)
+        if not new_delta_link:
+            print("❌ 差分を取得できませんでした（デルタリンクが失効した場合は --mode full で再実行してください）")
+            sys.exit(1)
+        try:
+            project_folders = resolve_changed_project_folders(token, TARGET_USER_EMAIL, args.target_path, changed_items) if changed_items else []
+        except Exception as e:
+            print(f"❌ 変更された案件フォルダを特定できませんでした（デルタリンクは更新しません）: {e}")
+            sys.exit(1)
+
+        # 前回までに失敗した案件フォルダを再処理（変更が検出された案件と重複する場合は1回だけ）
+        pending_folders = get_pending_project_folders(TARGET_USER_EMAIL, args.target_path)
+        changed_ids = {folder['id'] for folder in project_folders}
+        retry_folders = [folder for folder in pending_folders if folder['id'] not in changed_ids]
+        if retry_folders:
+            print(f"🔁 前回失敗した案件フォルダを再処理: {len(retry_folders)}件")
+            project_folders += retry_folders
+
+        failed_projects = []
+        if project_folders:
+            failed_projects = process_projects(project_folders)
+        else:
+            print("✨ 処理対象の変更はありませんでした")
+
+    else:
+        # フォルダ収集
+        if args.discovery == 'delta':
+            project_folders, new_delta_link = collect_project_folders_from_delta(token, TARGET_USER_EMAIL, args.target_path)
+        elif args.discovery == 'search':
+            new_delta_link = fetch_latest_delta_link(token, TARGET_USER_EMAIL)
+            project_folders = collect_project_folders_from_search(
+                token, TARGET_USER_EMAIL, args.target_path,
+                index_path=None if args.no_folder_index else args.folder_index
+            )
+        elif args.executor == 'pipeline' or args.mode == 'batch':
+            # 収集完了を待たず、検出した案件フォルダから順に処理を開始
+            new_delta_link = fetch_latest_delta_link(token, TARGET_USER_EMAIL)
+            # クロールはリクエストごとにTOKEN_PROVIDERからトークンを取得（収集中の期限切れを防ぐ）
+            project_folders = iter_crawled_project_folders(
+                None, TARGET_USER_EMAIL, args.target_path,
+                concurrency=args.crawl_concurrency,
+                index_path=None if args.no_folder_index else args.folder_index
+            )
+        else:
+            # 収集前の時点を起点にして、収集中の変更も次回の差分で拾う
+            new_delta_link = fetch_latest_delta_link(token, TARGET_USER_EMAIL)
+            project_folders = collect_all_project_folders(
+                None, TARGET_USER_EMAIL, args.target_path,
+                concurrency=args.crawl_concurrency,
+                index_path=None if args.no_folder_index else args.folder_index
+            )
+
+        if not project_folders:
+            print("⚠️ 案件フォルダが見つかりませんでした")
+            return
+
+        # 並列処理
+        failed_projects = process_projects(project_folders)
+
+    # デルタリンクを保存（次回の差分取得用）。失敗した案件フォルダは次回の差分更新で再処理するため一緒に保存
+    if failed_projects is None:
+        print("⚠️ 案件を処理できなかったため、デルタリンクを更新しません（次回も同じ変更から再処理）")
+    elif new_delta_link:
+        save_delta_link(TARGET_USER_EMAIL, args.target_path, new_delta_link, run_started_at, failed_projects)
 
     # 実行時間トラッキング終了
     end_time = time.time()
@@ -3,7 +3,6 @@ OneDrive検索で案件を見つけて直接処理する
 """
 
 import msal
-import requests
 import json
 import os
 import gc
@@ -16,6 +15,7 @@ from google.cloud import secretmanager
 from google.cloud import firestore
 from google.api_core import retry, exceptions
 import re
+from batch_processor_v4_rate_optimized import iter_graph_items, fetch_pdf, read_file_data, close_file_data
 
 # --- 設定 ---
 GCP_PROJECT_ID = "uplan-knowledge-base"
@@ -64,9 +64,7 @@ def search_folders_by_keyword(access_token, keyword):
     search_url = f"https://graph.microsoft.com/v1.0/users/{TARGET_USER_EMAIL}/drive/root/search(q='{keyword}')"
 
     try:
-        response = requests.get(search_url, headers=headers, timeout=30)
-        response.raise_for_status()
-        results = response.json().get('value', [])
+        results = list(iter_graph_items(search_url, headers, timeout=30))
 
         # 構造設計図書フォルダを探す
         target_folders = []
@@ -192,7 +190,7 @@ def analyze_with_gemini(file_data_list, file_name_hints=None):
         parts.append(hint_text)
 
     for file_info in file_data_list:
-        parts.append(Part.from_data(file_info["data"], mime_type=file_info["mime_type"]))
+        parts.append(Part.from_data(read_file_data(file_info), mime_type=file_info["mime_type"]))
         parts.append(f"[ファイル名: {file_info['name']}]")
 
     prompt = """
@@ -302,9 +300,7 @@ def process_folder(folder_info: Dict, access_token: str, user_email: str) -> Tup
 
         # フォルダ内のファイル一覧を取得
         folder_url = f"https://graph.microsoft.com/v1.0/users/{user_email}/drive/items/{folder_id}/children"
-        response = requests.get(folder_url, headers=headers, timeout=60)
-        response.raise_for_status()
-        items = response.json().get('value', [])
+        items = list(iter_graph_items(folder_url, headers, timeout=60))
 
         # ファイルを選定
         calc_files, drawing_files, cert_file, review_file = select_project_files(items)
@@ -323,16 +319,14 @@ def process_folder(folder_info: Dict, access_token: str, user_email: str) -> Tup
 
         print(f"   📥 PDFダウンロード中: {len(calc_files)}ファイル")
         for pdf_file in calc_files[:5]:
-            download_url = pdf_file.get('@microsoft.graph.downloadUrl')
-            if download_url:
-                pdf_response = requests.get(download_url, timeout=120)
-                if pdf_response.status_code == 200:
-                    file_data_list.append({
-                        "data": pdf_response.content,
-                        "mime_type": "application/pdf",
-                        "name": pdf_file['name']
-                    })
-                    file_name_hints.append(pdf_file['name'])
+            pdf_file_data = fetch_pdf(pdf_file, headers)
+            if pdf_file_data is not None:
+                file_data_list.append({
+                    "file": pdf_file_data,
+                    "mime_type": "application/pdf",
+                    "name": pdf_file['name']
+                })
+                file_name_hints.append(pdf_file['name'])
 
         if not file_data_list:
             elapsed = time.time() - start_time
@@ -340,7 +334,10 @@ def process_folder(folder_info: Dict, access_token: str, user_email: str) -> Tup
 
         # Gemini APIで解析
         print(f"   🤖 AI解析中...")
-        analysis_result = analyze_with_gemini_retry(file_data_list, file_name_hints)
+        try:
+            analysis_result = analyze_with_gemini_retry(file_data_list, file_name_hints)
+        finally:
+            close_file_data(file_data_list)
 
         del file_data_list
         gc.collect()
@@ -16,6 +16,7 @@ from google.cloud import secretmanager
 from google.cloud import firestore
 from datetime import datetime, timezone, timedelta
 import re
+from batch_processor_v4_rate_optimized import fetch_pdf, read_pdf_data
 
 # 日本時間のタイムゾーン
 JST = timezone(timedelta(hours=9))
@@ -231,18 +232,16 @@ def select_project_files(pdf_files: List[Dict], max_files: int = 5) -> List[Dict
     # 上位max_files件を返す
     return sorted_files[:max_files]
 
-def download_pdf(access_token, file_id):
-    """PDFファイルをダウンロード"""
+def download_pdf(access_token, pdf_file):
+    """PDFファイルをダウンロード（共通のfetch_pdfで取得し、バイト列で返す）"""
     try:
         headers = {"Authorization": f"Bearer {access_token}"}
-        download_url = f"https://graph.microsoft.com/v1.0/users/{TARGET_USER_EMAIL}/drive/items/{file_id}/content"
-
-        response = requests.get(download_url, headers=headers)
-        if response.status_code == 200:
-            return response.content
-        else:
-            print(f"❌ ダウンロードエラー: {response.status_code}")
+        pdf_file_data = fetch_pdf(pdf_file, headers, TARGET_USER_EMAIL)
+        if pdf_file_data is None:
+            print("❌ ダウンロードエラー")
             return None
+        with pdf_file_data:
+            return read_pdf_data(pdf_file_data)
 
     except Exception as e:
         print(f"❌ ダウンロードエラー: {e}")
@@ -455,7 +454,7 @@ def process_single_project(project_info: Dict, access_token: str, collection_nam
         pdf_contents = []
         for i, file in enumerate(selected_files):
             print(f"   {i+1}/{len(selected_files)}: {file['name']}")
-            content = download_pdf(access_token, file["id"])
+            content = download_pdf(access_token, file)
             if content:
                 pdf_contents.append(content)
                 print(f"      ✅ ダウンロード完了 ({len(content) / 1024 / 1024:.2f} MB)")
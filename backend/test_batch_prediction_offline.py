@@ -0,0 +1,207 @@
+"""
+バッチ予測（--mode batch）の回収・再開をオフラインで確認するスクリプト
+
+Graph API・Vertex AI・Firestoreには接続しない
+- ステージング先は一時ディレクトリ（file://）、ジョブはLocalBatchPredictionJob
+- LocalBatchPredictionJob.responder を差し替えて応答を作り、保存処理（persist_stage）は記録のみ
+
+確認内容:
+1. ジョブ投入後にタスクが終了しても、マニフェストから --batch-collect 相当の処理で回収できる
+2. 同じPDFの組み合わせの案件は解析元の結果を共有し、エラー行の案件は失敗として返る
+3. ジョブ失敗時は共有済みの案件のみ保存し、Noneを返す（デルタリンクを進めない）
+4. デフォルトのスタブ応答ではFirestoreに保存しない
+5. 自動削除ルールの日数が短い場合は置き換える
+
+使い方: python test_batch_prediction_offline.py（pytestでも実行可）
+"""
+
+import sys
+import os
+import json
+import shutil
+import tempfile
+from contextlib import contextmanager
+sys.path.append(os.path.dirname(__file__))
+
+# 重複PDFの共有インデックス（ローカルのSQLite）を使わない
+os.environ["ANALYSIS_DEDUP_PATH"] = ""
+
+import batch_processor_v4_rate_optimized as bp
+
+DELTA_CURSOR = {"user_email": "test@example.com", "target_path": "test", "delta_link": "delta-link",
+                "run_started_at": "2026-01-01T00:00:00+09:00"}
+
+def make_project(folder_id, name):
+    """案件フォルダ1件分のジョブ（list/download/prepareステージの結果に相当）"""
+    return {
+        'project': {'id': folder_id, 'name': name, 'path': name, 'full_path': f"test/{name}"},
+        'folder_web_url': f"https://example.com/{folder_id}",
+        'calc_files': [{'name': f"{name}_構造計算書.pdf"}],
+        'drawing_files': [],
+        'cert_file': None,
+        'review_file': None,
+        'rule_fields': {'software': "SS7"},
+        'packed_count': 1,
+        'result': (True, "バッチリクエスト作成", 0.0),
+    }
+
+def write_run(run_id, jobs):
+    """process_projects_batchと同じ形でリクエストとマニフェストを書き出し、ジョブを投入する"""
+    stager = bp.create_pdf_stager(os.environ[bp.STAGING_BUCKET_ENV], bp.BATCH_PREFIX)
+    records = []
+    primaries = {}
+    for job in jobs:
+        if 'analysis_result' in job:
+            continue
+        job['batch_key'] = bp.batch_key(job['project']['id'])
+        primary = primaries.setdefault(job.get('input_signature') or job['batch_key'], job)
+        if primary is job:
+            records.append(bp.build_batch_request(job['batch_key'], ["解析してください"]))
+        else:
+            job['batch_primary'] = primary
+    manifest = {
+        "run_id": run_id, "collection": "test", "status": "prepared",
+        "input_uri": stager.put_jsonl(f"{run_id}/requests.jsonl", records),
+        "output_uri_prefix": stager.uri_for(f"{run_id}/output"),
+        "job_name": None, "delta_cursor": DELTA_CURSOR, "failed_projects": [],
+        "jobs": [bp.batch_manifest_job(job) for job in jobs],
+    }
+    batch_job = bp.submit_batch_job(manifest['input_uri'], manifest['output_uri_prefix'])
+    manifest['job_name'] = batch_job.resource_name
+    manifest['status'] = "submitted"
+    stager.put_json(f"{run_id}/{bp.BATCH_MANIFEST_NAME}", manifest)
+    return stager, manifest, batch_job
+
+def responder(request):
+    """案件キーごとに応答を作成（フォルダIDが "error" の案件はエラー行にする）"""
+    key = request["labels"][bp.BATCH_KEY_LABEL]
+    if key == bp.batch_key("error"):
+        raise RuntimeError("quota exceeded")
+    text = json.dumps({"basic": {"structureType": "木造"}, "other": {"projectName": key[:8]}})
+    return {"candidates": [{"content": {"role": "model", "parts": [{"text": f"```json\n{text}\n```"}]}}]}
+
+def recorder(saved):
+    """保存処理の代わりに、保存する案件を記録する"""
+    def persist_stage(job):
+        saved.append(job)
+        job['result'] = (True, "記録のみ", 0.0)
+        return job
+    return persist_stage
+
+@contextmanager
+def offline_staging(job_responder=bp.local_batch_stub_response):
+    """一時ディレクトリをステージング先にし、ジョブの応答を差し替える（終了時に元に戻す）"""
+    staging_dir = tempfile.mkdtemp(prefix="batch-offline-")
+    original_bucket = os.environ.get(bp.STAGING_BUCKET_ENV)
+    original_responder = bp.LocalBatchPredictionJob.__dict__['responder']
+    os.environ[bp.STAGING_BUCKET_ENV] = f"file://{staging_dir}"
+    bp.LocalBatchPredictionJob.responder = staticmethod(job_responder)
+    try:
+        yield
+    finally:
+        bp.LocalBatchPredictionJob.responder = original_responder
+        if original_bucket is None:
+            os.environ.pop(bp.STAGING_BUCKET_ENV, None)
+        else:
+            os.environ[bp.STAGING_BUCKET_ENV] = original_bucket
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+def check(condition, message):
+    print(f"{'✅' if condition else '❌'} {message}")
+    assert condition, message
+
+def test_resume_after_task_exit():
+    """ジョブ投入後にタスクが終了 → マニフェストから回収"""
+    with offline_staging(responder):
+        run_resume_after_task_exit([])
+
+def run_resume_after_task_exit(saved):
+    jobs = [make_project("primary", "解析元"), make_project("copy", "同一PDF"), make_project("error", "エラー"),
+            dict(make_project("shared", "共有済み"), analysis_result={"basic": {"structureType": "RC"}}, shared_from="old")]
+    jobs[0]['input_signature'] = jobs[1]['input_signature'] = "same-pdfs"
+    write_run("run_resume", jobs)
+    # ここでタスクが終了した想定（ジョブは実行中のまま、結果は未回収）
+
+    failed, delta_cursor = bp.resume_batch_run("run_resume", poll_interval=0, persist_stage=recorder(saved))
+    persisted = {job['project']['id']: job for job in saved}
+    check(delta_cursor == DELTA_CURSOR, "マニフェストのデルタカーソルを返す")
+    check([project['id'] for project in failed] == ["error"], "エラー行の案件のみ失敗")
+    check(set(persisted) == {"primary", "copy", "shared"}, "解析元・共有先・共有済みの案件を保存")
+    check(persisted["copy"]["shared_from"] == "primary", "同一PDFの案件は解析元の結果を共有")
+    check(persisted["primary"]["analysis_result"]["fieldSources"]["software"] == "rule", "ルール抽出の値を反映")
+
+    saved.clear()
+    failed_again, _ = bp.resume_batch_run("run_resume", poll_interval=0, persist_stage=recorder(saved))
+    check(not saved and [project['id'] for project in failed_again] == ["error"], "回収済みの実行は再保存しない")
+
+def test_job_failure():
+    """ジョブ失敗 → 共有済みの案件のみ保存し、Noneを返す"""
+    with offline_staging(responder):
+        run_job_failure([])
+
+def run_job_failure(saved):
+    jobs = [make_project("failed", "失敗"),
+            dict(make_project("shared2", "共有済み"), analysis_result={"basic": {"structureType": "RC"}}, shared_from="old")]
+    stager, manifest, batch_job = write_run("run_failed", jobs)
+    os.remove(manifest['input_uri'][len("file://"):])
+    batch_job.refresh()
+    batch_job.refresh()
+    check(bp.collect_batch_run(manifest, stager, batch_job, persist_stage=recorder(saved)) is None, "ジョブ失敗時はNone")
+    check([job['project']['id'] for job in saved] == ["shared2"], "共有済みの案件のみ保存")
+    check(stager.get_json(f"run_failed/{bp.BATCH_MANIFEST_NAME}")['status'] == "failed", "マニフェストに失敗を記録")
+
+def test_stub_dry_run():
+    """デフォルトのスタブ応答 → Firestoreに保存しない"""
+    def no_firestore():
+        raise AssertionError("Firestoreに接続しました")
+    original_client = bp.get_firestore_client
+    bp.get_firestore_client = no_firestore
+    try:
+        with offline_staging():
+            stager, manifest, batch_job = write_run("run_stub", [make_project("stub", "スタブ")])
+            batch_job.refresh()
+            batch_job.refresh()
+            failed = bp.collect_batch_run(manifest, stager, batch_job)
+    finally:
+        bp.get_firestore_client = original_client
+    check(failed == [], "スタブ応答はドライランで成功扱い（Firestoreへの接続なし）")
+
+def test_lifecycle_age():
+    """既存の自動削除ルールが短い場合はdaysに置き換える"""
+    class FakeBucket:
+        def __init__(self):
+            self.lifecycle_rules = [
+                {"action": {"type": "Delete"}, "condition": {"age": 1, "matchesPrefix": [bp.BATCH_PREFIX, "other/"]}}
+            ]
+            self.patched = False
+        def reload(self):
+            pass
+        def add_lifecycle_delete_rule(self, age, matches_prefix):
+            self.lifecycle_rules = self.lifecycle_rules + [
+                {"action": {"type": "Delete"}, "condition": {"age": age, "matchesPrefix": matches_prefix}}
+            ]
+        def patch(self):
+            self.patched = True
+
+    stager = bp.GcsPdfStager.__new__(bp.GcsPdfStager)
+    stager.bucket = FakeBucket()
+    stager.prefix = bp.BATCH_PREFIX
+    stager.ensure_lifecycle(bp.BATCH_RETENTION_DAYS)
+    conditions = [rule["condition"] for rule in stager.bucket.lifecycle_rules]
+    check(conditions == [{"age": 1, "matchesPrefix": ["other/"]},
+                         {"age": bp.BATCH_RETENTION_DAYS, "matchesPrefix": [bp.BATCH_PREFIX]}],
+          "短いルールからプレフィックスを外し、保持日数のルールを追加")
+
+    stager.bucket.patched = False
+    stager.ensure_lifecycle(bp.BATCH_RETENTION_DAYS)
+    check(not stager.bucket.patched, "保持日数を満たすルールがあれば変更しない")
+
+if __name__ == "__main__":
+    print("=" * 80)
+    print("🧪 バッチ予測の回収・再開テスト（オフライン）")
+    print("=" * 80)
+    test_resume_after_task_exit()
+    test_job_failure()
+    test_stub_dry_run()
+    test_lifecycle_age()
+    print("\n🎉 すべて成功")
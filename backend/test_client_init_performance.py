@@ -0,0 +1,74 @@
+"""
+クライアント初期化コストの計測: 案件ごとに作成（従来） vs プロセスごとに1回作成して使い回す（init_worker）
+
+各案件で行う処理を模して、以下をN回繰り返した時間を比較する
+- Firestoreの重複チェッククエリ（file_id == ダミーID）
+- Geminiのcount_tokens（生成は行わないため課金なし）
+
+使い方: python test_client_init_performance.py [繰り返し回数]
+"""
+
+import sys
+import time
+import vertexai
+from vertexai.generative_models import GenerativeModel
+from google.cloud import firestore
+from batch_processor_v4_rate_optimized import (
+    GCP_PROJECT_ID, LOCATION, GEMINI_MODEL_NAME, FIRESTORE_DATABASE,
+    get_firestore_client, get_gemini_model
+)
+
+COLLECTION_NAME = "Projects_2026_01_07"
+DUMMY_FOLDER_ID = "client-init-benchmark"
+
+def run_task(db, model):
+    """1案件分のクライアント操作（重複チェック + count_tokens）"""
+    list(db.collection(COLLECTION_NAME).where("file_id", "==", DUMMY_FOLDER_ID).limit(1).stream())
+    model.count_tokens("構造計算書の解析")
+
+def measure_per_task(iterations):
+    """従来: 案件ごとにvertexai.init・GenerativeModel・firestore.Clientを作成"""
+    setup_total = 0.0
+    start_time = time.time()
+    for _ in range(iterations):
+        setup_start = time.time()
+        vertexai.init(project=GCP_PROJECT_ID, location=LOCATION)
+        model = GenerativeModel(GEMINI_MODEL_NAME)
+        db = firestore.Client(project=GCP_PROJECT_ID, database=FIRESTORE_DATABASE)
+        setup_total += time.time() - setup_start
+        run_task(db, model)
+    return time.time() - start_time, setup_total
+
+def measure_per_process(iterations):
+    """改善後: プロセスごとに1回作成したクライアントを使い回す"""
+    start_time = time.time()
+    setup_start = time.time()
+    db = get_firestore_client()
+    model = get_gemini_model()
+    setup_total = time.time() - setup_start
+    for _ in range(iterations):
+        run_task(db, model)
+    return time.time() - start_time, setup_total
+
+if __name__ == "__main__":
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+
+    print("=" * 80)
+    print(f"🔬 クライアント初期化コストの計測（{iterations}案件分）")
+    print("=" * 80)
+
+    # 認証・DNSなどの初回コストを除くため、1回ウォームアップ
+    measure_per_task(1)
+
+    per_task_total, per_task_setup = measure_per_task(iterations)
+    print("\n📦 案件ごとに作成（従来）")
+    print(f"   合計: {per_task_total:.2f}秒（{per_task_total / iterations * 1000:.0f}ms/案件）")
+    print(f"   うちクライアント作成: {per_task_setup:.2f}秒（{per_task_setup / iterations * 1000:.0f}ms/案件）")
+
+    per_process_total, per_process_setup = measure_per_process(iterations)
+    print("\n♻️  プロセスごとに1回作成（init_worker）")
+    print(f"   合計: {per_process_total:.2f}秒（{per_process_total / iterations * 1000:.0f}ms/案件）")
+    print(f"   うちクライアント作成: {per_process_setup:.2f}秒（初回のみ）")
+
+    saved = per_task_total - per_process_total
+    print(f"\n✅ 削減: {saved:.2f}秒（{saved / iterations * 1000:.0f}ms/案件、{saved / per_task_total * 100:.0f}%）")
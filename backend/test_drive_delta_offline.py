@@ -0,0 +1,145 @@
+"""
+ドライブのデルタクエリによる案件フォルダ探索をオフラインで確認するスクリプト
+
+Graph APIには接続しない（GRAPH_CLIENT.get を偽のデルタ応答に差し替える）
+- デルタは複数ページで、ターゲットパス外のフォルダ・削除済みアイテム・ファイルを含む
+- 子フォルダが親より先のページに出てくる場合も含む
+
+確認内容:
+1. パス指定ではなくドライブのルート（drive/root/delta）を列挙する
+2. ターゲットパス配下の構造設計図書フォルダのみを検出する（パス外の同名フォルダは除外）
+3. 最終ページのデルタリンクを返す
+4. 差分更新: デルタリンク（token=latest）もドライブのルートで取得し、変更はターゲットパスで絞り込む
+
+使い方: python test_drive_delta_offline.py（pytestでも実行可）
+"""
+
+import sys
+import os
+sys.path.append(os.path.dirname(__file__))
+
+import batch_processor_v4_rate_optimized as bp
+
+USER_EMAIL = "test@example.com"
+ROOT_PATH = "001_全社/01.構造設計"
+DELTA_LINK = "https://graph.example.com/delta?token=next"
+
+def folder(item_id, name, parent_id):
+    return {"id": item_id, "name": name, "folder": {"childCount": 1}, "parentReference": {"id": parent_id}}
+
+# 2ページ目が親（ターゲット・行フォルダ）、1ページ目が子（案件フォルダ）
+DELTA_PAGES = [
+    {
+        "value": [
+            folder("calc-a", "構造設計図書", "client-a"),
+            folder("calc-outside", "構造設計図書", "other-client"),
+            folder("dummy", "○構造計算書", "client-a"),
+            {"id": "pdf-1", "name": "構造計算書.pdf", "file": {}, "parentReference": {"id": "calc-a"}},
+            {"id": "gone", "name": "構造計算書", "deleted": {}, "parentReference": {"id": "client-a"}},
+        ],
+        "@odata.nextLink": "page-2",
+    },
+    {
+        "value": [
+            folder("drive-root", "root", None),
+            folder("target", "01.構造設計", "company"),
+            folder("company", "001_全社", "drive-root"),
+            folder("row-a", "□あ行", "target"),
+            folder("client-a", "A001_取引先", "row-a"),
+            folder("other", "02.意匠設計", "company"),
+            folder("other-client", "B001_取引先", "other"),
+        ],
+        "@odata.deltaLink": DELTA_LINK,
+    },
+]
+
+class FakeResponse:
+    def __init__(self, data):
+        self.status_code = 200
+        self.data = data
+
+    def json(self):
+        return self.data
+
+    def raise_for_status(self):
+        pass
+
+class FakeGraph:
+    """デルタとターゲットパスの取得にだけ応答する偽のGraph API"""
+
+    def __init__(self, pages):
+        self.pages = pages
+        self.urls = []
+
+    def get(self, url, **kwargs):
+        self.urls.append(url)
+        if url == "page-2":
+            return FakeResponse(self.pages[1])
+        if "/drive/root/delta" in url:
+            return FakeResponse(self.pages[0])
+        if f"/drive/root:/{ROOT_PATH}" in url and "/delta" not in url:
+            return FakeResponse({"id": "target", "name": "01.構造設計"})
+        raise AssertionError(f"想定外のURL: {url}")
+
+def test_delta_discovery_filters_to_target():
+    """ドライブ全体のデルタからターゲットパス配下の案件フォルダのみを検出"""
+    graph = FakeGraph(DELTA_PAGES)
+    original_get = bp.GRAPH_CLIENT.get
+    bp.GRAPH_CLIENT.get = graph.get
+    try:
+        project_folders, delta_link = bp.collect_project_folders_from_delta("token", USER_EMAIL, ROOT_PATH)
+    finally:
+        bp.GRAPH_CLIENT.get = original_get
+
+    delta_urls = [url for url in graph.urls if "/delta" in url]
+    assert delta_urls and all("root:/" not in url for url in delta_urls), delta_urls
+    assert delta_link == DELTA_LINK
+    assert project_folders == [{
+        'id': "calc-a",
+        'name': "構造設計図書",
+        'path': f"{ROOT_PATH}/□あ行/A001_取引先",
+        'full_path': f"{ROOT_PATH}/□あ行/A001_取引先/構造設計図書",
+    }], project_folders
+
+def test_drive_changes_filtered_by_target_path():
+    """差分更新: ドライブ全体の変更からターゲットパス外の変更を除外"""
+    def pdf(item_id, parent_path):
+        return {"id": item_id, "name": f"{item_id}.pdf", "file": {},
+                "parentReference": {"id": "parent", "path": f"/drive/root:/{parent_path}"}}
+
+    pages = [
+        {"value": [pdf("inside", f"{ROOT_PATH}/□あ行/A001_取引先/構造設計図書"),
+                   pdf("outside", "001_全社/02.意匠設計/B001_取引先"),
+                   pdf("prefix-only", f"{ROOT_PATH}2/C001_取引先")],
+         "@odata.nextLink": "page-2"},
+        {"value": [{"id": "no-path", "name": "no-path.pdf", "file": {}, "parentReference": {"id": "calc-a"}},
+                   {"id": "image", "name": "image.jpg", "file": {}, "parentReference": {"id": "calc-a"}},
+                   {"id": "gone", "name": "gone.pdf", "deleted": {}, "parentReference": {"id": "calc-a"}}],
+         "@odata.deltaLink": DELTA_LINK},
+    ]
+    graph = FakeGraph(pages)
+    original_get = bp.GRAPH_CLIENT.get
+    bp.GRAPH_CLIENT.get = lambda url, **kwargs: (graph.urls.append(url) or FakeResponse(
+        {"@odata.deltaLink": DELTA_LINK}) if "token=latest" in url else graph.get(url, **kwargs))
+    try:
+        latest_link = bp.fetch_latest_delta_link("token", USER_EMAIL)
+        changed_items, delta_link = bp.fetch_drive_changes(
+            "token", USER_EMAIL, ROOT_PATH, f"{bp.GRAPH_API_BASE}/users/{USER_EMAIL}/drive/root/delta?token=previous")
+    finally:
+        bp.GRAPH_CLIENT.get = original_get
+
+    assert latest_link == DELTA_LINK
+    assert "/drive/root/delta?token=latest" in graph.urls[0], graph.urls
+    assert delta_link == DELTA_LINK
+    # パスが返らないアイテムは残し、resolve_changed_project_foldersで親を辿って判定する
+    assert [item['id'] for item in changed_items] == ["inside", "no-path"], changed_items
+
+if __name__ == "__main__":
+    print("=" * 80)
+    print("🧪 ドライブのデルタによる案件フォルダ探索テスト（オフライン）")
+    print("=" * 80)
+    test_delta_discovery_filters_to_target()
+    print("✅ ドライブ全体のデルタからターゲットパス配下の案件フォルダのみを検出")
+    test_drive_changes_filtered_by_target_path()
+    print("✅ 差分更新の変更をターゲットパスで絞り込み")
+    print("\n🎉 すべて成功")
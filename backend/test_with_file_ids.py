@@ -15,6 +15,7 @@ from vertexai.generative_models import GenerativeModel, Part, GenerationConfig
 from google.cloud import secretmanager
 from google.cloud import firestore
 from google.api_core import retry, exceptions
+from batch_processor_v4_rate_optimized import fetch_pdf, read_file_data, close_file_data
 import re
 
 # --- 設定 ---
@@ -150,7 +151,7 @@ def analyze_with_gemini(file_data_list, file_name_hints=None):
         parts.append(hint_text)
 
     for file_info in file_data_list:
-        parts.append(Part.from_data(file_info["data"], mime_type=file_info["mime_type"]))
+        parts.append(Part.from_data(read_file_data(file_info), mime_type=file_info["mime_type"]))
         parts.append(f"[ファイル名: {file_info['name']}]")
 
     prompt = """
@@ -329,16 +330,14 @@ def process_single_project_by_file_id(project_info: Dict, access_token: str, use
 
         print(f"   📥 PDFダウンロード中: {len(calc_files)}ファイル")
         for pdf_file in calc_files[:5]:
-            download_url = pdf_file.get('@microsoft.graph.downloadUrl')
-            if download_url:
-                pdf_response = requests.get(download_url, timeout=120)
-                if pdf_response.status_code == 200:
-                    file_data_list.append({
-                        "data": pdf_response.content,
-                        "mime_type": "application/pdf",
-                        "name": pdf_file['name']
-                    })
-                    file_name_hints.append(pdf_file['name'])
+            pdf_file_data = fetch_pdf(pdf_file, headers, TARGET_USER_EMAIL)
+            if pdf_file_data is not None:
+                file_data_list.append({
+                    "file": pdf_file_data,
+                    "mime_type": "application/pdf",
+                    "name": pdf_file['name']
+                })
+                file_name_hints.append(pdf_file['name'])
 
         if not file_data_list:
             elapsed = time.time() - start_time
@@ -346,7 +345,10 @@ def process_single_project_by_file_id(project_info: Dict, access_token: str, use
 
         # Gemini APIで解析
         print(f"   🤖 AI解析中...")
-        analysis_result = analyze_with_gemini_retry(file_data_list, file_name_hints)
+        try:
+            analysis_result = analyze_with_gemini_retry(file_data_list, file_name_hints)
+        finally:
+            close_file_data(file_data_list)
 
         del file_data_list
         gc.collect()